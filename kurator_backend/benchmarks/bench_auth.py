@@ -0,0 +1,123 @@
+"""
+Measures what authentication costs per request: a route that only depends on
+`get_current_user`, called as ASGI with the cookie of a logged-in user, under
+each session backend of `kurator/sessions.py`, against the same route with no
+session at all. `cookie` is the signed cookie of Starlette's
+`SessionMiddleware` (what every request used to decode and verify), and
+`cookie+print` is the old dependency on top of it: a plain `def`, which
+FastAPI runs on a thread, that prints the user (to /dev/null here, so a lower
+bound of what the log costs).
+
+`--extra-bytes` pads the session, as with OAuth state that stays in it.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_auth.py [--requests 20000] [--extra-bytes 0] [--backends cookie memory sqlite]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from starlette.middleware.sessions import SessionMiddleware
+
+from kurator.routes.db import get_current_user
+from kurator.sessions import MemorySessionStore, ServerSessionMiddleware, SQLiteSessionStore
+
+BACKENDS = ["cookie+print", "cookie", "memory", "sqlite", "sqlite-nocache"]
+
+
+def make_app(backend: str, extra_bytes: int, tmp: Path) -> FastAPI:
+    app = FastAPI()
+    devnull = open(os.devnull, "w")
+
+    @app.get("/login")
+    async def login(request: Request):
+        request.session["user"] = {"given_name": "Bench", "email": "bench@example.com"}
+        if extra_bytes:
+            request.session["extra"] = "x" * extra_bytes
+        return PlainTextResponse("ok")
+
+    def get_current_user_printed(user=Depends(get_current_user)):
+        print("Current user:", user, file=devnull)
+        return user
+
+    dependency = get_current_user_printed if backend == "cookie+print" else get_current_user
+
+    @app.get("/whoami")
+    async def whoami(user=Depends(dependency)):
+        return PlainTextResponse(user["email"])
+
+    @app.get("/anonymous")
+    async def anonymous():
+        return PlainTextResponse("bench@example.com")
+
+    if backend.startswith("cookie"):
+        app.add_middleware(SessionMiddleware, secret_key="bench")
+    elif backend == "memory":
+        app.add_middleware(ServerSessionMiddleware, store=MemorySessionStore())
+    else:
+        store = SQLiteSessionStore(tmp / f"{backend}.db")
+        app.add_middleware(ServerSessionMiddleware, store=store, cache_ttl=0 if backend == "sqlite-nocache" else 30)
+    return app
+
+
+async def call(app, path: str, cookie: str = ""):
+    headers = [(b"cookie", cookie.encode())] if cookie else []
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+             "root_path": "", "headers": headers, "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+    response = {}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message["headers"]
+
+    await app(scope, receive, send)
+    return response
+
+
+async def per_request_us(app, path: str, cookie: str, n: int) -> float:
+    rounds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(n // 5):
+            response = await call(app, path, cookie)
+        rounds.append((time.perf_counter() - start) / (n // 5) * 1e6)
+        assert response["status"] == 200, response
+    return statistics.median(rounds)
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'backend':>14} | {'cookie bytes':>12} {'us/request':>10} {'auth us':>8}")
+        for backend in args.backends:
+            app = make_app(backend, args.extra_bytes, Path(tmp))
+            login = await call(app, "/login")
+            set_cookie = dict(login["headers"])[b"set-cookie"].decode()
+            cookie = set_cookie.split(";")[0]
+            await per_request_us(app, "/whoami", cookie, 500)  # warm up
+            baseline = await per_request_us(app, "/anonymous", "", args.requests)
+            authed = await per_request_us(app, "/whoami", cookie, args.requests)
+            print(f"{backend:>14} | {len(cookie):>12} {authed:>10.1f} {authed - baseline:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--extra-bytes", type=int, default=0, help="padding in the session")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Compares the diff that goes into the instruction prompt: `difflib.ndiff` on
+raw lines (what the prompt used to contain) against the change set of
+`kurator/yaml_diff.py`, on generated multi-document configs of growing size.
+Every edit changes a few values, adds a container env var, and reorders and
+re-indents one document, like saving the config from another tool would.
+
+Reports the time per diff (the change set both cold and memoized) and the
+prompt tokens of the diff, counted with tiktoken's encoding for
+code-davinci-002 when it is installed, else estimated like the rate limiter.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_diff.py [--docs 1 10 50] [--repeat 3]
+"""
+import argparse
+import difflib
+import random
+import time
+
+import yaml
+
+from kurator.llm import estimate_tokens
+from kurator.yaml_diff import compute_diff, diff_configs
+
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("p50k_base")
+    count_tokens = lambda text: len(encoding.encode(text))
+    TOKENIZER = "tiktoken p50k_base"
+except Exception:
+    # not installed, or the encoding can't be downloaded
+    count_tokens = estimate_tokens
+    TOKENIZER = "estimated"
+
+
+def make_deployment(i: int):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": f"app-{i}", "namespace": "bench", "labels": {"app": f"app-{i}", "tier": "web"}},
+        "spec": {
+            "replicas": 2,
+            "selector": {"matchLabels": {"app": f"app-{i}"}},
+            "template": {
+                "metadata": {"labels": {"app": f"app-{i}"}},
+                "spec": {
+                    "containers": [
+                        {
+                            "name": name,
+                            "image": f"registry.example.com/{name}:1.{i}.0",
+                            "args": ["--port", str(8080 + c), "--log-level", "info"],
+                            "env": [{"name": f"VAR_{k}", "value": f"value-{i}-{k}"} for k in range(8)],
+                            "ports": [{"name": "http", "containerPort": 8080 + c}],
+                            "resources": {"requests": {"cpu": "100m", "memory": "128Mi"},
+                                          "limits": {"cpu": "500m", "memory": "512Mi"}},
+                        }
+                        for c, name in enumerate(["web", "sidecar"])
+                    ],
+                },
+            },
+        },
+    }
+
+
+def edit(docs, rng: random.Random):
+    docs = yaml.safe_load(yaml.safe_dump(docs))
+    for doc in rng.sample(docs, max(1, len(docs) // 10)):
+        doc["spec"]["replicas"] = 3
+        containers = doc["spec"]["template"]["spec"]["containers"]
+        containers[0]["image"] = containers[0]["image"].replace(":1.", ":2.")
+        containers[1]["env"].append({"name": "NEW_VAR", "value": "on"})
+    # Reordered keys, as when the config is saved by another tool
+    docs[-1] = dict(reversed(list(docs[-1].items())))
+    return docs
+
+
+def dump(docs, indent: int = 2) -> str:
+    return "---\n".join(yaml.safe_dump(doc, sort_keys=False, indent=indent) for doc in docs)
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, nargs="+", default=[1, 10, 50], help="documents per config")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"tokens: {TOKENIZER}")
+    print(f"{'docs':>5} {'lines':>6} | {'ndiff ms':>9} {'tokens':>7} | {'change set ms':>13} {'memoized ms':>11} {'tokens':>7}")
+    for n in args.docs:
+        docs = [make_deployment(i) for i in range(n)]
+        before = dump(docs)
+        edited = edit(docs, rng)
+        # ... and re-indented
+        after = "---\n".join([dump(edited[:-1]), yaml.safe_dump(edited[-1], sort_keys=False, indent=4)])
+
+        ndiff = lambda: "\n".join(difflib.ndiff(before.splitlines(), after.splitlines()))
+        ndiff_ms = timed(ndiff, args.repeat) * 1000
+        cold_ms = timed(lambda: compute_diff(before, after), args.repeat) * 1000
+        diff_configs(before, after)
+        memoized_ms = timed(lambda: diff_configs(before, after), args.repeat) * 1000
+
+        print(f"{n:>5} {before.count(chr(10)):>6} | {ndiff_ms:>9.1f} {count_tokens(ndiff()):>7} | "
+              f"{cold_ms:>13.1f} {memoized_ms:>11.3f} {count_tokens(diff_configs(before, after)):>7}")
+
+
+if __name__ == "__main__":
+    main()
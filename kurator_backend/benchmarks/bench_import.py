@@ -0,0 +1,76 @@
+"""
+Measures rows per second of inserting data points one transaction per row (what
+seeding through `/api/add_data_point` amounts to) against the batched
+transactions of `/api/import_data_points`. Both index the resource types of
+the rows they write, as the two endpoints do.
+
+Writes `--rows` scratch data points owned by a benchmark user with each method
+and deletes them again. Run it against a development database, it writes to
+`edit_data_points`.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_import.py [--rows N] [--batch-size N]
+"""
+import argparse
+import time
+
+from sqlalchemy import text
+
+from kurator.database import get_engine
+from kurator.dataset import index_data_points, insert_data_point, write_data_points
+
+BENCH_USER = "bench-import@kurator.local"
+
+
+def make_rows(n: int):
+    return [{
+        "username": BENCH_USER,
+        "before_edit": f"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: bench-{i}\n",
+        "human_change_instruction": "rename the config map",
+        "after_edit": f"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: bench-{i}-renamed\n",
+        "gpt3_change_instruction": "",
+        "edited": True,
+        "note": "",
+    } for i in range(n)]
+
+
+def one_per_transaction(engine, rows, batch_size):
+    for row in rows:
+        with engine.begin() as conn:
+            data_point_id = insert_data_point(conn, row)
+            index_data_points(conn, [dict(row, id=data_point_id)])
+
+
+def batched(engine, rows, batch_size):
+    results = write_data_points(engine, rows, BENCH_USER, False, batch_size=batch_size)
+    assert all(r["status"] == "created" for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    rows = make_rows(args.rows)
+    results = {}
+    try:
+        for name, write in [("one per transaction", one_per_transaction), ("batched", batched)]:
+            start = time.perf_counter()
+            write(engine, rows, args.batch_size)
+            results[name] = args.rows / (time.perf_counter() - start)
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "DELETE FROM data_point_resources WHERE data_point_id IN "
+                "(SELECT id FROM edit_data_points WHERE username = :u)"), {"u": BENCH_USER})
+            conn.execute(text("DELETE FROM edit_data_points WHERE username = :u"), {"u": BENCH_USER})
+
+    for name, rate in results.items():
+        print(f"{name:>20}: {rate:8.1f} rows/s")
+    print(f"speedup: {results['batched'] / results['one per transaction']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Fires concurrent queries at the LLM client (`kurator/llm.py`) and reports
+latency and how many upstream requests they took. Identical in-flight prompts
+are coalesced, so `--distinct 10 --queries 100` needs about 10 requests, and
+with LLM_BATCH_WINDOW_MS set the distinct prompts are batched into fewer still.
+LLM_REQUESTS_PER_MINUTE / LLM_TOKENS_PER_MINUTE show the limiter at work.
+
+Run it against the stub server (see benchmarks/llm_stub_server.py):
+    OPENAI_API_BASE=http://localhost:8001/v1 python benchmarks/bench_llm.py --queries 100 --distinct 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from kurator.llm import AsyncModel, close_http_client, rate_limiter
+
+
+async def run(queries: int, distinct: int):
+    model = AsyncModel("code-davinci-002")
+    latencies = []
+
+    async def one(i: int):
+        start = time.perf_counter()
+        await model.query(f"Describe change number {i % distinct}")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(queries)])
+    wall = time.perf_counter() - start
+    await close_http_client()
+
+    stats = model.stats()
+    print(f"{queries} queries ({distinct} distinct prompts) in {wall:.2f}s")
+    print(f"upstream requests: {stats['upstream_requests']}, coalesced: {stats['coalesced']}, "
+          f"batches: {stats['batches']}, retries: {stats['retries']}")
+    limiter = rate_limiter.stats()
+    print(f"throttled: {limiter['throttled']} times, {limiter['throttled_seconds']:.2f}s in total")
+    print(f"latency: median {statistics.median(latencies) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--distinct", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.queries, args.distinct))
+
+
+if __name__ == "__main__":
+    main()
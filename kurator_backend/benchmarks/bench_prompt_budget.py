@@ -0,0 +1,59 @@
+"""
+Shows the token budget of the new-config prompt (`kurator/prompt_budget.py`)
+on generated multi-document configs: prompt tokens with the whole config
+against the trimmed prompt, and the `max_tokens` asked for instead of the
+fixed 250. The default instruction names one Deployment, so the other
+documents can be left out. With `--big-values` every ConfigMap carries a long
+embedded file, which is elided when an instruction that names nothing doesn't
+fit otherwise.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_prompt_budget.py [--docs 1 5 20 50] [--big-values] [--instruction TEXT]
+"""
+import argparse
+import time
+
+import yaml
+
+from kurator.routes.gpt3 import build_prompt_for_new_config
+
+
+def make_config(n: int, big_values: bool) -> str:
+    docs = []
+    for i in range(n):
+        docs.append({
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {"name": f"app-{i}"},
+            "spec": {"replicas": 2, "template": {"spec": {"containers": [
+                {"name": "web", "image": f"registry.example.com/web:1.{i}.0",
+                 "env": [{"name": f"VAR_{k}", "value": f"value-{k}"} for k in range(5)]}]}}},
+        })
+        data = "\n".join(f"setting_{k} = {k}" for k in range(200 if big_values else 5)) + "\n"
+        docs.append({"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": f"settings-{i}"},
+                     "data": {"app.conf": data}})
+    return "---\n".join(yaml.safe_dump(doc, sort_keys=False) for doc in docs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, nargs="+", default=[1, 5, 20, 50], help="Deployments (each with a ConfigMap)")
+    parser.add_argument("--big-values", action="store_true")
+    parser.add_argument("--instruction", default="Scale app-0 to 3 replicas")
+    args = parser.parse_args()
+
+    print(f"{'docs':>5} | {'untrimmed':>9} {'prompt':>7} {'max_tokens':>10} {'left out':>8} {'elided':>6} {'fits':>5} {'build ms':>8}")
+    for n in args.docs:
+        before = make_config(n, args.big_values)
+        start = time.perf_counter()
+        prompt = build_prompt_for_new_config(before, args.instruction, check_fits=False)
+        build_ms = (time.perf_counter() - start) * 1000
+        report = prompt.report()
+        print(f"{2 * n:>5} | {report['untrimmed_prompt_tokens']:>9} {report['prompt_tokens']:>7} "
+              f"{report['max_tokens']:>10} {len(report['documents_left_out']):>8} {report['values_elided']:>6} "
+              f"{str(report['fits']):>5} {build_ms:>8.1f}")
+    print(f"tokens: {report['tokenizer']}, context: {report['context_tokens']}")
+
+
+if __name__ == "__main__":
+    main()
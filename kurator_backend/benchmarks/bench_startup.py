@@ -0,0 +1,73 @@
+"""
+Measures the cold start of the app: how long `import kurator.app` takes in a
+fresh interpreter, and which modules account for it (`python -X importtime`).
+This is what every worker boot and every `--reload` pays before serving.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_startup.py [--repeat N] [--top N] [--module kurator.app]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Settings the app reads at import time; dummies are enough to import it
+DUMMY_ENV = {
+    "AUTH_SECRET_KEY": "bench",
+    "GITHUB_CLIENT_ID": "bench",
+    "GITHUB_CLIENT_SECRET": "bench",
+    "OPENAI_API_KEY": "bench",
+}
+
+
+def run_import(module: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    env = dict(DUMMY_ENV, **os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", f"import {module}"]
+    result = subprocess.run(args, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    return result
+
+
+def parse_importtime(stderr: str):
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the app")
+    parser.add_argument("--module", default="kurator.app")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="show the N slowest top-level imports of the module")
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run_import(args.module)
+        timings.append(time.perf_counter() - start)
+    print(f"import {args.module}: median {statistics.median(timings) * 1000:.0f} ms, "
+          f"min {min(timings) * 1000:.0f} ms over {args.repeat} fresh interpreters")
+
+    modules = parse_importtime(run_import(args.module, importtime=True).stderr)
+    total = next(cumulative for name, _, cumulative in reversed(modules) if name.strip() == args.module)
+    print(f"importtime cumulative for {args.module}: {total / 1000:.0f} ms")
+    # names are indented by two spaces per level; the module itself is at depth 0
+    nested = [(name.strip(), (len(name) - len(name.lstrip()) - 1) // 2, cumulative)
+              for name, _, cumulative in modules]
+    print(f"slowest imports within two levels of {args.module}:")
+    for name, depth, cumulative in sorted([m for m in nested if 1 <= m[1] <= 2], key=lambda m: -m[2])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {'  ' * (depth - 1)}{name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the two validation backends ("jsonschema" in-process vs. "kubeconform"
+subprocess) on the CRDs listed in crd_info.csv.
+
+For every (apiVersion, kind) in the corpus a minimal document is validated
+with both backends. Its metadata has a timestamp loaded by PyYAML as a
+`datetime`, as unquoted dates in user configs are. Reports per-document latency for each backend and how
+often the two backends agree on the outcome. Both backends are timed with the
+validation cache off; a last pass times jsonschema with a warm cache.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_validation.py [--limit N] [--repeat R]
+"""
+import argparse
+import datetime
+import statistics
+import time
+
+from kurator.utils import get_crd_info_index, validate_single_doc
+from kurator.validation_cache import validation_cache
+
+
+def sample_docs(limit: int):
+    docs = []
+    for row in get_crd_info_index().values():
+        docs.append({
+            "apiVersion": row["api_version"],
+            "kind": row["crd_name"],
+            "metadata": {"name": "bench", "creationTimestamp": datetime.datetime(2023, 1, 1)},
+            "spec": {},
+        })
+        if limit and len(docs) >= limit:
+            break
+    return docs
+
+
+def time_backend(backend: str, docs, repeat: int):
+    timings = []
+    results = []
+    for doc in docs:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            error = validate_single_doc(doc, backend=backend)
+        timings.append((time.perf_counter() - start) / repeat)
+        results.append(error)
+    return timings, results
+
+
+def summarize(name: str, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(0.95 * (len(timings_ms) - 1))]
+    print(f"{name:12s} docs={len(timings_ms)} total={sum(timings_ms):.1f}ms "
+          f"mean={statistics.mean(timings_ms):.2f}ms p50={statistics.median(timings_ms):.2f}ms p95={p95:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N CRDs (0 = all)")
+    parser.add_argument("--repeat", type=int, default=1, help="validate every document R times")
+    args = parser.parse_args()
+
+    docs = sample_docs(args.limit)
+    cache_size = validation_cache.max_entries
+    # otherwise every pass after the first would only time cache lookups
+    validation_cache.max_entries = 0
+    # generate missing schemas up front so that it isn't counted against either backend
+    for doc in docs:
+        validate_single_doc(doc, backend="jsonschema")
+
+    kc_timings, kc_results = time_backend("kubeconform", docs, args.repeat)
+    js_timings, js_results = time_backend("jsonschema", docs, args.repeat)
+
+    validation_cache.max_entries = cache_size
+    for doc in docs:
+        validate_single_doc(doc, backend="jsonschema")
+    cached_timings, _ = time_backend("jsonschema", docs, args.repeat)
+
+    summarize("kubeconform", kc_timings)
+    summarize("jsonschema", js_timings)
+    summarize("cached", cached_timings)
+    print(f"speedup: {sum(kc_timings) / max(sum(js_timings), 1e-9):.1f}x (uncached)")
+
+    agree = sum((a is None) == (b is None) for a, b in zip(kc_results, js_results))
+    print(f"backends agree on valid/invalid for {agree}/{len(docs)} documents")
+    for doc, a, b in zip(docs, kc_results, js_results):
+        if (a is None) != (b is None):
+            print(f"  {doc['apiVersion']} {doc['kind']}:\n    kubeconform: {a!r}\n    jsonschema:  {b!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures edits per second of the data point write path: the old
+`SELECT *` + `REPLACE INTO` against the single conditional `UPDATE` that
+`/api/add_data_point` uses now.
+
+Inserts `--rows` scratch data points owned by a benchmark user, edits each of
+them `--repeat` times with both variants (one transaction per edit, like the
+endpoint) and deletes them again. Run it against a development database, it
+writes to `edit_data_points`.
+
+Usage (from kurator_backend/):
+    python benchmarks/bench_writes.py [--rows N] [--repeat R]
+"""
+import argparse
+import time
+
+from sqlalchemy import text
+
+from kurator.database import get_engine
+from kurator.dataset import INSERT_COLUMNS, insert_data_point, update_data_point
+
+BENCH_USER = "bench-writes@kurator.local"
+
+
+def make_values(i: int, round: int):
+    return {
+        "username": BENCH_USER,
+        "before_edit": f"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: bench-{i}\n",
+        "human_change_instruction": f"bench edit {round}",
+        "after_edit": f"apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: bench-{i}-{round}\n",
+        "gpt3_change_instruction": "",
+        "edited": True,
+        "note": "",
+    }
+
+
+def legacy_edit(engine, values):
+    cols = ["id"] + INSERT_COLUMNS
+    with engine.begin() as conn:
+        existing = conn.execute(text(
+            "SELECT * FROM edit_data_points WHERE id = :id"), {"id": values["id"]}).fetchone()
+        assert existing is not None and existing._mapping["username"] == BENCH_USER
+        conn.execute(text("REPLACE INTO edit_data_points ({}) VALUES ({})".format(
+            ", ".join(cols), ", ".join(":" + col for col in cols))), values)
+
+
+def conditional_edit(engine, values):
+    with engine.begin() as conn:
+        assert update_data_point(conn, values, BENCH_USER, False)
+
+
+def run(engine, edit, ids, repeat: int) -> float:
+    start = time.perf_counter()
+    for round in range(repeat):
+        for i, data_point_id in enumerate(ids):
+            edit(engine, dict(make_values(i, round), id=data_point_id))
+    return len(ids) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = get_engine()
+    with engine.begin() as conn:
+        ids = [insert_data_point(conn, make_values(i, 0)) for i in range(args.rows)]
+    try:
+        # warm up the pool and the buffer pool
+        run(engine, conditional_edit, ids, 1)
+        results = {
+            "SELECT + REPLACE INTO": run(engine, legacy_edit, ids, args.repeat),
+            "conditional UPDATE": run(engine, conditional_edit, ids, args.repeat),
+        }
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM edit_data_points WHERE username = :u"), {"u": BENCH_USER})
+
+    print(f"{args.rows} rows x {args.repeat} edits")
+    for name, rate in results.items():
+        print(f"{name:>24}: {rate:8.1f} writes/s")
+    print(f"speedup: {results['conditional UPDATE'] / results['SELECT + REPLACE INTO']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Stand-in for the OpenAI completions API, for trying out and benchmarking the
+LLM client (`kurator/llm.py`) without an API key or cost.
+
+Answers `POST /v1/completions` after `--delay` seconds with `n` canned
+completions, cut at the first stop sequence like the real API, and fails a
+`--error-rate` fraction of the requests with a 429. With `"stream": true` the
+completion is sent as server-sent events, a few characters at a time, spread
+over the delay. `GET /stats` reports how many upstream requests it has seen.
+
+Usage (from kurator_backend/):
+    python benchmarks/llm_stub_server.py --port 8001 --delay 1
+    OPENAI_API_BASE=http://localhost:8001/v1 uvicorn kurator.app:app
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import *
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+app = FastAPI()
+app.state.delay = 0.5
+app.state.error_rate = 0.0
+app.state.requests = 0
+app.state.errors = 0
+app.state.prompts = 0
+
+# Looks like an answer to both prompts: a change instruction and a YAML config
+COMPLETION = (
+    "metadata:\n  name: stub\nspec:\n  replicas: 2\n```\n"
+    "In imperative form: Increase the number of replicas to 2.<<END>>"
+)
+
+
+class CompletionRequest(BaseModel):
+    model: str
+    prompt: Union[str, List[str]]
+    n: int = 1
+    max_tokens: int = 16
+    temperature: float = 1
+    top_p: float = 1
+    stop: Union[str, List[str], None] = None
+    stream: bool = False
+
+
+def cut_at_stop(text: str, stop: List[str]) -> str:
+    for s in stop:
+        if s in text:
+            text = text[:text.index(s)]
+    return text
+
+
+@app.post("/v1/completions")
+async def completions(request: CompletionRequest):
+    app.state.requests += 1
+    if random.random() < app.state.error_rate:
+        app.state.errors += 1
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests"}}, status_code=429)
+    prompts = [request.prompt] if isinstance(request.prompt, str) else request.prompt
+    app.state.prompts += len(prompts)
+    stop = [request.stop] if isinstance(request.stop, str) else (request.stop or [])
+    text = cut_at_stop(COMPLETION, stop)
+    if request.stream:
+        return StreamingResponse(stream_completion(request.model, text), media_type="text/event-stream")
+    await asyncio.sleep(app.state.delay)
+    return {
+        "object": "text_completion",
+        "model": request.model,
+        "choices": [
+            {"index": i, "text": text, "finish_reason": "stop"}
+            for i in range(len(prompts) * request.n)
+        ],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+async def stream_completion(model: str, text: str, chunk_size: int = 4):
+    chunks = [text[i: i + chunk_size] for i in range(0, len(text), chunk_size)]
+    for chunk in chunks:
+        await asyncio.sleep(app.state.delay / len(chunks))
+        event = {"object": "text_completion", "model": model,
+                 "choices": [{"index": 0, "text": chunk, "finish_reason": None}]}
+        yield f"data: {json.dumps(event)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/stats")
+def stats():
+    return {"requests": app.state.requests, "errors": app.state.errors, "prompts": app.state.prompts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub OpenAI completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds before every answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    args = parser.parse_args()
+    app.state.delay = args.delay
+    app.state.error_rate = args.error_rate
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
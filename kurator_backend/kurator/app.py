@@ -1,19 +1,41 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from starlette.config import Config
-from starlette.middleware.sessions import SessionMiddleware
 
+import kurator.crd_schemas as crd_schemas
+import kurator.database as database
+import kurator.instruction_jobs as instruction_jobs
+import kurator.llm as llm
+import kurator.migrate as migrate
 import kurator.routes.auth as auth
 import kurator.routes.db as db
 import kurator.routes.gpt3 as gpt3
 import kurator.routes.home as home
 import kurator.routes.utils as rutils
+import kurator.sessions as sessions
 
 config = Config()
 
-app = FastAPI()
-app.add_middleware(SessionMiddleware,
-                   secret_key=config.environ["AUTH_SECRET_KEY"])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if config('REQUIRE_SCHEMA_BUILD', cast=bool, default=False):
+        crd_schemas.check_schema_build_complete()
+    engine = database.init_engine()
+    if config('RUN_MIGRATIONS', cast=bool, default=True):
+        migrate.apply_migrations_with_retry(engine)
+    if instruction_jobs.INSTRUCTION_JOBS:
+        instruction_jobs.worker.start(engine, gpt3.generate_instruction)
+    yield
+    await instruction_jobs.worker.stop()
+    await llm.close_http_client()
+    database.dispose_engine()
+
+
+app = FastAPI(lifespan=lifespan)
+sessions.add_session_middleware(app)
 
 app.mount("/static", StaticFiles(directory=rutils.static_dir), name="static")
 
@@ -0,0 +1,272 @@
+"""
+CRD lookup table and generation of the JSON schemas in `crd_schemas/`.
+
+Schemas can be built ahead of time for every CRD in crd_info.csv:
+
+    python -m kurator.crd_schemas [--workers N] [--force]
+
+The build is incremental: `crd_schemas/manifest.json` records the hash of
+every source CRD file and of the schemas generated from it, and only sources
+that changed (or whose outputs were modified/deleted) are regenerated.
+Set `REQUIRE_SCHEMA_BUILD=true` to make the server refuse to start until the
+build is complete. Schemas that are missing at validation time are still
+generated on demand.
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from pathlib import Path
+from typing import *
+
+from kurator import openapi2jsonschema
+
+SRC_PATH = Path(__file__).parent
+ROOT_PATH = SRC_PATH.parent
+CRD_SCHEMAS_PATH = ROOT_PATH / "crd_schemas"
+MANIFEST_PATH = CRD_SCHEMAS_PATH / "manifest.json"
+
+
+
+###### CRD lookup ######
+
+@lru_cache(maxsize=None)
+def load_crd_info() -> Tuple[Dict[str, str], ...]:
+    # Read on first use rather than at import, so that starting the app doesn't pay for it
+    with open(ROOT_PATH / "crd_info.csv", newline="") as f:
+        return tuple(csv.DictReader(f))
+
+def crd_version_key(version: str) -> Tuple[int, ...]:
+    return tuple(map(int, version.split('.')))
+
+def build_crd_info_index(rows: Iterable[Dict]) -> Dict[Tuple[str, str], Dict]:
+    # (api_version, crd_name) -> row of the latest operator version providing that CRD
+    index = {}
+    for row in rows:
+        key = (row['api_version'], row['crd_name'])
+        if key not in index or crd_version_key(row['version']) > crd_version_key(index[key]['version']):
+            index[key] = row
+    return index
+
+@lru_cache(maxsize=None)
+def get_crd_info_index() -> Dict[Tuple[str, str], Dict]:
+    return build_crd_info_index(load_crd_info())
+
+def get_crd_info_row(crd_api_version: str, crd_name: str) -> Dict:
+    # raises KeyError for unknown CRDs (e.g. inbuilt kinds)
+    return get_crd_info_index()[(crd_api_version, crd_name)]
+
+def get_json_schema_file_name_for_row(crd_info_row: Dict) -> Path:
+    crd_operator = crd_info_row['operator']
+    crd_kind = crd_info_row['crd_name']
+    operator_version = crd_info_row['version']
+    crd_api_version = crd_info_row['api_version'].split("/")[1]
+    return CRD_SCHEMAS_PATH / f"{crd_operator}/{operator_version}/{crd_kind.lower()}_{crd_api_version}.json"
+
+@lru_cache(maxsize=None)
+def get_json_schema_file_name_for_crd(crd_api_version: str, crd_name: str) -> Path:
+    return get_json_schema_file_name_for_row(get_crd_info_row(crd_api_version, crd_name))
+
+
+###### Schema generation ######
+
+def unzip_community_operators_if_needed():
+    community_operators_path = ROOT_PATH / "community-operators"
+    if community_operators_path.exists():
+        return
+
+    community_operators_zip_path = ROOT_PATH / "community-operators.zip"
+    assert community_operators_zip_path.exists(), "community-operators.zip does not exist. Check if installation was proper."
+
+    subprocess.run(["unzip", "-o", community_operators_zip_path, "-d", ROOT_PATH], check=True)
+
+def generate_json_schemas(crd_yaml_path: Path, out_dir: Path) -> Optional[str]:
+    """Generates the JSON schemas of all CRDs in `crd_yaml_path` into `out_dir`. Returns an error, if any."""
+    try:
+        schemas = openapi2jsonschema.convert_crd_file(crd_yaml_path, filename_format="{kind}_{version}")
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for filename, schema in schemas.items():
+        # write-then-rename, so that concurrent readers never see a partial schema
+        path = out_dir / filename
+        tmp_path = path.with_name(f".{filename}.{os.getpid()}.tmp")
+        tmp_path.write_text(openapi2jsonschema.schema_to_json(schema))
+        os.replace(tmp_path, path)
+    return None
+
+# Requests for CRDs of the same operator version would otherwise race on the same files
+_generation_locks: Dict[Path, threading.Lock] = defaultdict(threading.Lock)
+
+def ensure_json_schema(crd_info_row: Dict) -> Path:
+    """Returns the schema path for the CRD, generating the schema first if it doesn't exist yet."""
+    crd_json_path = get_json_schema_file_name_for_row(crd_info_row)
+    if crd_json_path.exists():
+        return crd_json_path
+
+    with _generation_locks[crd_json_path.parent]:
+        if crd_json_path.exists():
+            return crd_json_path
+        crd_yaml_path = ROOT_PATH / crd_info_row['crd_path']
+        if not crd_yaml_path.exists():
+            # check if community-operators is already extracted
+            unzip_community_operators_if_needed()
+            assert crd_yaml_path.exists(), f"CRD yaml path {crd_yaml_path} does not exist"
+
+        error = generate_json_schemas(crd_yaml_path, crd_json_path.parent)
+        if error is not None:
+            print(error)
+            raise RuntimeError("Failed to generate schema for CRD")
+        assert crd_json_path.exists(), f"Schema file not generated: {crd_json_path}"
+    return crd_json_path
+
+
+###### Ahead-of-time build ######
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_manifest() -> Dict[str, Any]:
+    if not MANIFEST_PATH.exists():
+        return {"complete": False, "sources": {}}
+    return json.loads(MANIFEST_PATH.read_text())
+
+def write_manifest(manifest: Dict[str, Any]):
+    CRD_SCHEMAS_PATH.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp_path, MANIFEST_PATH)
+
+def get_build_groups() -> Dict[str, Dict[str, Any]]:
+    # One task per output directory (i.e. operator version), so that no two
+    # workers ever write into the same directory. A CRD file yields the schemas
+    # of all its versions, so each file is only converted once per directory.
+    groups = {}
+    for row in load_crd_info():
+        schema_path = get_json_schema_file_name_for_row(row)
+        key = str(schema_path.parent.relative_to(CRD_SCHEMAS_PATH))
+        group = groups.setdefault(key, {"crd_paths": [], "expected": []})
+        if row['crd_path'] not in group["crd_paths"]:
+            group["crd_paths"].append(row['crd_path'])
+        group["expected"].append(str(schema_path.relative_to(CRD_SCHEMAS_PATH)))
+    return groups
+
+def sources_sha256(crd_paths: List[str]) -> Optional[str]:
+    h = hashlib.sha256()
+    for crd_path in sorted(crd_paths):
+        path = ROOT_PATH / crd_path
+        if not path.exists():
+            return None
+        h.update(crd_path.encode() + b"\0" + sha256_file(path).encode() + b"\0")
+    return h.hexdigest()
+
+def is_up_to_date(group: Dict[str, Any], entry: Optional[Dict[str, Any]]) -> bool:
+    if entry is None or entry.get("error"):
+        return False
+    if sources_sha256(group["crd_paths"]) != entry["source_sha256"]:
+        return False
+    for rel_path, digest in entry["outputs"].items():
+        path = CRD_SCHEMAS_PATH / rel_path
+        if not path.exists() or sha256_file(path) != digest:
+            return False
+    return True
+
+def build_group(key: str, group: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    # Runs in a worker process
+    out_dir = CRD_SCHEMAS_PATH / key
+    entry = {"source_sha256": sources_sha256(group["crd_paths"]), "outputs": {}, "error": None}
+    if entry["source_sha256"] is None:
+        entry["error"] = f"Some of the CRD yaml files do not exist: {group['crd_paths']}"
+        return key, entry
+
+    errors = []
+    for crd_path in group["crd_paths"]:
+        error = generate_json_schemas(ROOT_PATH / crd_path, out_dir)
+        if error is not None:
+            errors.append(f"{crd_path}: {error}")
+    missing = [p for p in group["expected"] if not (CRD_SCHEMAS_PATH / p).exists()]
+    if missing:
+        errors.append(f"Schema files not generated: {', '.join(missing)}")
+    if errors:
+        entry["error"] = "\n".join(errors)
+
+    entry["outputs"] = {
+        str(p.relative_to(CRD_SCHEMAS_PATH)): sha256_file(p) for p in sorted(out_dir.glob("*.json"))
+    }
+    return key, entry
+
+def build_all_schemas(workers: Optional[int] = None, force: bool = False, verbose: bool = True) -> Dict[str, Any]:
+    unzip_community_operators_if_needed()
+    groups = get_build_groups()
+    manifest = load_manifest()
+    sources = manifest.get("sources", {})
+    # Drop entries of CRDs that are no longer in crd_info.csv
+    sources = {k: v for k, v in sources.items() if k in groups}
+
+    todo = {k: g for k, g in groups.items() if force or not is_up_to_date(g, sources.get(k))}
+    if verbose:
+        print(f"{len(groups)} operator versions, {len(groups) - len(todo)} up to date, building {len(todo)}")
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_group, k, g) for k, g in todo.items()]
+        for i, future in enumerate(as_completed(futures)):
+            key, entry = future.result()
+            sources[key] = entry
+            if verbose and entry["error"]:
+                print(f"[{i + 1}/{len(todo)}] FAILED {key}: {entry['error'].strip()}")
+            elif verbose and (i + 1) % 100 == 0:
+                print(f"[{i + 1}/{len(todo)}] built")
+
+    errors = {k: v["error"] for k, v in sources.items() if v.get("error")}
+    manifest = {
+        "complete": len(errors) == 0 and len(sources) == len(groups),
+        "built_at": datetime.datetime.now().isoformat(),
+        # changes whenever any generated schema changes
+        "build_id": hashlib.sha256(json.dumps(
+            {k: v["outputs"] for k, v in sorted(sources.items())}, sort_keys=True).encode()).hexdigest(),
+        "sources": sources,
+    }
+    write_manifest(manifest)
+    if verbose:
+        print(f"Built {len(todo)} operator versions in {time.time() - start:.1f}s, {len(errors)} failed. Manifest: {MANIFEST_PATH}")
+    return manifest
+
+def check_schema_build_complete():
+    """Raises if the ahead-of-time build hasn't been run (successfully) for the current crd_info.csv."""
+    manifest = load_manifest()
+    groups = get_build_groups()
+    missing = [k for k in groups if k not in manifest.get("sources", {})]
+    if not manifest.get("complete") or missing:
+        raise RuntimeError(
+            f"CRD schema build is incomplete ({len(missing)} of {len(groups)} operator versions not built). "
+            "Run `python -m kurator.crd_schemas` first."
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the JSON schemas of all CRDs in crd_info.csv")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="rebuild everything, ignoring the manifest")
+    args = parser.parse_args()
+
+    manifest = build_all_schemas(workers=args.workers, force=args.force)
+    sys.exit(0 if manifest["complete"] else 1)
+
+
+if __name__ == "__main__":
+    main()
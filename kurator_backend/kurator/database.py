@@ -0,0 +1,70 @@
+from typing import Any, Dict, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.base import Engine
+from starlette.config import Config
+
+config = Config()
+
+# One engine (and hence one connection pool) per process. Created in the app's
+# lifespan, or lazily by CLI tools that talk to the database directly.
+_engine: Optional[Engine] = None
+
+
+def get_db_url() -> str:
+    user = config.get('MYSQL_USER')
+    password = config.get('MYSQL_PASSWORD')
+    host = config.get('MYSQL_HOST')
+    port = config.get('MYSQL_PORT')
+    db = config.get('MYSQL_DATABASE')
+    return f'mysql://{user}:{password}@{host}:{port}/{db}'
+
+
+def create_db_engine() -> Engine:
+    return create_engine(
+        get_db_url(),
+        pool_size=config('MYSQL_POOL_SIZE', cast=int, default=10),
+        max_overflow=config('MYSQL_POOL_MAX_OVERFLOW', cast=int, default=20),
+        pool_timeout=config('MYSQL_POOL_TIMEOUT', cast=float, default=30),
+        # MySQL drops idle connections after `wait_timeout` (8h by default), so
+        # recycle well before that and ping on checkout to survive db restarts.
+        pool_recycle=config('MYSQL_POOL_RECYCLE', cast=int, default=1800),
+        pool_pre_ping=config('MYSQL_POOL_PRE_PING', cast=bool, default=True),
+    )
+
+
+def init_engine(test_conn: bool = False) -> Engine:
+    global _engine
+    if _engine is None:
+        _engine = create_db_engine()
+    if test_conn:
+        with _engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    return _engine
+
+
+def get_engine() -> Engine:
+    if _engine is None:
+        return init_engine()
+    return _engine
+
+
+def dispose_engine():
+    global _engine
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    engine = get_engine()
+    pool = engine.pool
+    # Not every pool class (e.g. NullPool/StaticPool) tracks these counters
+    stats = {"pool_class": type(pool).__name__}
+    for name in ["size", "checkedin", "checkedout", "overflow"]:
+        fn = getattr(pool, name, None)
+        if callable(fn):
+            stats[name] = fn()
+    stats["max_overflow"] = getattr(pool, "_max_overflow", None)
+    stats["status"] = pool.status()
+    return stats
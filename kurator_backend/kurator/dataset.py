@@ -0,0 +1,418 @@
+"""
+Helpers for jobs and exports that walk over the whole `edit_data_points` table.
+"""
+import base64
+import datetime
+import json
+import re
+from typing import *
+
+import yaml
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+DATA_POINT_COLUMNS = [
+    "id", "username", "before_edit", "human_change_instruction", "after_edit",
+    "gpt3_change_instruction", "note", "edited", "deleted", "created_at",
+    "updated_at", "tags",
+]
+
+
+###### Resource types ######
+
+MAX_RESOURCE_VALUE_LENGTH = 255
+DOCUMENT_SEPARATOR = re.compile(r"^---(?:[ \t].*)?$", re.MULTILINE)
+# Fields at the top level of a document are the only unindented `key:` lines
+TOP_LEVEL_FIELD = re.compile(r"^(apiVersion|kind):[ \t]*(.*?)[ \t]*$", re.MULTILINE)
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def clean_value(value: str) -> str:
+    value = re.sub(r"[ \t]+#.*$", "", value)
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        value = value[1:-1]
+    return value.strip()[:MAX_RESOURCE_VALUE_LENGTH]
+
+
+def document_resource(document: str) -> Optional[Tuple[str, str]]:
+    fields: Dict[str, str] = {}
+    for m in TOP_LEVEL_FIELD.finditer(document):
+        fields.setdefault(m.group(1), clean_value(m.group(2)))
+    if not fields and "{" in document:
+        # flow style (JSON), rare enough to parse
+        try:
+            doc = yaml.load(document, Loader=Loader)
+        except yaml.YAMLError:
+            doc = None
+        if isinstance(doc, dict):
+            fields = {k: str(doc[k])[:MAX_RESOURCE_VALUE_LENGTH] for k in ("apiVersion", "kind") if doc.get(k) is not None}
+    if not fields.get("apiVersion") and not fields.get("kind"):
+        return None
+    return fields.get("apiVersion", ""), fields.get("kind", "")
+
+
+def extract_resources(*configs: str) -> List[Tuple[str, str]]:
+    """
+    The distinct (apiVersion, kind) of the documents of the configs. Read from
+    the lines instead of parsing, so that it is cheap on the write path and
+    works on configs that are not valid YAML.
+    """
+    resources = set()
+    for config_yaml in configs:
+        for document in DOCUMENT_SEPARATOR.split(config_yaml):
+            resource = document_resource(document)
+            if resource is not None:
+                resources.add(resource)
+    return sorted(resources)
+
+
+def index_data_points(conn, data_points: List[Dict[str, Any]]):
+    """(Re)writes the resource types of data points (with `id`, `before_edit` and `after_edit`), in the caller's transaction."""
+    if not data_points:
+        return
+    conn.execute(text("DELETE FROM data_point_resources WHERE data_point_id IN :ids").bindparams(
+        bindparam("ids", expanding=True)), {"ids": [dp["id"] for dp in data_points]})
+    rows = [
+        {"data_point_id": dp["id"], "api_version": api_version, "kind": kind}
+        for dp in data_points
+        for api_version, kind in extract_resources(dp["before_edit"], dp["after_edit"])
+    ]
+    if rows:
+        conn.execute(text(
+            "INSERT INTO data_point_resources (data_point_id, api_version, kind) "
+            "VALUES (:data_point_id, :api_version, :kind)"), rows)
+
+
+###### Writes ######
+
+# An edit keeps the owner, created_at, deleted and tags of the row
+INSERT_COLUMNS = ["username", "before_edit", "human_change_instruction",
+                  "after_edit", "gpt3_change_instruction", "edited", "note"]
+UPDATE_COLUMNS = INSERT_COLUMNS[1:]
+
+INSERT_DATA_POINT = text("INSERT INTO edit_data_points ({}) VALUES ({})".format(
+    ", ".join(INSERT_COLUMNS), ", ".join(":" + col for col in INSERT_COLUMNS)))
+# The ownership check is part of the statement, so an edit is a single round trip.
+# The affected-row count tells whether it went through: SQLAlchemy's MySQL
+# drivers connect with CLIENT_FOUND_ROWS, so it counts matched, not changed, rows.
+UPDATE_DATA_POINT = text(
+    "UPDATE edit_data_points SET {}, updated_at = CURRENT_TIMESTAMP "
+    "WHERE id = :id AND (username = :editing_user OR :is_admin)".format(
+        ", ".join(f"{col} = :{col}" for col in UPDATE_COLUMNS)))
+DELETE_DATA_POINT = text(
+    "UPDATE edit_data_points SET deleted = True, updated_at = CURRENT_TIMESTAMP "
+    "WHERE id = :id AND (username = :editing_user OR :is_admin)")
+
+
+def insert_data_point(conn, values: Dict[str, Any]) -> int:
+    """Inserts a new data point and returns its id."""
+    return conn.execute(INSERT_DATA_POINT, {col: values[col] for col in INSERT_COLUMNS}).lastrowid
+
+
+def update_data_point(conn, values: Dict[str, Any], editing_user: str, is_admin: bool) -> bool:
+    """Updates data point `values["id"]` in place, if it exists and `editing_user` may edit it."""
+    params = {col: values[col] for col in UPDATE_COLUMNS}
+    params.update(id=values["id"], editing_user=editing_user, is_admin=is_admin)
+    return conn.execute(UPDATE_DATA_POINT, params).rowcount == 1
+
+
+def soft_delete_data_point(conn, data_point_id: int, editing_user: str, is_admin: bool) -> bool:
+    return conn.execute(DELETE_DATA_POINT, {
+        "id": data_point_id, "editing_user": editing_user, "is_admin": is_admin}).rowcount == 1
+
+
+def write_denied_reason(conn, data_point_id: int) -> str:
+    """Why a conditional update/delete matched no row. Only runs on the error path."""
+    exists = conn.execute(text("SELECT 1 FROM edit_data_points WHERE id = :id"), {"id": data_point_id}).scalar()
+    return "username does not match" if exists else "id does not exist"
+
+
+def write_data_points(
+    engine: Engine,
+    rows: List[Dict[str, Any]],
+    editing_user: str,
+    is_admin: bool,
+    batch_size: int = 100,
+) -> List[Dict[str, Any]]:
+    """
+    Upserts many data points, `batch_size` rows per transaction. Rows without
+    an id are inserted, rows with an id are conditional updates (see
+    `update_data_point`). Returns the status of every
+    row, in order: {"status": "created" | "updated" | "error", "id", "error"}.
+    The resource types of the written rows are indexed in the same transaction.
+    A database error rolls back (and fails) only its own batch.
+    """
+    results: List[Dict[str, Any]] = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start: start + batch_size]
+        try:
+            with engine.begin() as conn:
+                batch_results = []
+                for row in batch:
+                    if not row.get("id"):
+                        # One INSERT per row: ids of a multi-row INSERT aren't consecutive
+                        # with innodb_autoinc_lock_mode=2 or auto_increment_increment > 1
+                        batch_results.append({"status": "created", "id": insert_data_point(conn, row), "error": None})
+                    elif update_data_point(conn, row, editing_user, is_admin):
+                        batch_results.append({"status": "updated", "id": row["id"], "error": None})
+                    else:
+                        batch_results.append({"status": "error", "id": row["id"],
+                                              "error": write_denied_reason(conn, row["id"])})
+                index_data_points(conn, [dict(row, id=result["id"]) for row, result in zip(batch, batch_results)
+                                         if result["status"] != "error" and result["id"]])
+        except SQLAlchemyError as e:
+            print(f"Batch of rows {start}-{start + len(batch) - 1} failed:", repr(e))
+            batch_results = [{"status": "error", "id": row.get("id"), "error": f"batch failed: {type(e).__name__}"}
+                             for row in batch]
+        results.extend(batch_results)
+    return results
+
+
+def iter_data_point_chunks(
+    engine: Engine,
+    columns: List[str],
+    chunk_size: int = 500,
+    after_id: int = 0,
+    include_deleted: bool = False,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yields the data points with id > `after_id` in chunks of `chunk_size`,
+    ordered by id. Every chunk is its own (keyset paginated) query, so no
+    connection or transaction is held open between chunks.
+    """
+    if 'id' not in columns:
+        columns = ['id'] + columns
+    query = f"SELECT {', '.join(columns)} FROM edit_data_points WHERE id > :after_id"
+    if not include_deleted:
+        query += " AND deleted = False"
+    query += " ORDER BY id LIMIT :limit"
+
+    while True:
+        with engine.connect() as conn:
+            rows = [dict(r._mapping) for r in conn.execute(
+                text(query), {"after_id": after_id, "limit": chunk_size})]
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1]['id']
+        if len(rows) < chunk_size:
+            return
+
+
+def get_checkpoint(engine: Engine, job_name: str) -> int:
+    with engine.connect() as conn:
+        last_id = conn.execute(text(
+            "SELECT last_id FROM job_checkpoints WHERE job_name = :job_name"), {"job_name": job_name}).scalar()
+    return last_id or 0
+
+
+def save_checkpoint(conn, job_name: str, last_id: int):
+    conn.execute(text(
+        "INSERT INTO job_checkpoints (job_name, last_id) VALUES (:job_name, :last_id) "
+        "ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)"), {"job_name": job_name, "last_id": last_id})
+
+
+###### Change feed ######
+
+class FeedToken(NamedTuple):
+    """Position in the change feed: the last (updated_at, id) a consumer has seen."""
+    updated_at: datetime.datetime
+    id: int
+
+
+FEED_START = FeedToken(datetime.datetime(1970, 1, 1), 0)
+
+
+def encode_feed_token(token: FeedToken) -> str:
+    data = json.dumps({"t": token.updated_at.isoformat(), "id": token.id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_feed_token(token: str) -> FeedToken:
+    """Raises ValueError on anything that isn't a token from `encode_feed_token`."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return FeedToken(datetime.datetime.fromisoformat(data["t"]), int(data["id"]))
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"invalid feed token: {e}") from e
+
+
+def to_db_time(engine: Engine, t: datetime.datetime) -> datetime.datetime:
+    """
+    `t` as a naive time in the timezone of the database session, which is what
+    TIMESTAMP columns are compared in. Naive times are assumed to be in it already.
+    """
+    if t.tzinfo is None:
+        return t
+    with engine.connect() as conn:
+        offset = conn.execute(text("SELECT TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW())")).scalar()
+    return t.astimezone(datetime.timezone(datetime.timedelta(seconds=int(offset)))).replace(tzinfo=None)
+
+
+def change_type(row: Dict[str, Any]) -> str:
+    # Timestamps have a resolution of one second, so an edit within the second
+    # the row was created in still counts as "created"
+    if row["deleted"]:
+        return "deleted"
+    if row["created_at"] == row["updated_at"]:
+        return "created"
+    return "updated"
+
+
+def get_changes(
+    engine: Engine,
+    columns: List[str],
+    since: FeedToken = FEED_START,
+    limit: int = 500,
+    safety_lag_seconds: int = 5,
+) -> Tuple[List[Dict[str, Any]], FeedToken]:
+    """
+    Returns the data points created, updated or (soft) deleted after `since`,
+    ordered by (updated_at, id), and the token to continue from.
+
+    updated_at has a resolution of one second, so rows of the current second
+    (and of transactions that may still commit with an older timestamp) are
+    held back for `safety_lag_seconds`. Once a second is handed out it can't
+    gain rows anymore, so polling with the returned token misses nothing.
+    """
+    columns = [c for c in columns if c not in ("id", "created_at", "updated_at", "deleted")]
+    columns = ["id", "created_at", "updated_at", "deleted"] + columns
+    query = (
+        f"SELECT {', '.join(columns)} FROM edit_data_points "
+        "WHERE (updated_at > :t OR (updated_at = :t AND id > :id)) "
+        "AND updated_at < NOW() - INTERVAL :lag SECOND "
+        "ORDER BY updated_at, id LIMIT :limit"
+    )
+    with engine.connect() as conn:
+        rows = [dict(r._mapping) for r in conn.execute(text(query), {
+            "t": since.updated_at, "id": since.id, "lag": safety_lag_seconds, "limit": limit,
+        })]
+    for row in rows:
+        row["change_type"] = change_type(row)
+    if rows:
+        since = FeedToken(rows[-1]["updated_at"], rows[-1]["id"])
+    return rows, since
+
+
+###### Export ######
+
+# Columns a training example consists of
+DEFAULT_EXPORT_COLUMNS = ["id", "before_edit", "human_change_instruction", "after_edit"]
+EXPORT_FORMATS = ["jsonl", "parquet"]
+EXPORT_MEDIA_TYPES = {"jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+
+def iter_export_batches(
+    engine: Engine,
+    columns: List[str],
+    username: Optional[str] = None,
+    updated_since: Optional[datetime.datetime] = None,
+    deleted: Optional[bool] = False,
+    batch_size: int = 1000,
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yields the matching data points in batches, ordered by id. Uses a
+    server-side cursor, so memory use doesn't depend on the table size.
+    `deleted=None` exports both deleted and non-deleted data points.
+    """
+    query = f"SELECT {', '.join(columns)} FROM edit_data_points WHERE 1 = 1"
+    params: Dict[str, Any] = {}
+    if deleted is not None:
+        query += " AND deleted = :deleted"
+        params["deleted"] = deleted
+    if username is not None:
+        query += " AND username = :username"
+        params["username"] = username
+    if updated_since is not None:
+        query += " AND updated_at >= :updated_since"
+        params["updated_since"] = to_db_time(engine, updated_since)
+    query += " ORDER BY id"
+
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=batch_size) as conn:
+        result = conn.execute(text(query), params)
+        for partition in result.mappings().partitions(batch_size):
+            yield [dict(r) for r in partition]
+
+
+def _json_default(o):
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def iter_jsonl(batches: Iterable[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(json.dumps(row, default=_json_default) + "\n" for row in batch).encode("utf-8")
+
+
+class _StreamSink:
+    """Write-only file that hands out what has been written so far, but keeps counting positions."""
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# TINYINT(1) columns, which the driver returns as 0 and 1
+BOOL_COLUMNS = ["edited", "deleted"]
+
+
+def parquet_schema(columns: List[str]):
+    import pyarrow as pa
+
+    types = {
+        "id": pa.int64(), "edited": pa.bool_(), "deleted": pa.bool_(),
+        "created_at": pa.timestamp("s"), "updated_at": pa.timestamp("s"),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in columns])
+
+
+def iter_parquet(batches: Iterable[List[Dict[str, Any]]], columns: List[str]) -> Iterator[bytes]:
+    """Encodes the batches as a Parquet file, one row group per batch, yielding bytes as they're ready."""
+    # Optional dependency, only needed for Parquet exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(columns)
+    bools = [c for c in BOOL_COLUMNS if c in columns]
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for batch in batches:
+            for row in batch:
+                for col in bools:
+                    if row[col] is not None:
+                        row[col] = bool(row[col])
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def encode_export(batches: Iterable[List[Dict[str, Any]]], columns: List[str], format: str) -> Iterator[bytes]:
+    assert format in EXPORT_FORMATS, f"format must be one of {EXPORT_FORMATS}"
+    if format == "parquet":
+        return iter_parquet(batches, columns)
+    return iter_jsonl(batches)
@@ -0,0 +1,51 @@
+"""
+Exports the dataset for training pipelines, streaming rows from MySQL with a
+server-side cursor so that memory use stays flat regardless of table size.
+
+Usage (from kurator_backend/):
+    python -m kurator.export --format jsonl > data_points.jsonl
+    python -m kurator.export --format parquet --output data_points.parquet
+"""
+import argparse
+import datetime
+import sys
+
+from kurator.database import get_engine
+from kurator.dataset import (
+    DATA_POINT_COLUMNS, DEFAULT_EXPORT_COLUMNS, EXPORT_FORMATS, encode_export, iter_export_batches,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export data points as JSONL or Parquet")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+    parser.add_argument("--output", default="-", help="output file (default: stdout)")
+    parser.add_argument("--columns", default=",".join(DEFAULT_EXPORT_COLUMNS),
+                        help=f"comma separated columns, any of {','.join(DATA_POINT_COLUMNS)}")
+    parser.add_argument("--username", default=None, help="only export data points of this user")
+    parser.add_argument("--updated-since", type=datetime.datetime.fromisoformat, default=None,
+                        help="only export data points updated at or after this ISO timestamp")
+    parser.add_argument("--deleted", choices=["false", "true", "any"], default="false",
+                        help="export non-deleted (default), deleted or all data points")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per batch / Parquet row group")
+    args = parser.parse_args()
+
+    columns = [c.strip() for c in args.columns.split(",") if c.strip()]
+    unknown = [c for c in columns if c not in DATA_POINT_COLUMNS]
+    if unknown:
+        parser.error(f"unknown columns: {', '.join(unknown)}")
+    if args.output == "-" and args.format == "parquet" and sys.stdout.isatty():
+        parser.error("refusing to write parquet to a terminal, use --output")
+
+    batches = iter_export_batches(
+        get_engine(), columns, username=args.username, updated_since=args.updated_since,
+        deleted={"false": False, "true": True, "any": None}[args.deleted], batch_size=args.batch_size,
+    )
+    out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    with out:
+        for chunk in encode_export(batches, columns, args.format):
+            out.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
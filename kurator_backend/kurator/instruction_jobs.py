@@ -0,0 +1,317 @@
+"""
+Background generation of `gpt3_change_instruction` for new and edited data
+points, so that saving never waits for the model.
+
+The write path calls `enqueue_instruction_jobs` in its own transaction, so a
+job exists exactly when the write committed, and then `worker.notify()`. Jobs
+live in the `instruction_jobs` table (one per data point) and are run by an
+`InstructionJobWorker` on the event loop of every app process: it claims
+pending jobs with a conditional UPDATE, so workers of several processes never
+run the same job, generates the instruction and fills the column.
+
+- Jobs are keyed on the hash of (before_edit, after_edit). Saving a data point
+  without changing its configs doesn't queue a new job, and content that has
+  been answered before (for any data point) is filled in right away.
+- Failed jobs are retried `INSTRUCTION_JOB_MAX_ATTEMPTS` times with
+  exponential backoff, then marked `failed`.
+- A result is only written if the data point still has the content the job
+  was for; an edit in the meantime has queued a new job.
+- Jobs whose worker died while running them are picked up again after
+  `INSTRUCTION_JOB_TIMEOUT` seconds.
+"""
+import asyncio
+import datetime
+import hashlib
+from typing import *
+
+from sqlalchemy import text
+from sqlalchemy.engine.base import Engine
+from starlette.concurrency import run_in_threadpool
+from starlette.config import Config
+
+from kurator.llm import backoff_delay
+
+config = Config()
+
+INSTRUCTION_JOBS = config('INSTRUCTION_JOBS', cast=bool, default=True)
+INSTRUCTION_JOB_CONCURRENCY = config('INSTRUCTION_JOB_CONCURRENCY', cast=int, default=4)
+INSTRUCTION_JOB_MAX_ATTEMPTS = config('INSTRUCTION_JOB_MAX_ATTEMPTS', cast=int, default=5)
+INSTRUCTION_JOB_RETRY_BASE = config('INSTRUCTION_JOB_RETRY_BASE', cast=float, default=30)
+INSTRUCTION_JOB_RETRY_MAX = config('INSTRUCTION_JOB_RETRY_MAX', cast=float, default=3600)
+INSTRUCTION_JOB_POLL_SECONDS = config('INSTRUCTION_JOB_POLL_SECONDS', cast=float, default=10)
+INSTRUCTION_JOB_TIMEOUT = config('INSTRUCTION_JOB_TIMEOUT', cast=float, default=300)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# The data point was deleted (or changed outside of the app) before its job ran
+CANCELLED = "cancelled"
+JOB_STATUSES = [PENDING, RUNNING, DONE, FAILED, CANCELLED]
+
+JOB_COLUMNS = ["data_point_id", "content_hash", "status", "attempts", "instruction", "error",
+               "run_after", "claimed_at", "updated_at"]
+
+
+def content_hash(before_edit: str, after_edit: str) -> str:
+    h = hashlib.sha256(before_edit.encode("utf-8"))
+    h.update(b"\0" + after_edit.encode("utf-8"))
+    return h.hexdigest()
+
+
+def is_edited(human_change_instruction: str, gpt3_change_instruction: str) -> bool:
+    return human_change_instruction.strip() != gpt3_change_instruction.strip()
+
+
+###### Queue ######
+
+def fill_instruction(conn, data_point_id: int, instruction: str, human_change_instruction: str):
+    # Keeps updated_at, so that the change feed doesn't report the data point again as updated
+    conn.execute(text(
+        "UPDATE edit_data_points SET gpt3_change_instruction = :instruction, edited = :edited, "
+        "updated_at = updated_at WHERE id = :id"
+    ), {"id": data_point_id, "instruction": instruction,
+        "edited": is_edited(human_change_instruction, instruction)})
+
+
+def save_job(conn, data_point_id: int, content_hash: str, status: str, instruction: Optional[str] = None):
+    # A new job replaces whatever the data point had before
+    conn.execute(text(
+        "REPLACE INTO instruction_jobs (data_point_id, content_hash, status, attempts, instruction, run_after) "
+        "VALUES (:data_point_id, :content_hash, :status, 0, :instruction, :run_after)"
+    ), {"data_point_id": data_point_id, "content_hash": content_hash, "status": status,
+        "instruction": instruction, "run_after": datetime.datetime.now()})
+
+
+def enqueue_instruction_jobs(conn, data_points: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Queues generating the instruction of the given data points (with `id`,
+    `before_edit`, `after_edit` and `human_change_instruction`), inside the
+    caller's transaction. Returns how many were queued, were already queued
+    or done for the same content, and were filled from an earlier job.
+    """
+    counts = {"queued": 0, "unchanged": 0, "reused": 0}
+    for dp in data_points:
+        h = content_hash(dp["before_edit"], dp["after_edit"])
+        existing = conn.execute(text(
+            "SELECT content_hash, status, instruction FROM instruction_jobs WHERE data_point_id = :id"
+        ), {"id": dp["id"]}).fetchone()
+        if existing is not None and existing.content_hash == h and existing.status in (PENDING, RUNNING):
+            counts["unchanged"] += 1
+            continue
+
+        if existing is not None and existing.content_hash == h and existing.status == DONE:
+            instruction = existing.instruction
+        else:
+            instruction = conn.execute(text(
+                "SELECT instruction FROM instruction_jobs WHERE content_hash = :content_hash AND status = :done LIMIT 1"
+            ), {"content_hash": h, "done": DONE}).scalar()
+        if instruction is not None:
+            # The write path clears the column, so fill it again even if nothing changed
+            fill_instruction(conn, dp["id"], instruction, dp["human_change_instruction"])
+            if existing is not None and existing.content_hash == h and existing.status == DONE:
+                counts["unchanged"] += 1
+            else:
+                save_job(conn, dp["id"], h, DONE, instruction)
+                counts["reused"] += 1
+            continue
+
+        save_job(conn, dp["id"], h, PENDING)
+        counts["queued"] += 1
+    return counts
+
+
+def get_job(conn, data_point_id: int) -> Optional[Dict[str, Any]]:
+    row = conn.execute(text(
+        f"SELECT {', '.join(JOB_COLUMNS)} FROM instruction_jobs WHERE data_point_id = :id"
+    ), {"id": data_point_id}).fetchone()
+    return dict(row._mapping) if row is not None else None
+
+
+def count_jobs(conn) -> Dict[str, int]:
+    counts = {status: 0 for status in JOB_STATUSES}
+    for status, n in conn.execute(text("SELECT status, COUNT(*) FROM instruction_jobs GROUP BY status")):
+        counts[status] = n
+    return counts
+
+
+###### Claiming and finishing jobs ######
+
+def claim_jobs(engine: Engine, limit: int, timeout: float = INSTRUCTION_JOB_TIMEOUT) -> List[Dict[str, Any]]:
+    """Marks up to `limit` due jobs as running and returns them with their data point."""
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        # jobs of a worker that died while running them
+        conn.execute(text(
+            "UPDATE instruction_jobs SET status = :pending WHERE status = :running AND claimed_at < :stale"
+        ), {"pending": PENDING, "running": RUNNING, "stale": now - datetime.timedelta(seconds=timeout)})
+        candidates = conn.execute(text(
+            "SELECT data_point_id, content_hash FROM instruction_jobs "
+            "WHERE status = :pending AND run_after <= :now ORDER BY run_after LIMIT :limit"
+        ), {"pending": PENDING, "now": now, "limit": limit}).fetchall()
+
+    claimed = []
+    for candidate in candidates:
+        with engine.begin() as conn:
+            # conditional, so that only one worker gets the job
+            if conn.execute(text(
+                "UPDATE instruction_jobs SET status = :running, attempts = attempts + 1, claimed_at = :now "
+                "WHERE data_point_id = :id AND content_hash = :content_hash AND status = :pending"
+            ), {"running": RUNNING, "pending": PENDING, "now": now, "id": candidate.data_point_id,
+                "content_hash": candidate.content_hash}).rowcount != 1:
+                continue
+            job = conn.execute(text(
+                "SELECT j.data_point_id, j.content_hash, j.attempts, d.before_edit, d.after_edit, "
+                "d.human_change_instruction, d.deleted "
+                "FROM instruction_jobs j LEFT JOIN edit_data_points d ON d.id = j.data_point_id "
+                "WHERE j.data_point_id = :id"
+            ), {"id": candidate.data_point_id}).fetchone()
+        claimed.append(dict(job._mapping))
+    return claimed
+
+
+def finish_job(engine: Engine, job: Dict[str, Any], instruction: str) -> bool:
+    """Stores the result, unless the data point has been edited since. Returns whether it was stored."""
+    with engine.begin() as conn:
+        if conn.execute(text(
+            "UPDATE instruction_jobs SET status = :done, instruction = :instruction, error = NULL "
+            "WHERE data_point_id = :id AND content_hash = :content_hash AND status = :running"
+        ), {"done": DONE, "running": RUNNING, "instruction": instruction, "id": job["data_point_id"],
+            "content_hash": job["content_hash"]}).rowcount != 1:
+            return False
+        fill_instruction(conn, job["data_point_id"], instruction, job["human_change_instruction"])
+        return True
+
+
+def fail_job(engine: Engine, job: Dict[str, Any], error: str, max_attempts: int = INSTRUCTION_JOB_MAX_ATTEMPTS,
+             status: Optional[str] = None) -> str:
+    """Schedules a retry, or gives up after `max_attempts`. Returns the new status."""
+    if status is None:
+        status = PENDING if job["attempts"] < max_attempts else FAILED
+    delay = backoff_delay(job["attempts"], INSTRUCTION_JOB_RETRY_BASE, INSTRUCTION_JOB_RETRY_MAX)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE instruction_jobs SET status = :status, error = :error, run_after = :run_after "
+            "WHERE data_point_id = :id AND content_hash = :content_hash AND status = :running"
+        ), {"status": status, "error": error[:1000], "running": RUNNING,
+            "run_after": datetime.datetime.now() + datetime.timedelta(seconds=delay),
+            "id": job["data_point_id"], "content_hash": job["content_hash"]})
+    return status
+
+
+###### Worker ######
+
+class InstructionJobWorker:
+    """
+    Runs the jobs on the event loop, at most `concurrency` at a time.
+    `generate(before_edit, after_edit)` returns the instruction.
+    """
+    def __init__(self, concurrency: int = INSTRUCTION_JOB_CONCURRENCY, poll_seconds: float = INSTRUCTION_JOB_POLL_SECONDS):
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.engine: Optional[Engine] = None
+        self.generate: Optional[Callable[[str, str], Awaitable[str]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._running: Set[asyncio.Task] = set()
+        self.done = 0
+        self.discarded = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, engine: Engine, generate: Callable[[str, str], Awaitable[str]]):
+        self.engine = engine
+        self.generate = generate
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        # jobs that are cut short stay `running` and are picked up again after INSTRUCTION_JOB_TIMEOUT
+        for task in [self._task, *self._running]:
+            task.cancel()
+        await asyncio.gather(self._task, *self._running, return_exceptions=True)
+        self._task = None
+        self._wakeup = None
+
+    def notify(self):
+        """
+        Called after a write committed new jobs, from any thread (the routes
+        that write run on the threadpool). A no-op where the worker doesn't
+        run (e.g. CLI tools).
+        """
+        if self._wakeup is not None:
+            # asyncio.Event isn't thread-safe, so it's set on the worker's loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            free = self.concurrency - len(self._running)
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = await run_in_threadpool(claim_jobs, self.engine, free)
+                except Exception as e:
+                    print("Claiming instruction jobs failed:", repr(e))
+            for job in jobs:
+                task = asyncio.create_task(self._run_job(job))
+                self._running.add(task)
+                task.add_done_callback(self._job_finished)
+            if len(jobs) < free or free <= 0:
+                # nothing more is due (or no free slot): wait for a write, a finished job or the next poll
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    def _job_finished(self, task: asyncio.Task):
+        self._running.discard(task)
+        self.notify()
+
+    async def _run_job(self, job: Dict[str, Any]):
+        try:
+            if job["before_edit"] is None or job["deleted"]:
+                await run_in_threadpool(fail_job, self.engine, job, "data point was deleted", status=CANCELLED)
+                return
+            if content_hash(job["before_edit"], job["after_edit"]) != job["content_hash"]:
+                # changed without going through the write path (which would have replaced the job)
+                await run_in_threadpool(fail_job, self.engine, job, "data point has changed", status=CANCELLED)
+                return
+            instruction = await self.generate(job["before_edit"], job["after_edit"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Instruction job for data point {job['data_point_id']} failed (attempt {job['attempts']}):", repr(e))
+            status = await run_in_threadpool(fail_job, self.engine, job, f"{type(e).__name__}: {e}")
+            if status == FAILED:
+                self.failed += 1
+            else:
+                self.retried += 1
+            return
+        if await run_in_threadpool(finish_job, self.engine, job, instruction):
+            self.done += 1
+        else:
+            self.discarded += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "running": len(self._running),
+            "concurrency": self.concurrency,
+            "done": self.done,
+            "retried": self.retried,
+            "failed": self.failed,
+            "discarded": self.discarded,
+        }
+
+
+worker = InstructionJobWorker()
@@ -0,0 +1,104 @@
+"""
+In-process validation of config documents against the JSON schemas generated
+by `openapi2jsonschema.py`. This avoids spawning a `kubeconform` process (and
+re-serializing the document to YAML) for every document, while producing the
+same style of error messages as `kubeconform -strict`.
+"""
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import *
+
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import ValidationError, best_match
+from jsonschema.validators import validator_for
+
+# Names of the JSON types the way kubeconform (santhosh-tekuri/jsonschema) reports them
+JSON_TYPE_NAMES = [
+    (bool, "boolean"), (int, "integer"), (float, "number"), (str, "string"),
+    (list, "array"), (dict, "object"), (type(None), "null"),
+]
+
+
+@lru_cache(maxsize=1024)
+def _load_validator(schema_path: str, mtime_ns: int):
+    # `mtime_ns` is only part of the cache key, so that regenerated schemas get recompiled.
+    # Unknown properties are already disallowed by the schema itself, see
+    # `additional_properties` in openapi2jsonschema.py.
+    schema = json.loads(Path(schema_path).read_text())
+    cls = validator_for(schema, default=Draft7Validator)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def get_validator(schema_path: Path):
+    schema_path = Path(schema_path)
+    return _load_validator(str(schema_path), schema_path.stat().st_mtime_ns)
+
+
+def clear_validator_cache():
+    _load_validator.cache_clear()
+
+
+def _json_type_name(value: Any) -> str:
+    for typ, name in JSON_TYPE_NAMES:
+        if isinstance(value, typ):
+            return name
+    return type(value).__name__
+
+
+def _quote_all(values: Iterable[Any]) -> str:
+    return ", ".join(f"'{v}'" for v in values)
+
+
+def format_error_message(error: ValidationError) -> str:
+    # Mirror the wording of kubeconform's messages for the common cases, so that
+    # both backends show the same thing to the annotators.
+    if error.validator == "type":
+        expected = error.validator_value
+        if isinstance(expected, str):
+            expected = [expected]
+        return f"expected {' or '.join(expected)}, but got {_json_type_name(error.instance)}"
+    if error.validator == "required":
+        missing = [p for p in error.validator_value if p not in error.instance]
+        return f"missing properties: {_quote_all(missing)}"
+    if error.validator == "additionalProperties":
+        allowed = error.schema.get("properties", {})
+        extra = [p for p in error.instance if p not in allowed]
+        return f"additionalProperties {_quote_all(extra)} not allowed"
+    if error.validator == "enum":
+        return f"value must be one of {_quote_all(error.validator_value)}"
+    if error.validator == "pattern":
+        return f"does not match pattern '{error.validator_value}'"
+    if error.validator == "minimum":
+        return f"must be >= {error.validator_value} but found {error.instance}"
+    if error.validator == "maximum":
+        return f"must be <= {error.validator_value} but found {error.instance}"
+    return error.message
+
+
+def format_error(config_doc: Dict, schema_path: Path, error: ValidationError) -> str:
+    kind = config_doc.get("kind", "")
+    metadata = config_doc.get("metadata")
+    name = metadata.get("name", "") if isinstance(metadata, dict) else ""
+    instance_location = "".join(f"/{p}" for p in error.absolute_path)
+    keyword_location = "".join(f"/{p}" for p in error.absolute_schema_path)
+    return (
+        f"{kind} {name} is invalid: problem validating schema. Check JSON formatting: "
+        f"jsonschema: '{instance_location}' does not validate with "
+        f"{Path(schema_path).absolute().as_uri()}#{keyword_location}: {format_error_message(error)}\n"
+    )
+
+
+def to_json_types(config_doc: Dict) -> Dict:
+    # PyYAML loads unquoted dates and timestamps as `date`/`datetime`, which
+    # kubeconform sees as strings after its YAML to JSON conversion
+    return json.loads(json.dumps(config_doc, default=str))
+
+
+def validate_doc(config_doc: Dict, schema_path: Path) -> Optional[str]:
+    validator = get_validator(schema_path)
+    error = best_match(validator.iter_errors(to_json_types(config_doc)))
+    if error is None:
+        return None
+    return format_error(config_doc, schema_path, error)
@@ -0,0 +1,520 @@
+"""
+Async client for the completion models, used by the routes instead of running
+the blocking `Model.query` (Manifest) on a worker thread.
+
+All models share one pooled `httpx.AsyncClient`. Identical queries (same model,
+prompt and sampling parameters) that are in flight at the same time share a
+single upstream request. Every upstream request has its own deadline
+(`LLM_REQUEST_TIMEOUT`), which all of its waiters see, and keeps running if one
+of the waiters goes away.
+
+Upstream requests draw from token buckets for requests and tokens per minute
+(`LLM_REQUESTS_PER_MINUTE`, `LLM_TOKENS_PER_MINUTE`), shared by all models,
+and failed requests are retried with exponential backoff and jitter.
+Optionally (`LLM_BATCH_WINDOW_MS` > 0), distinct prompts with the same
+sampling parameters that arrive within the window go upstream as one request.
+
+`AsyncModel.stream` forwards the completion as it is generated (server-sent
+events from the API), cut at the stop sequences.
+
+Completions are cached in `kurator.llm_cache.get_llm_cache()` (see there for the
+backends and limits).
+
+The API base url is configurable (`OPENAI_API_BASE`), e.g. to run against
+`benchmarks/llm_stub_server.py` instead of OpenAI.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import time
+from typing import *
+
+import httpx
+from starlette.config import Config
+
+from kurator.llm_cache import LLMCache, get_llm_cache
+
+config = Config()
+
+OPENAI_API_BASE = config('OPENAI_API_BASE', default="https://api.openai.com/v1")
+LLM_REQUEST_TIMEOUT = config('LLM_REQUEST_TIMEOUT', cast=float, default=60)
+LLM_MAX_CONNECTIONS = config('LLM_MAX_CONNECTIONS', cast=int, default=20)
+LLM_MAX_TRIES = config('LLM_MAX_TRIES', cast=int, default=5)
+LLM_BACKOFF_BASE = config('LLM_BACKOFF_BASE', cast=float, default=1)
+LLM_BACKOFF_MAX = config('LLM_BACKOFF_MAX', cast=float, default=30)
+LLM_TOKENS_PER_MINUTE = config('LLM_TOKENS_PER_MINUTE', cast=int, default=150000)
+LLM_REQUESTS_PER_MINUTE = config('LLM_REQUESTS_PER_MINUTE', cast=int, default=3000)
+LLM_BATCH_WINDOW_MS = config('LLM_BATCH_WINDOW_MS', cast=float, default=0)
+LLM_MAX_BATCH_SIZE = config('LLM_MAX_BATCH_SIZE', cast=int, default=8)
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMTimeout(LLMError):
+    pass
+
+
+###### HTTP client ######
+
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """The connection pool shared by all models. Pooled connections belong to the event loop that opened them."""
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            base_url=OPENAI_API_BASE,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=10),
+        )
+        _http_client_loop = loop
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+###### Rate limiting ######
+
+def backoff_delay(attempt: int, base: float = LLM_BACKOFF_BASE, cap: float = LLM_BACKOFF_MAX) -> float:
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(response: httpx.Response) -> float:
+    """The `Retry-After` of a 429/5xx response in seconds, 0 if there is none (or it's a date)."""
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English and YAML
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute. Callers wait
+    in FIFO order until both buckets can cover their request. The token count
+    is an estimate upfront and is corrected with the usage the API reports.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+        self.queued = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int) -> int:
+        """Waits until `tokens` (capped at the bucket size) can be spent, spends them and returns the amount."""
+        tokens = min(tokens, self.tokens_per_minute)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self.queued += 1
+        try:
+            async with self._lock:
+                start = time.monotonic()
+                self._refill()
+                while self._requests < 1 or self._tokens < tokens:
+                    await asyncio.sleep(max(
+                        (1 - self._requests) * 60 / self.requests_per_minute,
+                        (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                    ))
+                    self._refill()
+                if time.monotonic() > start + 0.001:
+                    self.throttled += 1
+                    self.throttled_seconds += time.monotonic() - start
+                self._requests -= 1
+                self._tokens -= tokens
+                return tokens
+        finally:
+            self.queued -= 1
+
+    def settle(self, estimated: int, actual: int):
+        """Gives back (or takes) the difference between the estimated and the reported token usage."""
+        self._refill()
+        self._tokens = min(self.tokens_per_minute, self._tokens + estimated - actual)
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "available_requests": int(self._requests),
+            "available_tokens": int(self._tokens),
+            "queued": self.queued,
+            "throttled": self.throttled,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
+
+
+# One API key, so one budget for all models
+rate_limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
+
+class MicroBatcher:
+    """
+    Collects prompts with the same sampling parameters for up to `window`
+    seconds (or `max_size` prompts) and sends them upstream as one request.
+    """
+    def __init__(self, send: Callable[[List[str], Dict[str, Any]], Awaitable[List[List[str]]]],
+                 window: float, max_size: int):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._open: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self.batches = 0
+        self.batched_prompts = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(batch) for batch in self._open.values())
+
+    async def submit(self, prompt: str, params: Dict[str, Any]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        key = json.dumps(params, sort_keys=True)
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = []
+            loop.call_later(self.window, self._flush, key, batch, params)
+        future = loop.create_future()
+        batch.append((prompt, future))
+        if len(batch) >= self.max_size:
+            self._flush(key, batch, params)
+        return await future
+
+    def _flush(self, key: str, batch: List[Tuple[str, asyncio.Future]], params: Dict[str, Any]):
+        if self._open.get(key) is not batch:
+            return  # already sent because it was full
+        del self._open[key]
+        self.batches += 1
+        self.batched_prompts += len(batch)
+        asyncio.ensure_future(self._send(batch, params))
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]], params: Dict[str, Any]):
+        try:
+            results = await self.send([prompt for prompt, _ in batch], params)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class StopSequenceFilter:
+    """
+    Cuts streamed text at the first stop sequence. Text that may be the start
+    of a stop sequence is held back until the next chunk decides.
+    """
+    def __init__(self, stop: List[str]):
+        self.stop = [s for s in stop if s]
+        self.buffer = ""
+        self.stopped = False
+
+    def feed(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        self.buffer += text
+        found = [self.buffer.index(s) for s in self.stop if s in self.buffer]
+        if found:
+            out, self.buffer, self.stopped = self.buffer[:min(found)], "", True
+            return out
+        hold = max([k for s in self.stop for k in range(1, len(s)) if self.buffer.endswith(s[:k])], default=0)
+        out = self.buffer[:len(self.buffer) - hold]
+        self.buffer = self.buffer[len(out):]
+        return out
+
+    def flush(self) -> str:
+        out, self.buffer = self.buffer, ""
+        return out
+
+
+###### Models ######
+
+models: List["AsyncModel"] = []
+
+
+class AsyncModel:
+    """
+    Same sampling parameters and defaults as `kurator.utils.Model`; `query`
+    returns the `n` completions of the prompt. Cache entries are tagged with
+    `namespace` (the model name by default).
+    """
+    def __init__(
+        self,
+        model_name: str,
+        n: int = 1,
+        temperature: float = 0.3,
+        top_p: float = 1,
+        max_tokens: int = 250,
+        stop: Union[str, List[str]] = ["```"],
+        timeout: float = LLM_REQUEST_TIMEOUT,
+        max_tries: int = LLM_MAX_TRIES,
+        batch_window_ms: float = LLM_BATCH_WINDOW_MS,
+        max_batch_size: int = LLM_MAX_BATCH_SIZE,
+        use_cache: bool = True,
+        namespace: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.n = n
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.stop = [stop] if isinstance(stop, str) else list(stop)
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.batcher = MicroBatcher(self._request, batch_window_ms / 1000, max_batch_size) if batch_window_ms > 0 else None
+        self.use_cache = use_cache
+        self.namespace = namespace or model_name
+
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.queries = 0
+        self.upstream_requests = 0
+        self.upstream_seconds = 0.0
+        self.completions = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = 0
+        models.append(self)
+
+    @property
+    def cache(self) -> Optional[LLMCache]:
+        return get_llm_cache() if self.use_cache else None
+
+    def params(self, **kwargs) -> Dict[str, Any]:
+        params = dict(
+            model=self.model_name, n=self.n, temperature=self.temperature,
+            top_p=self.top_p, max_tokens=self.max_tokens, stop=self.stop,
+        )
+        unknown = set(kwargs) - set(params)
+        assert not unknown, f"unknown parameters: {unknown}"
+        params.update(kwargs)
+        if isinstance(params["stop"], str):
+            params["stop"] = [params["stop"]]
+        return params
+
+    @staticmethod
+    def make_key(prompt: str, params: Dict[str, Any]) -> str:
+        data = json.dumps({"prompt": prompt, **params}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    async def query(self, prompt: str, **kwargs) -> List[str]:
+        params = self.params(**kwargs)
+        key = self.make_key(prompt, params)
+        self.queries += 1
+
+        if self.cache is not None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return list(cached)
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.wait_for(self._fetch(key, prompt, params), self.timeout))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.coalesced += 1
+
+        try:
+            # shielded, so that a waiter that is cancelled (e.g. the client went away)
+            # doesn't cancel the request for the others
+            return list(await asyncio.shield(task))
+        except asyncio.TimeoutError:
+            raise LLMTimeout(f"{self.model_name} did not answer within {self.timeout}s")
+
+    async def stream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """
+        Yields the (single) completion of the prompt in chunks as they arrive.
+        Goes through the cache and the rate limiter like `query`, but isn't
+        coalesced. Failures before the first chunk are retried.
+        """
+        params = self.params(**kwargs)
+        assert params["n"] == 1, "only a single completion can be streamed"
+        key = self.make_key(prompt, params)
+        self.queries += 1
+
+        if self.cache is not None:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                yield cached[0]
+                return
+
+        client = get_http_client()
+        api_key = config('OPENAI_API_KEY', default=None)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        estimated = estimate_tokens(prompt) + params["max_tokens"]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + self.timeout
+
+        pieces: List[str] = []
+        last_error = None
+        retry_after = 0.0
+        for attempt in range(self.max_tries):
+            if attempt > 0:
+                self.retries += 1
+                await asyncio.sleep(max(retry_after, backoff_delay(attempt - 1)))
+                retry_after = 0.0
+            await rate_limiter.acquire(estimated)
+            self.upstream_requests += 1
+            stop_filter = StopSequenceFilter(params["stop"])
+            try:
+                async with client.stream("POST", "/completions", json={"prompt": prompt, **params, "stream": True},
+                                         headers=headers) as response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        last_error = f"{response.status_code} {(await response.aread())[:200]!r}"
+                        retry_after = retry_after_seconds(response)
+                        continue
+                    if response.status_code != 200:
+                        raise LLMError(f"{self.model_name} request failed: {response.status_code} "
+                                       f"{(await response.aread())[:200]!r}")
+                    async for line in response.aiter_lines():
+                        if loop.time() > deadline:
+                            self.timeouts += 1
+                            raise LLMTimeout(f"{self.model_name} did not finish within {self.timeout}s")
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        text = stop_filter.feed(json.loads(data)["choices"][0]["text"])
+                        if text:
+                            pieces.append(text)
+                            yield text
+                        if stop_filter.stopped:
+                            break
+            except httpx.TransportError as e:
+                if pieces:
+                    # can't be retried once the caller has seen part of the completion
+                    self.errors += 1
+                    raise LLMError(f"{self.model_name} stream broke off: {e!r}")
+                last_error = repr(e)
+                continue
+
+            text = stop_filter.flush()
+            if text:
+                pieces.append(text)
+                yield text
+            self.completions += 1
+            self.upstream_seconds += loop.time() - start
+            if self.cache is not None:
+                await self.cache.put(key, self.namespace, prompt, ["".join(pieces)])
+            return
+        self.errors += 1
+        raise LLMError(f"{self.model_name} request failed after {self.max_tries} tries: {last_error}")
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if task.cancelled():
+            return
+        error = task.exception()
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        elif error is not None:
+            self.errors += 1
+
+    async def _fetch(self, key: str, prompt: str, params: Dict[str, Any]) -> List[str]:
+        start = time.perf_counter()
+        result = await self._complete(prompt, params)
+        self.completions += 1
+        self.upstream_seconds += time.perf_counter() - start
+        if self.cache is not None:
+            await self.cache.put(key, self.namespace, prompt, result)
+        return result
+
+    async def _complete(self, prompt: str, params: Dict[str, Any]) -> List[str]:
+        if self.batcher is not None:
+            return await self.batcher.submit(prompt, params)
+        return (await self._request([prompt], params))[0]
+
+    async def _request(self, prompts: List[str], params: Dict[str, Any]) -> List[List[str]]:
+        """One upstream request for all `prompts`, returns the `n` completions of each."""
+        client = get_http_client()
+        api_key = config('OPENAI_API_KEY', default=None)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        payload = {"prompt": prompts[0] if len(prompts) == 1 else prompts, **params}
+        estimated = sum(estimate_tokens(p) for p in prompts) + len(prompts) * params["n"] * params["max_tokens"]
+
+        last_error = None
+        retry_after = 0.0
+        for attempt in range(self.max_tries):
+            if attempt > 0:
+                self.retries += 1
+                await asyncio.sleep(max(retry_after, backoff_delay(attempt - 1)))
+                retry_after = 0.0
+            spent = await rate_limiter.acquire(estimated)
+            self.upstream_requests += 1
+            try:
+                response = await client.post("/completions", json=payload, headers=headers)
+            except httpx.TransportError as e:
+                last_error = repr(e)
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                last_error = f"{response.status_code} {response.text[:200]}"
+                retry_after = retry_after_seconds(response)
+                continue
+            if response.status_code != 200:
+                raise LLMError(f"{self.model_name} request failed: {response.status_code} {response.text[:200]}")
+            body = response.json()
+            if "total_tokens" in body.get("usage", {}):
+                rate_limiter.settle(spent, body["usage"]["total_tokens"])
+            # the choices of prompt i have the indices [i * n, (i + 1) * n)
+            choices = sorted(body["choices"], key=lambda c: c.get("index", 0))
+            texts = [choice["text"] for choice in choices]
+            n = params["n"]
+            return [texts[i * n: (i + 1) * n] for i in range(len(prompts))]
+        raise LLMError(f"{self.model_name} request failed after {self.max_tries} tries: {last_error}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "namespace": self.namespace,
+            "stop": self.stop,
+            "queries": self.queries,
+            "upstream_requests": self.upstream_requests,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+            "queued_for_batch": self.batcher.pending if self.batcher else 0,
+            "batches": self.batcher.batches if self.batcher else 0,
+            "batched_prompts": self.batcher.batched_prompts if self.batcher else 0,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "avg_completion_ms": self.upstream_seconds / self.completions * 1000 if self.completions else 0.0,
+        }
+
+
+async def llm_stats() -> Dict[str, Any]:
+    return {
+        "rate_limiter": rate_limiter.stats(),
+        "cache": await get_llm_cache().stats(),
+        "models": [model.stats() for model in models],
+    }
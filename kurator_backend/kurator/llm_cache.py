@@ -0,0 +1,374 @@
+"""
+Response cache for the LLM client (`kurator/llm.py`), replacing Manifest's
+unbounded `manifest_cache.db`.
+
+Entries are keyed on the prompt, the model and all sampling parameters (see
+`AsyncModel.make_key`), and remember the model they belong to (`namespace`),
+so that they can be inspected and purged per model. Every backend is bounded
+by `LLM_CACHE_MAX_ENTRIES` (least recently used entries are evicted first) and
+`LLM_CACHE_TTL` seconds. The SQLite backend enforces the limit every
+`LLM_CACHE_PRUNE_EVERY` writes rather than on each one, so it can be over by
+that many entries per worker in between.
+
+Backends (`LLM_CACHE`):
+    memory  an LRU per worker process
+    sqlite  a file in WAL mode shared by all workers (default, `LLM_CACHE_PATH`)
+    redis   any Redis-protocol server at `LLM_CACHE_REDIS_URL`; needs `pip install redis`
+    none    no caching
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import *
+
+from starlette.concurrency import run_in_threadpool
+from starlette.config import Config
+
+config = Config()
+
+ROOT_PATH = Path(__file__).parent.parent
+LLM_CACHE_BACKENDS = ["memory", "sqlite", "redis", "none"]
+
+PROMPT_PREVIEW_LENGTH = 200
+
+
+def make_entry(key: str, namespace: str, prompt: str, value: List[str], ttl: float) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "key": key,
+        "namespace": namespace,
+        "prompt": prompt[:PROMPT_PREVIEW_LENGTH],
+        "value": value,
+        "created_at": now,
+        "expires_at": now + ttl if ttl > 0 else None,
+        "last_access": now,
+        "hits": 0,
+    }
+
+
+def is_expired(entry: Dict[str, Any]) -> bool:
+    return entry["expires_at"] is not None and entry["expires_at"] <= time.time()
+
+
+class LLMCache:
+    """Interface of the backends. Async, so that network backends don't block the event loop."""
+    backend = "none"
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lookup_seconds = 0.0
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        start = time.perf_counter()
+        entry = await self._get(key)
+        self.lookup_seconds += time.perf_counter() - start
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["value"]
+
+    async def put(self, key: str, namespace: str, prompt: str, value: List[str]):
+        await self._put(make_entry(key, namespace, prompt, value, self.ttl))
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    async def _put(self, entry: Dict[str, Any]):
+        pass
+
+    async def entries(self, namespace: Optional[str] = None, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """Most recently used first."""
+        return []
+
+    async def count(self) -> int:
+        return 0
+
+    async def purge(self, key: Optional[str] = None, namespace: Optional[str] = None) -> int:
+        """Deletes one entry, all entries of a namespace or (with neither) everything. Returns how many."""
+        return 0
+
+    async def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "entries": await self.count(),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "avg_lookup_ms": self.lookup_seconds / lookups * 1000 if lookups else 0.0,
+        }
+
+
+class MemoryLLMCache(LLMCache):
+    backend = "memory"
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 0):
+        super().__init__(max_entries, ttl)
+        self._entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if is_expired(entry):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        entry["last_access"] = time.time()
+        entry["hits"] += 1
+        return entry
+
+    async def _put(self, entry: Dict[str, Any]):
+        self._entries[entry["key"]] = entry
+        self._entries.move_to_end(entry["key"])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def entries(self, namespace: Optional[str] = None, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        matching = [e for e in reversed(self._entries.values())
+                    if (namespace is None or e["namespace"] == namespace) and not is_expired(e)]
+        return matching[offset: offset + limit]
+
+    async def count(self) -> int:
+        return len(self._entries)
+
+    async def purge(self, key: Optional[str] = None, namespace: Optional[str] = None) -> int:
+        keys = [k for k, e in self._entries.items()
+                if (key is None or k == key) and (namespace is None or e["namespace"] == namespace)]
+        for k in keys:
+            del self._entries[k]
+        return len(keys)
+
+
+class SQLiteLLMCache(LLMCache):
+    """
+    Shared by all workers through the file. The statements run on the
+    threadpool, so that a slow disk or a lock held by another worker doesn't
+    block the event loop.
+    """
+    backend = "sqlite"
+
+    COLUMNS = ["key", "namespace", "prompt", "value", "created_at", "expires_at", "last_access", "hits"]
+
+    def __init__(self, path: Path, max_entries: int = 10000, ttl: float = 0, prune_every: int = 100):
+        super().__init__(max_entries, ttl)
+        self.path = path
+        self.prune_every = max(1, prune_every)
+        self._writes_since_prune = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, namespace TEXT, prompt TEXT, value TEXT, "
+            "created_at REAL, expires_at REAL, last_access REAL, hits INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_namespace ON entries (namespace, last_access)")
+
+    def _row_to_entry(self, row) -> Dict[str, Any]:
+        entry = dict(zip(self.COLUMNS, row))
+        entry["value"] = json.loads(entry["value"])
+        return entry
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await run_in_threadpool(self._get_sync, key)
+
+    def _get_sync(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = self._row_to_entry(row)
+            if is_expired(entry):
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            return entry
+
+    async def _put(self, entry: Dict[str, Any]):
+        await run_in_threadpool(self._put_sync, entry)
+
+    def _put_sync(self, entry: Dict[str, Any]):
+        with self._lock:
+            values = dict(entry, value=json.dumps(entry["value"]))
+            self._db.execute(
+                f"REPLACE INTO entries ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [values[c] for c in self.COLUMNS])
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= self.prune_every:
+                self._writes_since_prune = 0
+                self._prune()
+
+    def _prune(self):
+        # counting is a full scan of the index, so it only runs every `prune_every` writes
+        self._db.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        excess = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_access LIMIT ?)", (excess,))
+            self.evictions += excess
+
+    async def entries(self, namespace: Optional[str] = None, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        return await run_in_threadpool(self._entries_sync, namespace, offset, limit)
+
+    def _entries_sync(self, namespace: Optional[str], offset: int, limit: int) -> List[Dict[str, Any]]:
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM entries WHERE (expires_at IS NULL OR expires_at > ?)"
+        params: List[Any] = [time.time()]
+        if namespace is not None:
+            query += " AND namespace = ?"
+            params.append(namespace)
+        query += " ORDER BY last_access DESC LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self._lock:
+            return [self._row_to_entry(row) for row in self._db.execute(query, params)]
+
+    async def count(self) -> int:
+        return await run_in_threadpool(self._count_sync)
+
+    def _count_sync(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    async def purge(self, key: Optional[str] = None, namespace: Optional[str] = None) -> int:
+        return await run_in_threadpool(self._purge_sync, key, namespace)
+
+    def _purge_sync(self, key: Optional[str], namespace: Optional[str]) -> int:
+        query, params = "DELETE FROM entries WHERE 1 = 1", []
+        if key is not None:
+            query += " AND key = ?"
+            params.append(key)
+        if namespace is not None:
+            query += " AND namespace = ?"
+            params.append(namespace)
+        with self._lock:
+            return self._db.execute(query, params).rowcount
+
+
+class RedisLLMCache(LLMCache):
+    """
+    Entries are hashes with a Redis TTL. A sorted set of keys by last access
+    keeps the number of entries at `max_entries`.
+    """
+    backend = "redis"
+
+    def __init__(self, url: str, max_entries: int = 10000, ttl: float = 0, prefix: str = "kurator:llm:"):
+        super().__init__(max_entries, ttl)
+        # Optional dependency, only needed for this backend
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.lru_key = prefix + "lru"
+
+    def _key(self, key: str) -> str:
+        return self.prefix + "entry:" + key
+
+    @staticmethod
+    def _decode(data: Dict[str, str]) -> Dict[str, Any]:
+        return {
+            "key": data["key"],
+            "namespace": data["namespace"],
+            "prompt": data["prompt"],
+            "value": json.loads(data["value"]),
+            "created_at": float(data["created_at"]),
+            "expires_at": float(data["expires_at"]) if data["expires_at"] else None,
+            "last_access": float(data["last_access"]),
+            "hits": int(data["hits"]),
+        }
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        data = await self.redis.hgetall(self._key(key))
+        if not data:
+            await self.redis.zrem(self.lru_key, key)
+            return None
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hincrby(self._key(key), "hits", 1)
+            pipe.hset(self._key(key), "last_access", now)
+            pipe.zadd(self.lru_key, {key: now})
+            await pipe.execute()
+        return self._decode(data)
+
+    async def _put(self, entry: Dict[str, Any]):
+        key = entry["key"]
+        mapping = dict(entry, value=json.dumps(entry["value"]), expires_at=entry["expires_at"] or "")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self._key(key), mapping=mapping)
+            if self.ttl > 0:
+                pipe.expire(self._key(key), int(self.ttl))
+            pipe.zadd(self.lru_key, {key: entry["last_access"]})
+            pipe.zcard(self.lru_key)
+            size = (await pipe.execute())[-1]
+        if size > self.max_entries:
+            evicted = await self.redis.zpopmin(self.lru_key, size - self.max_entries)
+            if evicted:
+                await self.redis.delete(*[self._key(k) for k, _ in evicted])
+                self.evictions += len(evicted)
+
+    async def entries(self, namespace: Optional[str] = None, offset: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        # Walks the LRU index from the most recent entry; fine for the admin page
+        result, skipped, start = [], 0, 0
+        while len(result) < limit:
+            keys = await self.redis.zrevrange(self.lru_key, start, start + 99)
+            if not keys:
+                break
+            start += len(keys)
+            for key in keys:
+                data = await self.redis.hgetall(self._key(key))
+                if not data or (namespace is not None and data["namespace"] != namespace):
+                    continue
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                result.append(self._decode(data))
+                if len(result) >= limit:
+                    break
+        return result
+
+    async def count(self) -> int:
+        return await self.redis.zcard(self.lru_key)
+
+    async def purge(self, key: Optional[str] = None, namespace: Optional[str] = None) -> int:
+        keys = [key] if key is not None else await self.redis.zrange(self.lru_key, 0, -1)
+        if namespace is not None:
+            keys = [k for k in keys if await self.redis.hget(self._key(k), "namespace") == namespace]
+        if not keys:
+            return 0
+        await self.redis.zrem(self.lru_key, *keys)
+        return await self.redis.delete(*[self._key(k) for k in keys])
+
+
+def create_llm_cache(backend: str) -> LLMCache:
+    assert backend in LLM_CACHE_BACKENDS, f"LLM_CACHE must be one of {LLM_CACHE_BACKENDS}"
+    max_entries = config('LLM_CACHE_MAX_ENTRIES', cast=int, default=10000)
+    # a week; 0 keeps entries until they are evicted
+    ttl = config('LLM_CACHE_TTL', cast=float, default=7 * 24 * 3600)
+    if backend == "memory":
+        return MemoryLLMCache(max_entries, ttl)
+    if backend == "sqlite":
+        path = config('LLM_CACHE_PATH', cast=Path, default=ROOT_PATH / "llm_cache.db")
+        return SQLiteLLMCache(path, max_entries, ttl, config('LLM_CACHE_PRUNE_EVERY', cast=int, default=100))
+    if backend == "redis":
+        return RedisLLMCache(config('LLM_CACHE_REDIS_URL', default="redis://localhost:6379/0"), max_entries, ttl)
+    return LLMCache(max_entries, ttl)
+
+
+@lru_cache(maxsize=None)
+def get_llm_cache() -> LLMCache:
+    # Created (and the SQLite file opened) on first use, not at import
+    return create_llm_cache(config('LLM_CACHE', default="sqlite"))
@@ -0,0 +1,224 @@
+"""
+Versioned schema migrations for the kurator database.
+
+Migrations are the `NNNN_description.sql` files in `kurator/migrations`. They
+are applied in order of their version number and every applied version is
+recorded in the `schema_migrations` table. `db/00_schema.sql` is the baseline
+that the migrations build upon.
+
+MySQL commits DDL statements implicitly, so a migration cannot be rolled back
+half-way. Keep migrations to a single DDL statement where possible.
+
+Usage:
+    python -m kurator.migrate              # apply pending migrations
+    python -m kurator.migrate --status     # list applied/pending migrations
+    python -m kurator.migrate --explain    # check the hot queries use the indexes
+"""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from typing import *
+
+from sqlalchemy import text
+from sqlalchemy.engine.base import Engine
+
+from kurator.database import get_engine
+
+MIGRATIONS_PATH = Path(__file__).parent / "migrations"
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+# Named lock so that multiple workers starting at once don't race each other
+MIGRATION_LOCK_NAME = "kurator_schema_migrations"
+MIGRATION_LOCK_TIMEOUT = 60
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: Path
+
+    def statements(self) -> List[str]:
+        sql = "\n".join(
+            line for line in self.path.read_text().splitlines()
+            if not line.strip().startswith("--")
+        )
+        return [stmt.strip() for stmt in sql.split(";") if stmt.strip()]
+
+
+def list_migrations() -> List[Migration]:
+    migrations = []
+    for path in MIGRATIONS_PATH.glob("*.sql"):
+        m = MIGRATION_FILE_RE.match(path.name)
+        assert m, f"Invalid migration file name: {path.name}"
+        migrations.append(Migration(int(m.group(1)), m.group(2), path))
+    migrations.sort()
+    versions = [m.version for m in migrations]
+    assert len(versions) == len(set(versions)), f"Duplicate migration versions: {versions}"
+    return migrations
+
+
+def ensure_migrations_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def get_applied_versions(conn) -> Set[int]:
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def apply_migrations(engine: Engine, verbose: bool = True) -> List[Migration]:
+    applied = []
+    # DDL is committed implicitly by MySQL anyway, autocommit makes sure the
+    # `schema_migrations` bookkeeping is committed right along with it.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        got_lock = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"), {
+            "name": MIGRATION_LOCK_NAME, "timeout": MIGRATION_LOCK_TIMEOUT}).scalar()
+        if got_lock != 1:
+            raise RuntimeError("Timed out waiting for the schema migration lock")
+        try:
+            ensure_migrations_table(conn)
+            applied_versions = get_applied_versions(conn)
+            for migration in list_migrations():
+                if migration.version in applied_versions:
+                    continue
+                if verbose:
+                    print(f"Applying migration {migration.version:04d}_{migration.name}")
+                for stmt in migration.statements():
+                    conn.execute(text(stmt))
+                conn.execute(text(
+                    "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                    {"version": migration.version, "name": migration.name})
+                applied.append(migration)
+        finally:
+            conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": MIGRATION_LOCK_NAME})
+    return applied
+
+
+def apply_migrations_with_retry(engine: Engine, retries: int = 10, delay: float = 3.0) -> List[Migration]:
+    # The backend and mysql containers start together, so mysql may not be
+    # accepting connections yet when the backend boots.
+    for attempt in range(retries):
+        try:
+            return apply_migrations(engine)
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            print(f"Could not apply migrations ({e}), retrying in {delay}s")
+            time.sleep(delay)
+    return []
+
+
+def migration_status(engine: Engine) -> List[Tuple[Migration, bool]]:
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        ensure_migrations_table(conn)
+        applied_versions = get_applied_versions(conn)
+    return [(m, m.version in applied_versions) for m in list_migrations()]
+
+
+###### Query plan checks ######
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+    params: Dict[str, Any]
+    # any of these indexes is acceptable
+    expected_keys: Set[str]
+
+
+HOT_QUERIES = [
+    HotQuery(
+        "data points of a user",
+        "SELECT id, username, human_change_instruction, updated_at FROM edit_data_points "
+        "WHERE deleted = False AND username = :username AND id > :after_id ORDER BY id LIMIT 100",
+        {"username": "test@test.com", "after_id": 0},
+        {"idx_edit_data_points_deleted_username_id"},
+    ),
+    HotQuery(
+        "data points page",
+        "SELECT id, username, human_change_instruction, updated_at FROM edit_data_points "
+        "WHERE deleted = False AND id > :after_id ORDER BY id LIMIT 100",
+        {"after_id": 0},
+        {"PRIMARY", "idx_edit_data_points_deleted_username_id"},
+    ),
+    HotQuery(
+        "recently updated data points",
+        "SELECT id FROM edit_data_points WHERE deleted = False AND updated_at > :since ORDER BY updated_at",
+        {"since": "1970-01-02 00:00:00"},
+        {"idx_edit_data_points_deleted_updated_at"},
+    ),
+    HotQuery(
+        "data point by id",
+        "SELECT * FROM edit_data_points WHERE id = :id",
+        {"id": 1},
+        {"PRIMARY"},
+    ),
+    HotQuery(
+        "data points by instruction text",
+        "SELECT id FROM edit_data_points WHERE MATCH (human_change_instruction, note) "
+        "AGAINST (:q IN NATURAL LANGUAGE MODE)",
+        {"q": "replicas"},
+        {"ft_edit_data_points_instruction_note"},
+    ),
+    HotQuery(
+        "data points of a kind",
+        "SELECT data_point_id FROM data_point_resources WHERE kind = :kind ORDER BY data_point_id DESC LIMIT 100",
+        {"kind": "Deployment"},
+        {"idx_data_point_resources_kind"},
+    ),
+]
+
+
+def explain_hot_queries(engine: Engine) -> List[Dict[str, Any]]:
+    """
+    Runs EXPLAIN on the hot queries and reports which index each one uses.
+    Note that on a (nearly) empty table the optimizer may legitimately prefer a
+    full scan, so run this against a realistically sized database.
+    """
+    report = []
+    with engine.connect() as conn:
+        for query in HOT_QUERIES:
+            plan = conn.execute(text("EXPLAIN " + query.sql), query.params).fetchall()
+            # the first row is the access to the table the query is on
+            row = dict(plan[0]._mapping)
+            report.append({
+                "query": query.name,
+                "key": row.get("key"),
+                "type": row.get("type"),
+                "rows": row.get("rows"),
+                "extra": row.get("Extra"),
+                "ok": row.get("key") in query.expected_keys and row.get("type") != "ALL",
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kurator schema migrations")
+    parser.add_argument("--status", action="store_true", help="list applied and pending migrations")
+    parser.add_argument("--explain", action="store_true", help="check the query plans of the hot queries")
+    args = parser.parse_args()
+
+    engine = get_engine()
+
+    if args.status:
+        for migration, is_applied in migration_status(engine):
+            print(f"[{'x' if is_applied else ' '}] {migration.version:04d}_{migration.name}")
+        return
+
+    if args.explain:
+        report = explain_hot_queries(engine)
+        for r in report:
+            print(f"{'OK  ' if r['ok'] else 'FAIL'} {r['query']}: key={r['key']} type={r['type']} rows={r['rows']} extra={r['extra']}")
+        sys.exit(0 if all(r["ok"] for r in report) else 1)
+
+    applied = apply_migrations(engine)
+    print(f"Applied {len(applied)} migration(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+-- Every query on edit_data_points filters on `deleted`, most of them also on
+-- `username`, and results are paginated by `id`.
+CREATE INDEX idx_edit_data_points_deleted_username_id ON edit_data_points (deleted, username, id);
@@ -0,0 +1,2 @@
+-- "Recently updated" queries.
+CREATE INDEX idx_edit_data_points_deleted_updated_at ON edit_data_points (deleted, updated_at);
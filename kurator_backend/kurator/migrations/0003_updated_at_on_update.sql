@@ -0,0 +1,3 @@
+-- Let MySQL keep `updated_at` current instead of relying on the write path.
+ALTER TABLE edit_data_points
+    MODIFY updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
@@ -0,0 +1,11 @@
+-- Results of the offline re-validation job (`python -m kurator.revalidate`),
+-- one row per data point. `*_errors` are JSON lists of {doc_index, error}.
+CREATE TABLE IF NOT EXISTS validation_results (
+    data_point_id INTEGER PRIMARY KEY NOT NULL,
+    valid BOOLEAN NOT NULL,
+    before_errors TEXT NOT NULL,
+    after_errors TEXT NOT NULL,
+    schema_build_id VARCHAR(64) NULL,
+    validated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_validation_results_valid (valid)
+);
@@ -0,0 +1,6 @@
+-- Progress of resumable offline jobs: the last data point id that was processed.
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    job_name VARCHAR(255) PRIMARY KEY NOT NULL,
+    last_id INTEGER NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
@@ -0,0 +1,2 @@
+-- Change feed (`/api/changes`) walks all rows, deleted or not, in (updated_at, id) order.
+CREATE INDEX idx_edit_data_points_updated_at_id ON edit_data_points (updated_at, id);
@@ -0,0 +1,17 @@
+-- Background generation of `gpt3_change_instruction` (kurator/instruction_jobs.py),
+-- one job per data point. `content_hash` is the hash of the (before_edit, after_edit)
+-- pair the job is for; done jobs keep their `instruction` so that data points with
+-- the same content reuse it. Times are set by the app, not the database.
+CREATE TABLE IF NOT EXISTS instruction_jobs (
+    data_point_id INTEGER PRIMARY KEY NOT NULL,
+    content_hash CHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    instruction TEXT NULL,
+    error TEXT NULL,
+    run_after DATETIME NOT NULL,
+    claimed_at DATETIME NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_instruction_jobs_status_run_after (status, run_after),
+    INDEX idx_instruction_jobs_content_hash_status (content_hash, status)
+);
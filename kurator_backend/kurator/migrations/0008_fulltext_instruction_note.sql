@@ -0,0 +1,3 @@
+-- Full-text search over the instruction and the note of data points
+-- (`/api/search_data_points`). MATCH() has to name exactly these columns.
+ALTER TABLE edit_data_points ADD FULLTEXT INDEX ft_edit_data_points_instruction_note (human_change_instruction, note);
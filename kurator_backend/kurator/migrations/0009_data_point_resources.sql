@@ -0,0 +1,13 @@
+-- The `apiVersion`/`kind` of every document in `before_edit` and `after_edit`,
+-- one row per distinct pair and data point, for searching by resource type.
+-- Written with the data point (kurator/search.py); rows that existed before
+-- this table are filled by `python -m kurator.search`. An empty string means
+-- the document has no such field.
+CREATE TABLE IF NOT EXISTS data_point_resources (
+    data_point_id INTEGER NOT NULL,
+    api_version VARCHAR(255) NOT NULL,
+    kind VARCHAR(255) NOT NULL,
+    PRIMARY KEY (data_point_id, api_version, kind),
+    INDEX idx_data_point_resources_kind (kind, api_version, data_point_id),
+    INDEX idx_data_point_resources_api_version (api_version, data_point_id)
+);
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 # Derived from https://github.com/instrumenta/openapi2jsonschema
+import copy
 import yaml
 import json
 import sys
@@ -91,18 +92,69 @@ def append_no_duplicates(obj, key, value):
         obj[key].append(value)
 
 
-def write_schema_file(schema, filename):
-    schemaJSON = ""
+def test_transform_schema():
+    schema = {
+        "type": "object",
+        "properties": {
+            "port": {"format": "int-or-string"},
+            "spec": {
+                "type": "object",
+                "required": ["ports"],
+                "properties": {
+                    "ports": {"type": "array", "items": {"properties": {"port": {"format": "int-or-string"}}}},
+                    "anyOf": [{"properties": {"x": {"type": "string", "format": "int-or-string"}}}],
+                },
+            },
+        },
+    }
+    for deny_root in [False, True]:
+        expect = replace_int_or_string(additional_properties(copy.deepcopy(schema), skip=not deny_root))
+        assert transform_schema(schema, deny_root_additional_properties=deny_root) == expect
+        assert json.dumps(transform_schema(schema, deny_root_additional_properties=deny_root)) == json.dumps(expect)
+
+def transform_schema(schema, deny_root_additional_properties=False, allow_null_optional=False):
+    """
+    Applies `additional_properties`, `replace_int_or_string` and (optionally)
+    `allow_null_optional_fields` in a single traversal, returning a new schema.
+    The input is not modified. Replaced int-or-string nodes are not traversed
+    any further.
+    """
+    def walk(data, parent, grand_parent, set_additional, skip):
+        new = {}
+        for k, v in data.items():
+            if isinstance(v, dict):
+                if "format" in v and v["format"] == "int-or-string":
+                    new[k] = {"oneOf": [{"type": "string"}, {"type": "integer"}]}
+                else:
+                    new[k] = walk(v, data, parent, set_additional, False)
+            elif isinstance(v, list):
+                # `additional_properties` never looked inside lists
+                new[k] = [walk(x, v, parent, False, False) if isinstance(x, dict) else x for x in v]
+            elif (
+                allow_null_optional and isinstance(v, str) and k == "type" and v != "null"
+                and not (grand_parent and "required" in grand_parent)
+            ):
+                new[k] = [v, "null"]
+            else:
+                new[k] = v
+        if set_additional and not skip and "properties" in data and "additionalProperties" not in data:
+            new["additionalProperties"] = False
+        return new
+
+    if not isinstance(schema, dict):
+        return schema
+    return walk(schema, None, None, True, not deny_root_additional_properties)
+
 
-    schema = additional_properties(schema, skip=not os.getenv("DENY_ROOT_ADDITIONAL_PROPERTIES"))
-    schema = replace_int_or_string(schema)
-    schemaJSON = json.dumps(schema, indent=2)
+def schema_to_json(schema):
+    return json.dumps(schema, indent=2) + "\n"
 
+
+def write_schema_file(schema, filename):
     # Dealing with user input here..
     filename = os.path.basename(filename)
-    f = open(filename, "w")
-    print(schemaJSON, file=f)
-    f.close()
+    with open(filename, "w") as f:
+        f.write(schema_to_json(schema))
     print("JSON schema written to {filename}".format(filename=filename))
 
 
@@ -118,62 +170,82 @@ def construct_value(load, node):
     yield str(node.value)
 
 
+class CRDLoader(yaml.SafeLoader):
+    pass
+
+CRDLoader.add_constructor(u'tag:yaml.org,2002:value', construct_value)
+
+
+def load_crd_definitions(f):
+    """Returns the CustomResourceDefinitions in the given YAML stream (string or file)."""
+    defs = []
+    for y in yaml.load_all(f, Loader=CRDLoader):
+        if y is None:
+            continue
+        if "items" in y:
+            defs.extend(y["items"])
+        if "kind" not in y:
+            continue
+        if y["kind"] != "CustomResourceDefinition":
+            continue
+        else:
+            defs.append(y)
+    return defs
+
+
+def convert_crds(crds, filename_format="{kind}_{version}", deny_root_additional_properties=False):
+    """
+    Converts the openAPIV3Schemas of the given parsed CRD objects into JSON
+    schemas. Returns a dict of file name -> schema, nothing is written to disk.
+    """
+    def file_name(y, version):
+        return filename_format.format(
+            kind=y["spec"]["names"]["kind"],
+            group=y["spec"]["group"].split(".")[0],
+            version=version,
+        ).lower() + ".json"
+
+    schemas = {}
+    for y in crds:
+        if "spec" in y and "versions" in y["spec"] and y["spec"]["versions"]:
+            for version in y["spec"]["versions"]:
+                if "schema" in version and "openAPIV3Schema" in version["schema"]:
+                    schema = version["schema"]["openAPIV3Schema"]
+                elif "validation" in y["spec"] and "openAPIV3Schema" in y["spec"]["validation"]:
+                    schema = y["spec"]["validation"]["openAPIV3Schema"]
+                else:
+                    continue
+                schemas[file_name(y, version["name"])] = transform_schema(
+                    schema, deny_root_additional_properties=deny_root_additional_properties)
+        elif "spec" in y and "validation" in y["spec"] and "openAPIV3Schema" in y["spec"]["validation"]:
+            schema = y["spec"]["validation"]["openAPIV3Schema"]
+            schemas[file_name(y, y["spec"]["version"])] = transform_schema(
+                schema, deny_root_additional_properties=deny_root_additional_properties)
+    return schemas
+
+
+def convert_crd_file(crdFile, filename_format="{kind}_{version}", deny_root_additional_properties=False):
+    if str(crdFile).startswith("http"):
+        f = urllib.request.urlopen(crdFile)
+    else:
+        f = open(crdFile)
+    with f:
+        defs = load_crd_definitions(f)
+    return convert_crds(defs, filename_format, deny_root_additional_properties)
+
+
 if __name__ == "__main__":
   if len(sys.argv) == 0:
       print("missing file")
       exit(1)
 
   for crdFile in sys.argv[1:]:
-      if crdFile.startswith("http"):
-        f = urllib.request.urlopen(crdFile)
-      else:
-        f = open(crdFile)
-      with f:
-          defs = []
-          yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:value', construct_value)
-          for y in yaml.load_all(f, Loader=yaml.SafeLoader):
-              if y is None:
-                  continue
-              if "items" in y:
-                  defs.extend(y["items"])
-              if "kind" not in y:
-                  continue
-              if y["kind"] != "CustomResourceDefinition":
-                  continue
-              else:
-                  defs.append(y)
-
-          for y in defs:
-              filename_format = os.getenv("FILENAME_FORMAT", "{kind}_{version}")
-              filename = ""
-              if "spec" in y and "versions" in y["spec"] and y["spec"]["versions"]:
-                  for version in y["spec"]["versions"]:
-                      if "schema" in version and "openAPIV3Schema" in version["schema"]:
-                          filename = filename_format.format(
-                              kind=y["spec"]["names"]["kind"],
-                              group=y["spec"]["group"].split(".")[0],
-                              version=version["name"],
-                          ).lower() + ".json"
-
-                          schema = version["schema"]["openAPIV3Schema"]
-                          write_schema_file(schema, filename)
-                      elif "validation" in y["spec"] and "openAPIV3Schema" in y["spec"]["validation"]:
-                          filename = filename_format.format(
-                              kind=y["spec"]["names"]["kind"],
-                              group=y["spec"]["group"].split(".")[0],
-                              version=version["name"],
-                          ).lower() + ".json"
-
-                          schema = y["spec"]["validation"]["openAPIV3Schema"]
-                          write_schema_file(schema, filename)
-              elif "spec" in y and "validation" in y["spec"] and "openAPIV3Schema" in y["spec"]["validation"]:
-                  filename = filename_format.format(
-                      kind=y["spec"]["names"]["kind"],
-                      group=y["spec"]["group"].split(".")[0],
-                      version=y["spec"]["version"],
-                  ).lower() + ".json"
-
-                  schema = y["spec"]["validation"]["openAPIV3Schema"]
-                  write_schema_file(schema, filename)
-
-  exit(0)
\ No newline at end of file
+      schemas = convert_crd_file(
+          crdFile,
+          filename_format=os.getenv("FILENAME_FORMAT", "{kind}_{version}"),
+          deny_root_additional_properties=bool(os.getenv("DENY_ROOT_ADDITIONAL_PROPERTIES")),
+      )
+      for filename, schema in schemas.items():
+          write_schema_file(schema, filename)
+
+  exit(0)
@@ -0,0 +1,298 @@
+"""
+Token budgeting for the new-config prompt (`/api/query_gpt3_new_config`),
+which contains the whole `before` config and asks for the whole new one.
+
+`build_new_config_prompt` counts tokens locally (tiktoken when it is installed
+and its encoding is available, otherwise ~4 characters per token) and:
+
+- leaves out the documents of a multi-document config that the instruction
+  doesn't mention by kind or name, when it mentions some of them. They are
+  spliced back into the answer unchanged by `NewConfigPrompt.complete`.
+- if the prompt still doesn't fit the context window (`LLM_CONTEXT_TOKENS`),
+  replaces long string values whose key the instruction doesn't mention with
+  placeholders, which are put back into the answer.
+- sizes `max_tokens` from the config in the prompt, since the answer repeats
+  it with the edits, instead of the fixed 250.
+
+`NewConfigPrompt.report()` says where the tokens went.
+"""
+import math
+import re
+from functools import lru_cache
+from typing import *
+
+import yaml
+from starlette.config import Config
+
+from kurator.llm import estimate_tokens
+
+config = Config()
+
+LLM_CONTEXT_TOKENS = config('LLM_CONTEXT_TOKENS', cast=int, default=8001)  # code-davinci-002
+LLM_TOKENIZER_ENCODING = config('LLM_TOKENIZER_ENCODING', default="p50k_base")
+
+# The new config is the old one with edits, plus some room for what gets added
+OUTPUT_TOKENS_RATIO = 1.25
+OUTPUT_TOKENS_MARGIN = 64
+MIN_OUTPUT_TOKENS = 64
+# Only string values at least this long are worth replacing with a placeholder
+ELIDE_MIN_TOKENS = 64
+
+PLACEHOLDER = "__kurator_elided_{}__"
+PLACEHOLDER_PREFIX = "__kurator_elided_"
+# A placeholder that is still being streamed, or one that just ended
+PARTIAL_PLACEHOLDER = re.compile(r"__kurator_elided_\d*_?$")
+COMPLETE_PLACEHOLDER_AT_END = re.compile(r"__kurator_elided_\d+__$")
+
+DOCUMENT_SEPARATOR = re.compile(r"^---[ \t]*$", re.MULTILINE)
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+###### Token counting ######
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(LLM_TOKENIZER_ENCODING)
+    except Exception as e:
+        # not installed, or the encoding can't be downloaded
+        print(f"Counting tokens approximately, tiktoken is not available: {e!r}")
+        return None
+
+
+def tokenizer_name() -> str:
+    return f"tiktoken {LLM_TOKENIZER_ENCODING}" if get_encoding() is not None else "estimate"
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+###### Documents ######
+
+class Document(NamedTuple):
+    text: str
+    label: Optional[str]
+    # Words that mark the document as relevant when the instruction contains them
+    terms: Tuple[str, ...]
+
+    @property
+    def has_content(self) -> bool:
+        return bool(self.text.strip(" \t\n-"))
+
+
+def split_documents(config_yaml: str) -> List[Document]:
+    """Splits on `---` lines, keeping each document's text as it is."""
+    bounds = [0] + [m.start() for m in DOCUMENT_SEPARATOR.finditer(config_yaml)] + [len(config_yaml)]
+    documents = []
+    for start, end in zip(bounds, bounds[1:]):
+        text = config_yaml[start:end]
+        label, terms = None, ()
+        try:
+            doc = yaml.load(text, Loader=Loader)
+        except yaml.YAMLError:
+            doc = None
+        if isinstance(doc, dict):
+            kind = doc.get("kind")
+            name = doc["metadata"].get("name") if isinstance(doc.get("metadata"), dict) else None
+            if kind and name:
+                label = f"{kind}/{name}"
+            terms = tuple(str(t) for t in (kind, name) if t)
+        documents.append(Document(text, label, terms))
+    return documents
+
+
+def mentions(instruction: str, term: str) -> bool:
+    # Prefix match, so that "deployments" mentions a Deployment
+    return re.search(r"(?<![\w-])" + re.escape(term), instruction, re.IGNORECASE) is not None
+
+
+def relevant_documents(documents: List[Document], instruction: str) -> List[bool]:
+    """
+    Which documents to keep: all of them, unless the instruction names some
+    but not others. Documents without a kind or name are always kept, empty
+    ones never.
+    """
+    content = [d for d in documents if d.has_content]
+    named = [d for d in content if d.terms and any(mentions(instruction, t) for t in d.terms)]
+    if len(content) < 2 or not named:
+        return [d.has_content for d in documents]
+    return [d.has_content and (not d.terms or d in named) for d in documents]
+
+
+def join_documents(texts: List[str]) -> str:
+    parts = []
+    for text in texts:
+        body = DOCUMENT_SEPARATOR.sub("", text, count=1) if DOCUMENT_SEPARATOR.match(text) else text
+        parts.append(body.strip("\n") + "\n")
+    return "---\n".join(parts)
+
+
+###### Long values ######
+
+def long_values(text: str, instruction: str) -> List[Tuple[int, int]]:
+    """(start, end) in `text` of string values that are long and not under a key the instruction mentions."""
+    try:
+        roots = list(yaml.compose_all(text, Loader=Loader))
+    except yaml.YAMLError:
+        return []
+    spans = []
+
+    def visit(node, key: Optional[str]):
+        if isinstance(node, yaml.MappingNode):
+            for key_node, value_node in node.value:
+                visit(value_node, str(key_node.value) if isinstance(key_node, yaml.ScalarNode) else None)
+        elif isinstance(node, yaml.SequenceNode):
+            for item in node.value:
+                visit(item, key)
+        elif isinstance(node, yaml.ScalarNode) and node.tag.endswith(":str") and key is not None:
+            if not mentions(instruction, key) and count_tokens(node.value) >= ELIDE_MIN_TOKENS:
+                spans.append((node.start_mark.index, node.end_mark.index))
+
+    for root in roots:
+        if root is not None:
+            visit(root, None)
+    return spans
+
+
+###### Prompt ######
+
+def output_tokens(config_tokens: int) -> int:
+    return max(MIN_OUTPUT_TOKENS, math.ceil(config_tokens * OUTPUT_TOKENS_RATIO) + OUTPUT_TOKENS_MARGIN)
+
+
+class NewConfigPrompt:
+    def __init__(self, prompt: str, max_tokens: int, documents: List[Document], kept: List[bool],
+                 elided: Dict[str, str], report: Dict[str, Any]):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.documents = documents
+        self.kept = kept
+        self.elided = elided
+        self._report = report
+
+    @property
+    def fits(self) -> bool:
+        return self._report["fits"]
+
+    def report(self) -> Dict[str, Any]:
+        return dict(self._report)
+
+    def restore_values(self, text: str) -> str:
+        for placeholder, value in self.elided.items():
+            text = text.replace(placeholder, value)
+        return text
+
+    def complete(self, completion: str, partial: bool = False) -> str:
+        """
+        The whole new config from the model's answer: placeholders replaced by
+        their values, and the documents that were left out of the prompt put
+        back where they were. With `partial`, for an answer that is still being
+        streamed, only the part up to the answer is given.
+        """
+        if partial and self.elided:
+            # hold back a placeholder that is only partly there
+            match = PARTIAL_PLACEHOLDER.search(completion)
+            if match:
+                hold = len(match.group())
+            elif COMPLETE_PLACEHOLDER_AT_END.search(completion):
+                # its closing "__" isn't the start of another one
+                hold = 0
+            else:
+                hold = max([k for k in range(1, len(PLACEHOLDER_PREFIX))
+                            if completion.endswith(PLACEHOLDER_PREFIX[:k])], default=0)
+            completion = completion[:len(completion) - hold]
+        completion = self.restore_values(completion)
+        left_out = [d.has_content and not k for d, k in zip(self.documents, self.kept)]
+        if not any(left_out) or True not in self.kept:
+            return completion
+
+        answered = [d for d in split_documents(completion) if d.has_content]
+        shown = [i for i, k in enumerate(self.kept) if k and self.documents[i].has_content]
+        if not partial and len(answered) == len(shown):
+            # one answer per document shown, so each can go back to its place
+            texts = [d.text for d in self.documents]
+            for i, d in zip(shown, answered):
+                texts[i] = d.text
+            return join_documents([t for t, d in zip(texts, self.documents) if d.has_content])
+
+        first_kept = self.kept.index(True)
+        before = "".join(d.text for d, out in zip(self.documents[:first_kept], left_out) if out)
+        after = "".join(d.text for d, out in zip(self.documents[first_kept:], left_out[first_kept:]) if out)
+        if before and not before.endswith("\n"):
+            before += "\n"
+        if before and not completion.lstrip().startswith("---"):
+            completion = "---\n" + completion
+        if partial:
+            return before + completion
+        if after and not completion.endswith("\n"):
+            completion += "\n"
+        return before + completion + after
+
+
+def build_new_config_prompt(
+    before: str,
+    instruction: str,
+    render: Callable[[str], str],
+    context_tokens: int = LLM_CONTEXT_TOKENS,
+) -> NewConfigPrompt:
+    """`render(config)` makes the prompt from the config to show to the model."""
+    documents = split_documents(before)
+    kept = relevant_documents(documents, instruction)
+    config_text = "".join(d.text for d, k in zip(documents, kept) if k)
+    first_kept = kept.index(True) if True in kept else len(kept)
+    if any(d.has_content for d in documents[:first_kept]):
+        # the first document shown shouldn't start with a separator
+        separator = DOCUMENT_SEPARATOR.match(config_text)
+        if separator:
+            config_text = config_text[separator.end():].lstrip("\n")
+
+    untrimmed_prompt_tokens = count_tokens(render(before))
+    prompt = render(config_text)
+    prompt_tokens = count_tokens(prompt)
+    config_tokens = count_tokens(config_text)
+
+    elided: Dict[str, str] = {}
+    if prompt_tokens + output_tokens(config_tokens) > context_tokens:
+        # replace the longest values first, until the prompt fits
+        spans = sorted(long_values(config_text, instruction), key=lambda s: s[0] - s[1])
+        chosen = []
+        for start, end in spans:
+            if prompt_tokens + output_tokens(config_tokens) <= context_tokens:
+                break
+            saved = count_tokens(config_text[start:end])
+            chosen.append((start, end))
+            prompt_tokens -= saved
+            config_tokens -= saved
+        for start, end in sorted(chosen, reverse=True):
+            value = config_text[start:end]
+            stripped = value.rstrip("\n")
+            placeholder = PLACEHOLDER.format(len(elided) + 1)
+            elided[placeholder] = stripped
+            config_text = config_text[:start] + placeholder + value[len(stripped):] + config_text[end:]
+        if chosen:
+            prompt = render(config_text)
+            prompt_tokens = count_tokens(prompt)
+            config_tokens = count_tokens(config_text)
+
+    max_tokens = min(output_tokens(config_tokens), max(context_tokens - prompt_tokens, 0))
+    report = {
+        "tokenizer": tokenizer_name(),
+        "context_tokens": context_tokens,
+        "prompt_tokens": prompt_tokens,
+        "untrimmed_prompt_tokens": untrimmed_prompt_tokens,
+        "config_tokens": config_tokens,
+        "max_tokens": max_tokens,
+        "documents": len([d for d in documents if d.has_content]),
+        "documents_left_out": [d.label or f"document {i + 1}"
+                               for i, (d, k) in enumerate(zip(documents, kept)) if d.has_content and not k],
+        "values_elided": len(elided),
+        # the answer repeats the config, so it has to fit at least that
+        "fits": max_tokens >= config_tokens,
+    }
+    return NewConfigPrompt(prompt, max_tokens, documents, kept, elided, report)
+
@@ -0,0 +1,118 @@
+"""
+Re-validates every data point, e.g. after the CRD schemas have been rebuilt.
+
+Rows are read from MySQL in chunks of increasing id, validated in parallel on a
+pool of worker processes, and the results are written to `validation_results`.
+After every chunk the last processed id is checkpointed in `job_checkpoints`,
+so an interrupted run continues where it left off. A pass that gets through
+all the rows resets the checkpoint, so that the next run (after the next schema
+change) starts from the beginning again.
+
+Usage (from kurator_backend/):
+    python -m kurator.revalidate [--workers N] [--chunk-size N] [--restart]
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import *
+
+from sqlalchemy import text
+
+from kurator.crd_schemas import load_manifest
+from kurator.database import get_engine
+from kurator.dataset import get_checkpoint, iter_data_point_chunks, save_checkpoint
+
+DEFAULT_JOB_NAME = "revalidate"
+
+
+def validate_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs in a worker process. Imported here so that the parent process
+    # doesn't have to load the validation machinery.
+    from kurator.utils import validate_configs_all_docs
+
+    result = {"data_point_id": row["id"]}
+    for name, errors in zip(["before", "after"], validate_configs_all_docs([row["before_edit"], row["after_edit"]])):
+        if isinstance(errors, BaseException):
+            errors = [{"doc_index": None, "error": f"Unable to validate: {type(errors).__name__}: {errors}"}]
+        else:
+            errors = [e._asdict() for e in errors]
+        result[f"{name}_errors"] = errors
+    result["valid"] = not result["before_errors"] and not result["after_errors"]
+    return result
+
+
+def save_results(conn, results: List[Dict[str, Any]], schema_build_id: Optional[str]):
+    conn.execute(text(
+        "INSERT INTO validation_results (data_point_id, valid, before_errors, after_errors, schema_build_id) "
+        "VALUES (:data_point_id, :valid, :before_errors, :after_errors, :schema_build_id) "
+        "ON DUPLICATE KEY UPDATE valid = VALUES(valid), before_errors = VALUES(before_errors), "
+        "after_errors = VALUES(after_errors), schema_build_id = VALUES(schema_build_id)"
+    ), [
+        {
+            "data_point_id": r["data_point_id"],
+            "valid": r["valid"],
+            "before_errors": json.dumps(r["before_errors"]),
+            "after_errors": json.dumps(r["after_errors"]),
+            "schema_build_id": schema_build_id,
+        }
+        for r in results
+    ])
+
+
+def revalidate(
+    workers: Optional[int] = None,
+    chunk_size: int = 200,
+    job_name: str = DEFAULT_JOB_NAME,
+    start_after_id: Optional[int] = None,
+    include_deleted: bool = False,
+) -> Dict[str, int]:
+    engine = get_engine()
+    if start_after_id is None:
+        start_after_id = get_checkpoint(engine, job_name)
+    schema_build_id = load_manifest().get("build_id")
+    print(f"Re-validating data points with id > {start_after_id} (schema build {schema_build_id})")
+
+    counts = {"rows": 0, "invalid": 0}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in iter_data_point_chunks(
+            engine, ["before_edit", "after_edit"], chunk_size=chunk_size,
+            after_id=start_after_id, include_deleted=include_deleted,
+        ):
+            results = list(pool.map(validate_row, chunk))
+            with engine.begin() as conn:
+                save_results(conn, results, schema_build_id)
+                save_checkpoint(conn, job_name, chunk[-1]["id"])
+
+            counts["rows"] += len(results)
+            counts["invalid"] += sum(not r["valid"] for r in results)
+            elapsed = time.time() - start
+            print(f"up to id {chunk[-1]['id']}: {counts['rows']} rows, {counts['invalid']} invalid, "
+                  f"{counts['rows'] / max(elapsed, 1e-9):.1f} rows/s")
+
+    with engine.begin() as conn:
+        save_checkpoint(conn, job_name, 0)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-validate all data points into validation_results")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=200, help="rows fetched and checkpointed at a time")
+    parser.add_argument("--job-name", default=DEFAULT_JOB_NAME, help="name of the checkpoint to resume from / save to")
+    parser.add_argument("--start-after-id", type=int, default=None, help="ignore the checkpoint and start after this id")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    parser.add_argument("--include-deleted", action="store_true", help="also re-validate deleted data points")
+    args = parser.parse_args()
+
+    start_after_id = 0 if args.restart else args.start_after_id
+    counts = revalidate(
+        workers=args.workers, chunk_size=args.chunk_size, job_name=args.job_name,
+        start_after_id=start_after_id, include_deleted=args.include_deleted,
+    )
+    print(f"Done: {counts['rows']} rows re-validated, {counts['invalid']} invalid")
+
+
+if __name__ == "__main__":
+    main()
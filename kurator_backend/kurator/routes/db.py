@@ -1,21 +1,63 @@
+import asyncio
 import datetime
+import importlib.util
+import json
+import time
 import traceback
-from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from pydantic import BaseModel
-from sqlalchemy import create_engine, text
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import text
 from sqlalchemy.engine.base import Engine
+from starlette.concurrency import run_in_threadpool
 from starlette.config import Config
 
-from kurator.utils import validate_config, ROOT_PATH
+from kurator.database import get_engine, get_pool_stats
+from kurator.dataset import (
+    DATA_POINT_COLUMNS, DEFAULT_EXPORT_COLUMNS, EXPORT_FORMATS, EXPORT_MEDIA_TYPES, FEED_START, FeedToken,
+    decode_feed_token, encode_feed_token, encode_export, get_changes, index_data_points, insert_data_point,
+    iter_export_batches, soft_delete_data_point, to_db_time, update_data_point, write_data_points,
+    write_denied_reason,
+)
+from kurator.instruction_jobs import count_jobs, enqueue_instruction_jobs, get_job, worker as instruction_worker
+from kurator.llm import llm_stats
+from kurator.llm_cache import get_llm_cache
+from kurator.search import SEARCH_COLUMNS, search_data_points
+from kurator.utils import (
+    validate_config, validate_configs_all_docs, ValidationOverloaded, ROOT_PATH,
+)
+from kurator.validation_cache import validation_cache
 
 config = Config()
 router = APIRouter()
 
 # Reading from file instead of env so that we can quickly restart the webserver alone, without having to restart the whole docker-compose stack
-# Auto-reload takes care of this.
-admin_users = open(ROOT_PATH / 'admin_users.txt').read().splitlines()
+# Read on first use and again whenever the file changes, so edits don't even need a restart.
+_admin_users: Tuple[int, List[str]] = (0, [])
+
+def get_admin_users() -> List[str]:
+    global _admin_users
+    path = ROOT_PATH / 'admin_users.txt'
+    mtime_ns = path.stat().st_mtime_ns
+    if _admin_users[0] != mtime_ns:
+        _admin_users = (mtime_ns, path.read_text().splitlines())
+    return _admin_users[1]
+
+MAX_PAGE_SIZE = 1000
+MAX_VALIDATION_BATCH_SIZE = 200
+MAX_IMPORT_ROWS = config('MAX_IMPORT_ROWS', cast=int, default=5000)
+FEED_SAFETY_LAG_SECONDS = config('FEED_SAFETY_LAG_SECONDS', cast=int, default=5)
+
+# Validation blocks on subprocesses and the per-document pool, so it runs on its
+# own executor instead of Starlette's threadpool, which serves every other sync
+# route. Requests beyond VALIDATION_MAX_PENDING_REQUESTS are turned away with a 429.
+validation_request_pool = ThreadPoolExecutor(
+    max_workers=config('VALIDATION_REQUEST_WORKERS', cast=int, default=8),
+    thread_name_prefix="validation-request")
+validation_requests = asyncio.Semaphore(config('VALIDATION_MAX_PENDING_REQUESTS', cast=int, default=32))
 
 class EditDataPoint(BaseModel):
     id: int | None = None
@@ -35,124 +77,336 @@ class EditDataPoint(BaseModel):
 class ValidateConfigsPayload(BaseModel):
     before: str
     after: str
+    # validate all documents concurrently and report every error, not just the first one
+    all_errors: bool = False
 
 
-def get_db(test_conn: bool = False) -> Engine:
-    user = config.get('MYSQL_USER')
-    password = config.get('MYSQL_PASSWORD')
-    host = config.get('MYSQL_HOST')
-    port = config.get('MYSQL_PORT')
-    db = config.get('MYSQL_DATABASE')
-    engine = None
-    try:
-        engine = create_engine(f'mysql://{user}:{password}@{host}:{port}/{db}')
-        if test_conn:
-            with engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
-        yield engine
-    except Exception as e:
-        if test_conn:
-            raise e
-    finally:
-        if engine:
-            engine.dispose()
+class ValidateConfigsBatchPayload(BaseModel):
+    items: List[ValidateConfigsPayload]
+
+
+def get_db() -> Engine:
+    # The engine (and its connection pool) is shared by the whole process and
+    # is created in the app lifespan, see `kurator.app`.
+    return get_engine()
 
 ############ Helper functions ############
 
-def get_current_user(request: Request) -> Dict[str, Any]:
+# Async, so that FastAPI calls them on the event loop instead of a thread
+async def get_current_user(request: Request) -> Dict[str, Any]:
     user = request.session.get('user')
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    print("Current user:", user)
     return user
 
+async def get_admin_user(current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
+    if current_user['email'] not in get_admin_users():
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return current_user
+
+########### Monitoring ###########
+
+
+@router.get('/api/db_pool_stats')
+def db_pool_stats(
+    request: Request,
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    return get_pool_stats()
+
+
+@router.get('/api/validation_cache_stats')
+def validation_cache_stats(
+    request: Request,
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    return validation_cache.stats()
+
+
+@router.get('/api/llm_stats')
+async def get_llm_stats(
+    request: Request,
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    return await llm_stats()
+
+
+@router.get('/api/llm_cache')
+async def inspect_llm_cache(
+    request: Request,
+    namespace: str | None = None,
+    offset: int = 0,
+    limit: int = 100,
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    """Cache stats and the most recently used entries (prompts are truncated)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return {
+        "stats": await get_llm_cache().stats(),
+        "entries": await get_llm_cache().entries(namespace=namespace, offset=max(offset, 0), limit=limit),
+    }
+
+
+@router.post('/api/llm_cache/purge')
+async def purge_llm_cache(
+    request: Request,
+    key: str | None = None,
+    namespace: str | None = None,
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    """Deletes the entry `key`, all entries of `namespace`, or (with neither) the whole cache."""
+    return {"purged": await get_llm_cache().purge(key=key, namespace=namespace)}
+
 ########### CRUD of data points ###########
 
 
-@router.get('/api/get_data_points', response_model=List[EditDataPoint])
+def row_to_dict(row) -> Dict[str, Any]:
+    d = dict(getattr(row, '_mapping', row))
+    for col in ('created_at', 'updated_at'):
+        if d.get(col) is not None:
+            d[col] = d[col].isoformat()
+    return d
+
+
+def parse_fields(fields: str | None, default: List[str] = DATA_POINT_COLUMNS) -> List[str]:
+    if fields is None or fields.strip() == "":
+        return default
+    cols = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [c for c in cols if c not in DATA_POINT_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"unknown fields: {', '.join(unknown)}")
+    # `id` is always returned, it's the pagination cursor
+    if 'id' not in cols:
+        cols = ['id'] + cols
+    return cols
+
+
+@router.get('/api/get_data_points', response_model=List[Dict[str, Any]])
 def get_data_points(
     request: Request,
+    response: Response,
     username: str | None = None,
     include_deleted: bool = False,
+    after_id: int | None = None,
+    limit: int | None = None,
+    fields: str | None = None,
     db: Engine = Depends(get_db),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
+    """
+    Lists data points ordered by id. Supports keyset pagination: pass the id of
+    the last data point of the previous page as `after_id`. When the page is
+    full, the `X-Next-Cursor` header holds the value for the next `after_id`.
+    `fields` is a comma separated list of columns to return (default: all).
+    """
     # TODO: handle `include_deleted`
     # TODO: handle `username` - should we allow users to see other users' data points?
 
+    cols = parse_fields(fields)
+    query = f"SELECT {', '.join(cols)} FROM edit_data_points WHERE deleted = False"
+    params: Dict[str, Any] = {}
+    if username is not None:
+        query += " AND username = :username"
+        params["username"] = username
+    if after_id is not None:
+        query += " AND id > :after_id"
+        params["after_id"] = after_id
+    query += " ORDER BY id"
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query += " LIMIT :limit"
+        params["limit"] = limit
+
     with db.connect() as conn:
-        if username is None:
-            data_points = conn.execute(
-                text("SELECT * FROM edit_data_points WHERE Deleted = False")).fetchall()
-        else:
-            data_points = conn.execute(text(
-                "SELECT * FROM edit_data_points WHERE Deleted = False AND username = :username"), {"username": username}).fetchall()
+        data_points = [row_to_dict(d) for d in conn.execute(text(query), params)]
 
-    data_points = [dict(d.items()) for d in data_points]
-    for d in data_points:
-        d['created_at'] = d['created_at'].isoformat()
-        d['updated_at'] = d['updated_at'].isoformat()
+    if limit is not None and len(data_points) == limit:
+        response.headers["X-Next-Cursor"] = str(data_points[-1]['id'])
     return data_points
 
 
-def get_instructions_from_gpt3(before_edit: str, after_edit: str) -> str:
-    # TODO: Implement this
-    return ""
+@router.get('/api/get_data_point/{data_point_id}', response_model=EditDataPoint)
+def get_data_point(
+    request: Request,
+    data_point_id: int,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    with db.connect() as conn:
+        data_point = conn.execute(text(
+            "SELECT * FROM edit_data_points WHERE id = :id AND deleted = False"), {"id": data_point_id}).fetchone()
+    if data_point is None:
+        raise HTTPException(status_code=404, detail="id does not exist")
+    return row_to_dict(data_point)
 
 
-@router.post('/api/add_data_point')
-async def add_data_point(
+@router.get('/api/export_data_points')
+def export_data_points(
     request: Request,
-    data_point: EditDataPoint,
+    format: str = "jsonl",
+    fields: str | None = None,
+    username: str | None = None,
+    updated_since: datetime.datetime | None = None,
+    deleted: str = "false",
     db: Engine = Depends(get_db),
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
-    editing_user = current_user['email']
+    """
+    Streams data points as NDJSON (`format=jsonl`) or Parquet (`format=parquet`)
+    without loading the table into memory. By default only
+    (id, before_edit, human_change_instruction, after_edit) are exported.
+    `deleted` is one of "false" (default), "true" or "any".
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {EXPORT_FORMATS}")
+    if format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise HTTPException(status_code=400, detail="parquet export requires pyarrow to be installed")
+    deleted_filter = {"false": False, "true": True, "any": None}
+    if deleted not in deleted_filter:
+        raise HTTPException(status_code=400, detail=f"deleted must be one of {list(deleted_filter)}")
+
+    cols = parse_fields(fields, default=DEFAULT_EXPORT_COLUMNS)
+    batches = iter_export_batches(
+        db, cols, username=username, updated_since=updated_since, deleted=deleted_filter[deleted])
+    return StreamingResponse(
+        encode_export(batches, cols, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="data_points.{format}"'},
+    )
+
+
+@router.get('/api/search_data_points')
+def search_data_points_api(
+    request: Request,
+    q: str | None = None,
+    kind: str | None = None,
+    api_version: str | None = None,
+    tag: str | None = None,
+    username: str | None = None,
+    offset: int = 0,
+    limit: int = 50,
+    fields: str | None = None,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    Finds data points by text in their instruction or note (`q`, ranked by
+    relevance), by the `kind` and `api_version` of the documents in their
+    configs, by `tag` and by `username`. Filters combine with AND. Pages are
+    `limit` results from `offset`; `next_offset` is null on the last page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(offset, 0)
+    cols = parse_fields(fields, default=SEARCH_COLUMNS)
+    with db.connect() as conn:
+        # one more than asked for tells whether there is a next page
+        rows = search_data_points(conn, cols, q=(q or "").strip() or None, kind=kind, api_version=api_version,
+                                  tag=tag, username=username, offset=offset, limit=limit + 1)
+    return {
+        "results": [row_to_dict(row) for row in rows[:limit]],
+        "next_offset": offset + limit if len(rows) > limit else None,
+    }
 
-    # sanity checks:
-    if data_point.after_edit.strip() == data_point.before_edit.strip():
-        raise HTTPException(
-            status_code=400, detail="after_edit is the same as before_edit")
 
+@router.get('/api/changes')
+def get_data_point_changes(
+    request: Request,
+    since: str | None = None,
+    updated_since: datetime.datetime | None = None,
+    limit: int = 500,
+    fields: str | None = None,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    Incremental change feed for downstream consumers. Returns the data points
+    created, updated or deleted after the `since` token (or after
+    `updated_since`, or from the beginning), oldest first, each with a
+    `change_type`. Poll again with `next_token` to get the next changes;
+    it stays the same while there is nothing new. `updated_since` without a
+    timezone is in the database's timezone.
+
+    `change_type` comes from the timestamps, which have a resolution of one
+    second: a data point edited within the second it was created in is
+    reported as "created" (with its latest content). Filling in the
+    generated instruction isn't a change, so `gpt3_change_instruction`
+    may still be empty in the feed.
+    """
+    if since is not None:
+        try:
+            token = decode_feed_token(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid since token")
+    elif updated_since is not None:
+        # everything updated at or after the given time
+        token = FeedToken(to_db_time(db, updated_since) - datetime.timedelta(microseconds=1), 0)
+    else:
+        token = FEED_START
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    cols = parse_fields(fields)
+    rows, next_token = get_changes(db, cols, since=token, limit=limit,
+                                   safety_lag_seconds=FEED_SAFETY_LAG_SECONDS)
+    return {
+        "changes": [row_to_dict(row) for row in rows],
+        "next_token": encode_feed_token(next_token),
+        "has_more": len(rows) == limit,
+    }
+
+
+def check_data_point(data_point: EditDataPoint) -> str | None:
+    """Sanity checks before saving, returns what is wrong with the data point if anything."""
+    if data_point.after_edit.strip() == data_point.before_edit.strip():
+        return "after_edit is the same as before_edit"
     if data_point.human_change_instruction.strip() == "":
-        raise HTTPException(
-            status_code=400, detail="human_change_instruction is empty")
+        return "human_change_instruction is empty"
+    return None
+
 
+def prepare_data_point(data_point: EditDataPoint, editing_user: str):
     data_point.username = editing_user
-    data_point.gpt3_change_instruction = get_instructions_from_gpt3(
-        data_point.before_edit, data_point.after_edit)
+    # filled in by a background job once the data point is saved, see `enqueue_instruction_jobs`
+    data_point.gpt3_change_instruction = ""
     data_point.edited = data_point.human_change_instruction.strip(
     ) != data_point.gpt3_change_instruction.strip()
 
     # TODO: validate config
     # TODO: compute tags
 
+
+@router.post('/api/add_data_point')
+def add_data_point(
+    request: Request,
+    data_point: EditDataPoint,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    editing_user = current_user['email']
+
+    problem = check_data_point(data_point)
+    if problem is not None:
+        raise HTTPException(status_code=400, detail=problem)
+    prepare_data_point(data_point, editing_user)
+
+    is_admin = editing_user in get_admin_users()
     with db.begin() as conn:
-        cols = ["username", "before_edit", "human_change_instruction",
-                "after_edit", "gpt3_change_instruction", "edited", "note"]
         if (
             data_point.id is not None and
             (str(data_point.id).isdigit() or isinstance(data_point.id, int)) and
             int(data_point.id) > 0
         ):
-            # check if the id exists, and if so, whether the username matches
-            existing_data_point = conn.execute(text(
-                "SELECT * FROM edit_data_points WHERE id = :id"), {"id": data_point.id}).fetchone()
-            if existing_data_point is None:
-                raise HTTPException(
-                    status_code=400, detail="id does not exist")
-            if existing_data_point['username'] != editing_user and editing_user not in admin_users:
+            # a single conditional UPDATE, which also checks that the username matches
+            if not update_data_point(conn, data_point.dict(), editing_user, is_admin):
                 raise HTTPException(
-                    status_code=400, detail="username does not match")
-            cols = ["id"] + cols
-
-        # insert or update - mysql syntax
-        conn.execute(text('REPLACE INTO edit_data_points ({}) VALUES ({})'.format(
-            ', '.join(cols),
-            ', '.join([':' + col for col in cols])
-        )), data_point.dict())
+                    status_code=400, detail=write_denied_reason(conn, data_point.id))
+        else:
+            data_point.id = insert_data_point(conn, data_point.dict())
+        index_data_points(conn, [data_point.dict()])
+        enqueue_instruction_jobs(conn, [data_point.dict()])
 
-        return {"success": True}
+    instruction_worker.notify()
+    return {"success": True, "id": data_point.id}
 
 
 @router.post('/api/del_data_point')
@@ -169,45 +423,115 @@ async def del_data_point(
         raise HTTPException(status_code=400, detail="id is invalid")
 
     with db.begin() as conn:
-        # check if the id exists, and if so, whether the username matches
-        existing_data_point = conn.execute(text(
-            "SELECT * FROM edit_data_points WHERE id = :id"), {"id": data_point_id}).fetchone()
-        if existing_data_point is None:
-            raise HTTPException(status_code=400, detail="id does not exist")
-        if existing_data_point['username'] != editing_user and editing_user not in admin_users:
+        if not soft_delete_data_point(conn, data_point_id, editing_user, editing_user in get_admin_users()):
             raise HTTPException(
-                status_code=400, detail="username does not match")
-
-        conn.execute(text('UPDATE edit_data_points SET Deleted = True WHERE id = :id'), {
-                     "id": data_point_id})
+                status_code=400, detail=write_denied_reason(conn, data_point_id))
 
         return {"success": True}
 
 
+########### Instruction suggestions ###########
+
+
+def enqueue_written_instruction_jobs(db: Engine, data_points: List[Dict[str, Any]]):
+    # after the import's own transactions, which each commit a batch
+    if data_points:
+        with db.begin() as conn:
+            enqueue_instruction_jobs(conn, data_points)
+        instruction_worker.notify()
+
+
+@router.get('/api/instruction_jobs/{data_point_id}')
+def get_instruction_job(
+    request: Request,
+    data_point_id: int,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    Status of generating `gpt3_change_instruction` for a data point:
+    `pending`, `running`, `done`, `failed` (after all retries) or `cancelled`.
+    """
+    with db.connect() as conn:
+        job = get_job(conn, data_point_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="no instruction job for this id")
+        job["gpt3_change_instruction"] = conn.execute(text(
+            "SELECT gpt3_change_instruction FROM edit_data_points WHERE id = :id"), {"id": data_point_id}).scalar()
+    for col in ("run_after", "claimed_at", "updated_at"):
+        if isinstance(job[col], datetime.datetime):
+            job[col] = job[col].isoformat()
+    return job
+
+
+@router.get('/api/instruction_jobs')
+def get_instruction_job_stats(
+    request: Request,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_admin_user)
+):
+    """Jobs per status in the table, and what this process's worker has done."""
+    with db.connect() as conn:
+        return {"jobs": count_jobs(conn), "worker": instruction_worker.stats()}
+
+
 ########### Validation ###########
 
 
 @router.post('/api/validate_configs')
-def validate_configs_api(
+async def validate_configs_api(
     request: Request,
     payload: ValidateConfigsPayload,
     current_user: Dict[str, Any] = Depends(get_current_user)
 ):
-    validation_errors = []
+    if validation_requests.locked():
+        raise HTTPException(
+            status_code=429, detail="Too many validation requests, please try again shortly",
+            headers={"Retry-After": "1"})
+    async with validation_requests:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                validation_request_pool, validate_configs, payload, current_user)
+        except ValidationOverloaded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
 
-    try:
-        before_error = validate_config(payload.before)
-    except Exception as e:
-        print("Error while validating before", traceback.format_exc())
-        before_error = ""
-        validation_errors.append(("before", traceback.format_exc()))
 
-    try:
-        after_error = validate_config(payload.after)
-    except Exception as e:
-        print("Error while validating after", traceback.format_exc())
-        after_error = ""
-        validation_errors.append(("after", traceback.format_exc()))
+def validate_configs(payload: ValidateConfigsPayload, current_user: Dict[str, Any]) -> Dict[str, Any]:
+    validation_errors = []
+    doc_errors = {}
+
+    if payload.all_errors:
+        results = validate_configs_all_docs([payload.before, payload.after])
+        for name, result in zip(["before", "after"], results):
+            if isinstance(result, ValidationOverloaded):
+                raise result
+            if isinstance(result, BaseException):
+                tb = "".join(traceback.format_exception(type(result), result, result.__traceback__))
+                print(f"Error while validating {name}", tb)
+                validation_errors.append((name, tb))
+                doc_errors[name] = []
+            else:
+                doc_errors[name] = [e._asdict() for e in result]
+        before_error = doc_errors["before"][0]["error"] if doc_errors["before"] else None
+        after_error = doc_errors["after"][0]["error"] if doc_errors["after"] else None
+    else:
+        try:
+            before_error = validate_config(payload.before)
+        except ValidationOverloaded:
+            raise
+        except Exception as e:
+            print("Error while validating before", traceback.format_exc())
+            before_error = ""
+            validation_errors.append(("before", traceback.format_exc()))
+
+        try:
+            after_error = validate_config(payload.after)
+        except ValidationOverloaded:
+            raise
+        except Exception as e:
+            print("Error while validating after", traceback.format_exc())
+            after_error = ""
+            validation_errors.append(("after", traceback.format_exc()))
 
     if len(validation_errors):
         # log the data, user, and error
@@ -225,8 +549,193 @@ def validate_configs_api(
             f.write("=" * 80 + "\n")
             f.write("\n")
 
-    return {
+    response = {
         "before_error": before_error,
         "after_error": after_error,
         "validation_error": len(validation_errors) > 0,
     }
+    if payload.all_errors:
+        response["before_errors"] = doc_errors["before"]
+        response["after_errors"] = doc_errors["after"]
+    return response
+
+
+def validate_configs_batch(payload: ValidateConfigsBatchPayload) -> List[Dict[str, Any]]:
+    # All documents of all items go through the per-document pool together
+    configs = []
+    for item in payload.items:
+        configs.extend([item.before, item.after])
+    results = validate_configs_all_docs(configs)
+
+    response = []
+    for i in range(len(payload.items)):
+        item_response = {"validation_error": False}
+        for name, result in zip(["before", "after"], results[2 * i: 2 * i + 2]):
+            if isinstance(result, ValidationOverloaded):
+                raise result
+            if isinstance(result, BaseException):
+                print(f"Error while validating {name} of batch item {i}:", repr(result))
+                item_response["validation_error"] = True
+                result = []
+            errors = [e._asdict() for e in result]
+            item_response[f"{name}_error"] = errors[0]["error"] if errors else None
+            item_response[f"{name}_errors"] = errors
+        response.append(item_response)
+    return response
+
+
+@router.post('/api/validate_configs_batch')
+async def validate_configs_batch_api(
+    request: Request,
+    payload: ValidateConfigsBatchPayload,
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """Validates many before/after pairs in one call. Items are answered in order, in the format of `/api/validate_configs` with `all_errors`."""
+    if len(payload.items) > MAX_VALIDATION_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"at most {MAX_VALIDATION_BATCH_SIZE} items per batch")
+    if validation_requests.locked():
+        raise HTTPException(
+            status_code=429, detail="Too many validation requests, please try again shortly",
+            headers={"Retry-After": "1"})
+    async with validation_requests:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                validation_request_pool, validate_configs_batch, payload)
+        except ValidationOverloaded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+########### Bulk import ###########
+
+
+def parse_import_payload(body: bytes) -> List[Any]:
+    """
+    Parses a JSON array, or JSON lines (one object per line). A line that isn't
+    valid JSON becomes an error message in place of its row, so that the other
+    rows can still be imported.
+    """
+    text_body = body.decode("utf-8")
+    if text_body.lstrip().startswith("["):
+        items = json.loads(text_body)
+        if not isinstance(items, list):
+            raise ValueError("payload must be a JSON array or JSON lines")
+        return items
+    items = []
+    for line in text_body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            items.append(f"invalid JSON: {e}")
+    return items
+
+
+def format_validation_error(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+
+
+async def validate_import_rows(data_points: Dict[int, EditDataPoint]) -> Dict[int, Dict[str, Any]]:
+    """Validates before/after of the rows, MAX_VALIDATION_BATCH_SIZE rows at a time. Returns the failed rows."""
+    failed = {}
+    indices = list(data_points)
+    for start in range(0, len(indices), MAX_VALIDATION_BATCH_SIZE):
+        chunk = indices[start: start + MAX_VALIDATION_BATCH_SIZE]
+        payload = ValidateConfigsBatchPayload(items=[
+            ValidateConfigsPayload(before=data_points[i].before_edit, after=data_points[i].after_edit)
+            for i in chunk
+        ])
+        # Waits for its turn instead of answering 429, the import is already underway
+        async with validation_requests:
+            responses = await asyncio.get_running_loop().run_in_executor(
+                validation_request_pool, validate_configs_batch, payload)
+        for i, response in zip(chunk, responses):
+            if response["validation_error"]:
+                failed[i] = {"error": "unable to validate", "validation": response}
+            elif response["before_errors"] or response["after_errors"]:
+                failed[i] = {"error": "before_edit or after_edit is invalid", "validation": response}
+    return failed
+
+
+@router.post('/api/import_data_points')
+async def import_data_points(
+    request: Request,
+    validate: bool = False,
+    batch_size: int = 100,
+    db: Engine = Depends(get_db),
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    Adds or updates many data points in one call. The body is a JSON array or
+    JSON lines of data points in the format of `/api/add_data_point`; rows with
+    an id update that data point. Rows are checked like in `/api/add_data_point`
+    and, with `validate=true`, their configs are validated (in parallel) first.
+    Valid rows are written `batch_size` rows per transaction. Returns the status
+    of every row, in order: "created", "updated", "invalid" or "error".
+    """
+    editing_user = current_user['email']
+    try:
+        items = parse_import_payload(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid payload: {e}")
+    if len(items) > MAX_IMPORT_ROWS:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_IMPORT_ROWS} rows per import")
+    batch_size = max(1, min(batch_size, MAX_PAGE_SIZE))
+
+    start = time.perf_counter()
+    results: List[Dict[str, Any]] = [
+        {"index": i, "status": "error", "id": item.get("id") if isinstance(item, dict) else None, "error": None}
+        for i, item in enumerate(items)
+    ]
+    data_points: Dict[int, EditDataPoint] = {}
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            results[i]["error"] = item
+            continue
+        if not isinstance(item, dict):
+            results[i]["error"] = "row must be a JSON object"
+            continue
+        try:
+            data_point = EditDataPoint(**{**item, "username": editing_user})
+        except ValidationError as e:
+            results[i]["error"] = format_validation_error(e)
+            continue
+        problem = check_data_point(data_point)
+        if problem is not None:
+            results[i]["error"] = problem
+            continue
+        prepare_data_point(data_point, editing_user)
+        data_points[i] = data_point
+
+    if validate and data_points:
+        try:
+            failed = await validate_import_rows(data_points)
+        except ValidationOverloaded as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+        for i, failure in failed.items():
+            results[i].update(status="invalid", **failure)
+            del data_points[i]
+
+    indices = list(data_points)
+    written = await run_in_threadpool(
+        write_data_points, db, [data_points[i].dict() for i in indices],
+        editing_user, editing_user in get_admin_users(), batch_size)
+    for i, status in zip(indices, written):
+        results[i].update(status)
+    await run_in_threadpool(enqueue_written_instruction_jobs, db, [
+        {**data_points[i].dict(), "id": results[i]["id"]}
+        for i in indices if results[i]["status"] in ("created", "updated") and results[i]["id"]])
+
+    seconds = time.perf_counter() - start
+    counts = {status: sum(r["status"] == status for r in results)
+              for status in ["created", "updated", "invalid", "error"]}
+    print(f"Imported {len(results)} rows for {editing_user} in {seconds:.2f}s "
+          f"({len(results) / max(seconds, 1e-9):.1f} rows/s): {counts}")
+    return {
+        "rows": len(results),
+        **counts,
+        "seconds": seconds,
+        "rows_per_second": len(results) / max(seconds, 1e-9),
+        "results": results,
+    }
@@ -1,18 +1,22 @@
-import anyio
-import difflib
+import json
 from string import Template
+from typing import *
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from kurator.utils import Model, CodexModel, SRC_PATH
+from kurator.llm import AsyncModel, LLMError, LLMTimeout
+from kurator.prompt_budget import NewConfigPrompt, build_new_config_prompt
+from kurator.utils import SRC_PATH
+from kurator.yaml_diff import UNIFIED_DIFF_HEADER, diff_configs
 
 router = APIRouter()
 
 prompt_template = (SRC_PATH/"routes/prompt_template.txt").read_text()
 
-# have to do this ugly thing because anyio.to_thread.run_sync doesn't pass keyword arguments to the function :facepalm:
-CodexModelForInstructions = Model("openai", "code-davinci-002", stop="<<END>>")
+CodexModel = AsyncModel("code-davinci-002", namespace="new_config")
+CodexModelForInstructions = AsyncModel("code-davinci-002", stop="<<END>>", namespace="instructions")
 
 class QueryGPT3Payload(BaseModel):
     before: str
@@ -23,57 +27,171 @@ class QueryGPT3NewConfigPayload(BaseModel):
     change_instruction: str
 
 
+CHANGE_SET_FORMAT_NOTE = (
+    "Format note: The line beginning with `#` names the resource. The lines beginning with `-` are fields "
+    "that have been deleted, the lines beginning with `+` are fields that have been added, and the lines "
+    "beginning with `~` are fields whose value changed from the left to the right of `->`. Fields are written "
+    "as paths into the config, with values as JSON. Fields that are not listed were not changed."
+)
+UNIFIED_DIFF_FORMAT_NOTE = (
+    "Format note: The lines beginning with `-` have been deleted, and the lines beginning with `+` have been added. "
+    "Other lines were not changed."
+)
+
 def get_prompt_for_gpt3(diff):
     # replace the diff
-    prompt = Template(prompt_template).substitute(diff_goes_here=diff)
+    format_note = UNIFIED_DIFF_FORMAT_NOTE if diff.startswith(UNIFIED_DIFF_HEADER) else CHANGE_SET_FORMAT_NOTE
+    prompt = Template(prompt_template).substitute(diff_goes_here=diff, format_note_goes_here=format_note)
     return prompt
 
-async def query_codex(model, prompt, **kwargs):
-    return await anyio.to_thread.run_sync(model.query, prompt, **kwargs)
+async def query_codex(model: AsyncModel, prompt, **kwargs):
+    try:
+        return await model.query(prompt, **kwargs)
+    except LLMTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except LLMError as e:
+        print("LLM query failed:", e)
+        raise HTTPException(status_code=502, detail="Model request failed, please try again")
 
-async def get_instructions_from_gpt3(before: str, after: str):
-    diff = difflib.ndiff(before.splitlines(), after.splitlines())
-    diff = '\n'.join(diff)
+NO_OTHER_CHANGES = "No other changes have been made."
+IMPERATIVE_FORM = "In imperative form:"
+
+
+def get_prompt_for_instructions(before: str, after: str) -> str:
+    return get_prompt_for_gpt3(diff_configs(before, after))
+
+
+def postprocess_instruction(choice: str) -> str:
+    if choice.endswith(NO_OTHER_CHANGES):
+        choice = choice[:-len(NO_OTHER_CHANGES)].strip()
+    if IMPERATIVE_FORM in choice:
+        choice = choice.split(IMPERATIVE_FORM)[1].strip()
+        if choice.startswith("```"):
+            choice = choice[len("```"):]
+        if choice.endswith("```"):
+            choice = choice[:-len("```")].strip()
+    return choice
+
+
+def postprocess_partial_instruction(text: str) -> str:
+    # Holds back a tail that may still turn into one of the markers, so that
+    # the partial result doesn't show text that the final one drops.
+    markers = [NO_OTHER_CHANGES, IMPERATIVE_FORM, "```"]
+    hold = max([k for m in markers for k in range(1, len(m)) if text.endswith(m[:k])], default=0)
+    return postprocess_instruction(text[:len(text) - hold])
 
-    prompt = get_prompt_for_gpt3(diff)
+
+async def get_instructions_from_gpt3(before: str, after: str):
+    prompt = get_prompt_for_instructions(before, after)
     choices = await query_codex(CodexModelForInstructions, prompt)
 
-    processed_responses = []
-    for choice in choices:
-        if choice.endswith("No other changes have been made."):
-            choice = choice[:-len("No other changes have been made.")].strip()
-        if "In imperative form:" in choice:
-            # print(choice)
-            choice = choice.split("In imperative form:")[1].strip()
-            if choice.startswith("```"):
-                choice = choice[len("```"):]
-            if choice.endswith("```"):
-                choice = choice[:-len("```")].strip()
-
-        processed_responses.append(choice)
-    
+    processed_responses = [postprocess_instruction(choice) for choice in choices]
     return processed_responses[0]
 
 
-@router.post('/api/query_gpt3')
-async def query_gpt3(payload: QueryGPT3Payload):
-    return await get_instructions_from_gpt3(payload.before, payload.after)
-
+async def generate_instruction(before: str, after: str) -> str:
+    """For the background jobs (kurator/instruction_jobs.py): raises LLMError instead of HTTPException."""
+    choices = await CodexModelForInstructions.query(get_prompt_for_instructions(before, after))
+    return postprocess_instruction(choices[0])
 
-@router.post('/api/query_gpt3_new_config')
-async def generate_new_config(payload: QueryGPT3NewConfigPayload):
-    # takes in a config and change instructions, and generates a new config
-    before = payload.before
-    instr = payload.change_instruction
 
+def get_prompt_for_new_config(before: str, instr: str) -> str:
     prompt  = "Consider the following Kubernetes configuration:\n\n"
     prompt += "```yaml\n" + before + "\n```\n\n"
     prompt += "Follow the given instructions and generate a new configuration:\n\n"
     prompt += "```\n" + instr + "\n```\n\n"
     prompt += "The new configuration is:\n\n"
     prompt += "```yaml\n"
+    return prompt
 
-    #choices = get_codex_solutions(prompt, stop=["```"], toks=[1500], num_solutions=1)
-    choices = await query_codex(CodexModel, prompt)
 
-    return choices[0]
\ No newline at end of file
+def build_prompt_for_new_config(before: str, instr: str, check_fits: bool = True) -> NewConfigPrompt:
+    prompt = build_new_config_prompt(before, instr, lambda config: get_prompt_for_new_config(config, instr))
+    if check_fits and not prompt.fits:
+        report = prompt.report()
+        raise HTTPException(status_code=413, detail=(
+            f"Config is too large for the model ({report['prompt_tokens']} prompt tokens, "
+            f"{report['context_tokens']} at most including the answer)"))
+    return prompt
+
+
+@router.post('/api/query_gpt3')
+async def query_gpt3(payload: QueryGPT3Payload):
+    return await get_instructions_from_gpt3(payload.before, payload.after)
+
+
+@router.post('/api/query_gpt3_new_config')
+async def generate_new_config(payload: QueryGPT3NewConfigPayload):
+    # takes in a config and change instructions, and generates a new config
+    prompt = build_prompt_for_new_config(payload.before, payload.change_instruction)
+
+    #choices = get_codex_solutions(prompt, stop=["```"], toks=[1500], num_solutions=1)
+    choices = await query_codex(CodexModel, prompt.prompt, max_tokens=prompt.max_tokens)
+
+    return prompt.complete(choices[0])
+
+
+@router.post('/api/query_gpt3_new_config/budget')
+async def new_config_budget(payload: QueryGPT3NewConfigPayload):
+    """How `/api/query_gpt3_new_config` would spend tokens on this payload, without querying the model."""
+    return build_prompt_for_new_config(payload.before, payload.change_instruction, check_fits=False).report()
+
+
+###### Streaming ######
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(
+    chunks: AsyncIterator[str],
+    postprocess: Callable[[str], str] = lambda text: text,
+    postprocess_partial: Callable[[str], str] = lambda text: text,
+) -> AsyncIterator[str]:
+    """
+    Server-sent events for a streamed completion:
+    `delta` appends text, `replace` (when post-processing changed text that was
+    already sent) replaces everything, `done` carries the final post-processed
+    text, and `error` the status and detail that the plain route would answer with.
+    """
+    text, sent = "", ""
+    try:
+        async for chunk in chunks:
+            text += chunk
+            current = postprocess_partial(text)
+            if current.startswith(sent):
+                if len(current) > len(sent):
+                    yield sse_event("delta", {"text": current[len(sent):]})
+            else:
+                yield sse_event("replace", {"text": current})
+            sent = current
+        yield sse_event("done", {"text": postprocess(text)})
+    except LLMTimeout as e:
+        yield sse_event("error", {"status": 504, "detail": str(e)})
+    except LLMError as e:
+        print("LLM query failed:", e)
+        yield sse_event("error", {"status": 502, "detail": "Model request failed, please try again"})
+
+
+def event_stream_response(events: AsyncIterator[str]) -> StreamingResponse:
+    # no buffering in between, every event should reach the browser right away
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post('/api/query_gpt3/stream')
+async def query_gpt3_stream(payload: QueryGPT3Payload):
+    """Streaming variant of `/api/query_gpt3`, see `stream_events` for the events."""
+    prompt = get_prompt_for_instructions(payload.before, payload.after)
+    return event_stream_response(stream_events(
+        CodexModelForInstructions.stream(prompt),
+        postprocess=postprocess_instruction, postprocess_partial=postprocess_partial_instruction))
+
+
+@router.post('/api/query_gpt3_new_config/stream')
+async def generate_new_config_stream(payload: QueryGPT3NewConfigPayload):
+    """Streaming variant of `/api/query_gpt3_new_config`, see `stream_events` for the events."""
+    prompt = build_prompt_for_new_config(payload.before, payload.change_instruction)
+    return event_stream_response(stream_events(
+        CodexModel.stream(prompt.prompt, max_tokens=prompt.max_tokens),
+        postprocess=prompt.complete, postprocess_partial=lambda text: prompt.complete(text, partial=True)))
@@ -0,0 +1,152 @@
+"""
+Search over data points (`/api/search_data_points`): full-text on the
+instruction and the note, by the `kind`/`apiVersion` of the documents in
+their configs, by tag and by user, ranked by relevance and paginated.
+
+- The text search uses the FULLTEXT index on
+  (human_change_instruction, note) in natural language mode.
+- Resource types live in `data_point_resources`, one row per distinct
+  (apiVersion, kind) of a data point. `kurator.dataset.index_data_points`
+  writes them in the transaction that writes the data point, both from
+  `/api/add_data_point` and the bulk import. Data points from before the table are indexed by the
+  backfill job below, which checkpoints in `job_checkpoints` like
+  `kurator.revalidate`.
+- Tags are a JSON list in a text column, matched with LIKE. The app doesn't
+  write tags yet, so this filter isn't indexed.
+
+Usage (from kurator_backend/):
+    python -m kurator.search [--chunk-size N] [--restart]
+"""
+import argparse
+import json
+import time
+from typing import *
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine.base import Engine
+
+from kurator.database import get_engine
+from kurator.dataset import get_checkpoint, index_data_points, save_checkpoint
+
+DEFAULT_JOB_NAME = "search_index"
+SEARCH_COLUMNS = ["id", "username", "human_change_instruction", "note", "tags", "updated_at"]
+FULLTEXT_MATCH = "MATCH (d.human_change_instruction, d.note) AGAINST (:q IN NATURAL LANGUAGE MODE)"
+
+
+###### Search ######
+
+def get_resources(conn, data_point_ids: List[int]) -> Dict[int, List[Dict[str, str]]]:
+    resources: Dict[int, List[Dict[str, str]]] = {i: [] for i in data_point_ids}
+    if not data_point_ids:
+        return resources
+    for row in conn.execute(text(
+        "SELECT data_point_id, api_version, kind FROM data_point_resources WHERE data_point_id IN :ids "
+        "ORDER BY data_point_id, api_version, kind"
+    ).bindparams(bindparam("ids", expanding=True)), {"ids": data_point_ids}):
+        resources[row.data_point_id].append({"apiVersion": row.api_version, "kind": row.kind})
+    return resources
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_data_points(
+    conn,
+    columns: List[str] = SEARCH_COLUMNS,
+    q: Optional[str] = None,
+    kind: Optional[str] = None,
+    api_version: Optional[str] = None,
+    tag: Optional[str] = None,
+    username: Optional[str] = None,
+    offset: int = 0,
+    limit: int = 50,
+) -> List[Dict[str, Any]]:
+    """
+    Data points (not deleted) that match all the given filters. With `q`
+    they are ranked by relevance (`score`), highest first, otherwise and on
+    ties the newest come first. Every result has its `resources`.
+    """
+    select = [f"d.{col}" for col in columns]
+    where = ["d.deleted = False"]
+    params: Dict[str, Any] = {"limit": limit, "offset": offset}
+    if q:
+        select.append(f"{FULLTEXT_MATCH} AS score")
+        where.append(FULLTEXT_MATCH)
+        params["q"] = q
+    if kind is not None or api_version is not None:
+        resource = []
+        if kind is not None:
+            resource.append("r.kind = :kind")
+            params["kind"] = kind
+        if api_version is not None:
+            resource.append("r.api_version = :api_version")
+            params["api_version"] = api_version
+        where.append(f"d.id IN (SELECT r.data_point_id FROM data_point_resources r WHERE {' AND '.join(resource)})")
+    if tag is not None:
+        where.append("d.tags LIKE :tag")
+        params["tag"] = "%" + escape_like(json.dumps(tag)) + "%"
+    if username is not None:
+        where.append("d.username = :username")
+        params["username"] = username
+    order = "score DESC, d.id DESC" if q else "d.id DESC"
+
+    rows = [dict(r._mapping) for r in conn.execute(text(
+        f"SELECT {', '.join(select)} FROM edit_data_points d WHERE {' AND '.join(where)} "
+        f"ORDER BY {order} LIMIT :limit OFFSET :offset"), params)]
+    resources = get_resources(conn, [row["id"] for row in rows])
+    for row in rows:
+        if q:
+            row["score"] = float(row["score"])
+        row["resources"] = resources[row["id"]]
+    return rows
+
+
+###### Backfill ######
+
+def backfill(
+    engine: Engine,
+    chunk_size: int = 500,
+    job_name: str = DEFAULT_JOB_NAME,
+    start_after_id: Optional[int] = None,
+) -> int:
+    """
+    Indexes the resource types of every data point (deleted ones too, so that
+    they are there if the data point is restored). Each chunk is read with
+    shared locks in the transaction that writes its index, so an edit that
+    happens meanwhile is never overwritten with its old configs.
+    """
+    after_id = get_checkpoint(engine, job_name) if start_after_id is None else start_after_id
+    print(f"Indexing data points with id > {after_id}")
+    rows, start = 0, time.time()
+    while True:
+        with engine.begin() as conn:
+            chunk = [dict(r._mapping) for r in conn.execute(text(
+                "SELECT id, before_edit, after_edit FROM edit_data_points WHERE id > :after_id "
+                "ORDER BY id LIMIT :limit FOR SHARE"), {"after_id": after_id, "limit": chunk_size})]
+            if not chunk:
+                break
+            index_data_points(conn, chunk)
+            save_checkpoint(conn, job_name, chunk[-1]["id"])
+        after_id = chunk[-1]["id"]
+        rows += len(chunk)
+        print(f"up to id {after_id}: {rows} rows, {rows / max(time.time() - start, 1e-9):.1f} rows/s")
+        if len(chunk) < chunk_size:
+            break
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the resource types of all data points for search")
+    parser.add_argument("--chunk-size", type=int, default=500, help="rows indexed and checkpointed at a time")
+    parser.add_argument("--job-name", default=DEFAULT_JOB_NAME, help="name of the checkpoint to resume from / save to")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    rows = backfill(get_engine(), chunk_size=args.chunk_size, job_name=args.job_name,
+                    start_after_id=0 if args.restart else None)
+    print(f"Done: {rows} rows indexed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Server-side sessions, replacing Starlette's `SessionMiddleware`, which keeps
+the whole session in a signed cookie that is decoded and HMAC-checked on
+every request.
+
+`ServerSessionMiddleware` only puts a short random id in the cookie. The
+session itself lives in a `SessionStore` and is loaded into `request.session`
+as before, so the routes and Authlib's OAuth state work unchanged. A session
+is written back only when a request changes it (or when it is past half its
+lifetime, to keep it alive), and gets a new id whenever the logged-in user
+changes. Every worker keeps the sessions it loaded for `SESSION_CACHE_TTL`
+seconds, so most requests don't go to the store at all.
+
+With several workers, that cache can be behind the store: a session another
+worker deleted (on logout) or rewrote is still served for up to
+`SESSION_CACHE_TTL` seconds by a worker that had it cached. So the login,
+OAuth and logout routes (`SESSION_UNCACHED_PATHS`) always read the store, and
+a request that changes a cached session re-reads it before writing it back,
+so that a deleted session isn't brought back. Other requests may still see a
+logged-out id as valid until the cache expires; set `SESSION_CACHE_TTL=0` if
+that matters for a multi-worker deployment.
+
+Backends (`SESSION_BACKEND`):
+    memory  a dict per worker process; lost on restart, not shared between workers
+    sqlite  a file in WAL mode shared by all workers (default, `SESSION_PATH`)
+    redis   any Redis-protocol server at `SESSION_REDIS_URL`; needs `pip install redis`
+    cookie  the signed cookie of Starlette's `SessionMiddleware` (`AUTH_SECRET_KEY`)
+"""
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import *
+
+from starlette.config import Config
+from starlette.datastructures import MutableHeaders
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+config = Config()
+
+ROOT_PATH = Path(__file__).parent.parent
+SESSION_BACKENDS = ["memory", "sqlite", "redis", "cookie"]
+
+SESSION_MAX_AGE = config('SESSION_MAX_AGE', cast=int, default=14 * 24 * 3600)  # seconds, as before
+SESSION_COOKIE = config('SESSION_COOKIE', default="kurator_session")
+SESSION_HTTPS_ONLY = config('SESSION_HTTPS_ONLY', cast=bool, default=False)
+SESSION_CACHE_TTL = config('SESSION_CACHE_TTL', cast=float, default=30)
+SESSION_CACHE_SIZE = config('SESSION_CACHE_SIZE', cast=int, default=1024)
+# Path prefixes whose requests always read the session from the store
+SESSION_UNCACHED_PATHS = ("/login", "/auth/", "/logout")
+
+
+class StoredSession(NamedTuple):
+    data: Dict[str, Any]
+    expires_at: float
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(16)
+
+
+class SessionStore:
+    """Interface of the backends. Async, so that network backends don't block the event loop."""
+    backend = "none"
+
+    async def load(self, session_id: str) -> Optional[StoredSession]:
+        return None
+
+    async def save(self, session_id: str, session: StoredSession):
+        pass
+
+    async def delete(self, session_id: str):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    backend = "memory"
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._sessions: OrderedDict[str, StoredSession] = OrderedDict()
+
+    async def load(self, session_id: str) -> Optional[StoredSession]:
+        session = self._sessions.get(session_id)
+        if session is not None and session.expires_at <= time.time():
+            del self._sessions[session_id]
+            return None
+        return session
+
+    async def save(self, session_id: str, session: StoredSession):
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        if len(self._sessions) > self.max_entries:
+            now = time.time()
+            for key in [k for k, s in self._sessions.items() if s.expires_at <= now]:
+                del self._sessions[key]
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    async def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Shared by all workers through the file. Like the LLM cache, the statements run inline."""
+    backend = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT, expires_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    async def load(self, session_id: str) -> Optional[StoredSession]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+                (session_id, time.time())).fetchone()
+        return StoredSession(json.loads(row[0]), row[1]) if row else None
+
+    async def save(self, session_id: str, session: StoredSession):
+        with self._lock:
+            self._db.execute("REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                             (session_id, json.dumps(session.data), session.expires_at))
+            self._db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+    async def delete(self, session_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+
+class RedisSessionStore(SessionStore):
+    """One key per session, expired by Redis."""
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str = "kurator:session:"):
+        # Optional dependency, only needed for this backend
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    async def load(self, session_id: str) -> Optional[StoredSession]:
+        value = await self.redis.get(self.prefix + session_id)
+        if value is None:
+            return None
+        value = json.loads(value)
+        return StoredSession(value["data"], value["expires_at"])
+
+    async def save(self, session_id: str, session: StoredSession):
+        ttl = max(1, int(session.expires_at - time.time()))
+        await self.redis.set(self.prefix + session_id, json.dumps(session._asdict()), ex=ttl)
+
+    async def delete(self, session_id: str):
+        await self.redis.delete(self.prefix + session_id)
+
+
+def create_session_store(backend: str) -> SessionStore:
+    assert backend in SESSION_BACKENDS, f"SESSION_BACKEND must be one of {SESSION_BACKENDS}"
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(config('SESSION_PATH', cast=Path, default=ROOT_PATH / "sessions.db"))
+    if backend == "redis":
+        return RedisSessionStore(config('SESSION_REDIS_URL', default="redis://localhost:6379/0"))
+    return SessionStore()
+
+
+@lru_cache(maxsize=None)
+def get_session_store() -> SessionStore:
+    # Created (and the SQLite file opened) on first use, not at import
+    return create_session_store(config('SESSION_BACKEND', default="sqlite"))
+
+
+class ServerSessionMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        store: Optional[SessionStore] = None,
+        session_cookie: str = SESSION_COOKIE,
+        max_age: int = SESSION_MAX_AGE,
+        https_only: bool = SESSION_HTTPS_ONLY,
+        cache_ttl: float = SESSION_CACHE_TTL,
+        cache_size: int = SESSION_CACHE_SIZE,
+        uncached_paths: Sequence[str] = SESSION_UNCACHED_PATHS,
+    ):
+        self.app = app
+        self.store = store if store is not None else get_session_store()
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.security_flags = "httponly; samesite=lax" + ("; secure" if https_only else "")
+        # A memory store is already local to the worker
+        self.cache_ttl = cache_ttl if self.store.backend != "memory" else 0
+        self.cache_size = cache_size
+        self.uncached_paths = tuple(uncached_paths)
+        # session id -> (session, cached until)
+        self._cache: OrderedDict[str, Tuple[StoredSession, float]] = OrderedDict()
+        self.cache_hits = 0
+        self.store_loads = 0
+
+    def cached(self, session_id: str) -> Optional[StoredSession]:
+        cached = self._cache.get(session_id)
+        if cached is not None and cached[1] > time.time():
+            self.cache_hits += 1
+            return cached[0]
+        return None
+
+    async def load(self, session_id: str) -> Optional[StoredSession]:
+        self.store_loads += 1
+        session = await self.store.load(session_id)
+        if session is None:
+            self._cache.pop(session_id, None)
+        else:
+            self.remember(session_id, session)
+        return session
+
+    def remember(self, session_id: str, session: StoredSession):
+        if self.cache_ttl <= 0:
+            return
+        self._cache[session_id] = (session, min(time.time() + self.cache_ttl, session.expires_at))
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def save(self, session_id: str, data: Dict[str, Any]):
+        session = StoredSession(data, time.time() + self.max_age)
+        await self.store.save(session_id, session)
+        self.remember(session_id, session)
+
+    async def delete(self, session_id: str):
+        self._cache.pop(session_id, None)
+        await self.store.delete(session_id)
+
+    def cookie_header(self, session_id: Optional[str]) -> str:
+        if session_id is None:
+            return f"{self.session_cookie}=null; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}"
+        return f"{self.session_cookie}={session_id}; path=/; Max-Age={self.max_age}; {self.security_flags}"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        session_id = HTTPConnection(scope).cookies.get(self.session_cookie)
+        use_cache = not scope.get("path", "").startswith(self.uncached_paths)
+        stored = self.cached(session_id) if session_id and use_cache else None
+        from_cache = stored is not None
+        if session_id and stored is None:
+            stored = await self.load(session_id)
+        initial = stored.data if stored is not None else {}
+        # A copy, so that the cached session isn't changed in place
+        scope["session"] = json.loads(json.dumps(initial)) if initial else {}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                new_id = await self.commit(session_id, stored, scope["session"], from_cache)
+                if new_id is not False:
+                    MutableHeaders(scope=message).append("Set-Cookie", self.cookie_header(new_id))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def commit(self, session_id: Optional[str], stored: Optional[StoredSession],
+                     session: Dict[str, Any], from_cache: bool = False) -> Union[str, None, bool]:
+        """Writes the session back if needed. Returns the id for the cookie, None to delete it, False to leave it."""
+        initial = stored.data if stored is not None else {}
+        if from_cache and session != initial and await self.load(session_id) is None:
+            # deleted by another worker meanwhile (logout); don't bring it back
+            return None
+        if not session:
+            if stored is not None:
+                await self.delete(session_id)
+            # also clears cookies of sessions that expired or are unknown
+            return None if session_id else False
+        if stored is not None and session == initial:
+            if stored.expires_at - time.time() > self.max_age / 2:
+                return False
+            await self.save(session_id, session)
+            return session_id
+        if stored is None or session.get("user") != initial.get("user"):
+            # a new id on login and logout, so that an id from before can't be reused
+            if stored is not None:
+                await self.delete(session_id)
+            session_id = new_session_id()
+        await self.save(session_id, session)
+        return session_id
+
+
+def add_session_middleware(app):
+    backend = config('SESSION_BACKEND', default="sqlite")
+    if backend == "cookie":
+        app.add_middleware(SessionMiddleware, secret_key=config.environ["AUTH_SECRET_KEY"],
+                           max_age=SESSION_MAX_AGE, https_only=SESSION_HTTPS_ONLY)
+    else:
+        app.add_middleware(ServerSessionMiddleware)
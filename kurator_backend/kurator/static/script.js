@@ -56,6 +56,51 @@ function replaceEditorValueKeepingStack(editor, newText) {
         'gpt3', [{ identifier: 'insert', range: new monaco.Range(1, 1, 1, 1), text: newText, forceMoveMarkers: true }]);
 }
 
+/**************************************************************************
+ * GPT-3 - streaming
+ *************************************************************************/
+
+// POSTs to one of the `/stream` routes and calls onText with the text so far
+// whenever server-sent events come in. Returns an error message, or null.
+async function streamCompletion(url, body, onText) {
+    var response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body)
+    });
+    if (!response.ok) {
+        return response.status;
+    }
+
+    var reader = response.body.getReader();
+    var decoder = new TextDecoder();
+    var buffer = "";
+    var text = "";
+    while (true) {
+        var { done, value } = await reader.read();
+        if (done) {
+            return null;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        var events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (var event of events) {
+            var name = event.match(/^event: (.*)$/m)[1];
+            var data = JSON.parse(event.match(/^data: (.*)$/m)[1]);
+            if (name === "delta") {
+                text += data.text;
+            } else if (name === "replace" || name === "done") {
+                text = data.text;
+            } else if (name === "error") {
+                return data.status + " " + data.detail;
+            }
+            onText(text);
+        }
+    }
+}
+
 /**************************************************************************
  * GPT-3 - for suggestion instructions
  *************************************************************************/
@@ -68,21 +113,12 @@ async function load_completion() {
 
     $id("spinner").style.display = "inline-block";
 
-    var response = await fetch('/api/query_gpt3', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            before: originalModel.getValue(),
-            after: modifiedModel.getValue()
-        })
-    })
-    if (response.ok) {
-        var data = await response.json();
-        replaceEditorValueKeepingStack(changeInstructionEditor, data);
-    } else {
-        replaceEditorValueKeepingStack(changeInstructionEditor, "Error: " + response.status);
+    var error = await streamCompletion('/api/query_gpt3/stream', {
+        before: originalModel.getValue(),
+        after: modifiedModel.getValue()
+    }, text => replaceEditorValueKeepingStack(changeInstructionEditor, text));
+    if (error) {
+        replaceEditorValueKeepingStack(changeInstructionEditor, "Error: " + error);
     }
 
     $id("spinner").style.display = "none";
@@ -103,22 +139,12 @@ async function load_new_config() {
 
     $id("spinner").style.display = "inline-block";
 
-    var response = await fetch('/api/query_gpt3_new_config', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            before: originalModel.getValue(),
-            change_instruction: changeInstructionEditor.getValue()
-        })
-    });
-
-    if (response.ok) {
-        var data = await response.json();
-        replaceEditorValueKeepingStack(diffEditor._modifiedEditor, data);
-    } else {
-        replaceEditorValueKeepingStack(diffEditor._modifiedEditor, "Error: " + response.status);
+    var error = await streamCompletion('/api/query_gpt3_new_config/stream', {
+        before: originalModel.getValue(),
+        change_instruction: changeInstructionEditor.getValue()
+    }, text => replaceEditorValueKeepingStack(diffEditor._modifiedEditor, text));
+    if (error) {
+        replaceEditorValueKeepingStack(diffEditor._modifiedEditor, "Error: " + error);
     }
 
     $id("spinner").style.display = "none";
@@ -168,16 +194,58 @@ $id('gpt3-suggest-conf-btn').addEventListener('click', load_new_config);
  * Data Selector
  *************************************************************************/
 
-async function loadDataPoints() {
-    var response = await fetch('/api/get_data_points', {
+// the dropdown only needs these, full configs are fetched when a data point is selected
+const BROWSE_FIELDS = 'id,username,human_change_instruction,updated_at';
+const BROWSE_PAGE_SIZE = 500;
+
+async function fetchDataPointSummaries() {
+    var summaries = [];
+    var afterId = null;
+    while (true) {
+        var url = '/api/get_data_points?fields=' + BROWSE_FIELDS + '&limit=' + BROWSE_PAGE_SIZE;
+        if (afterId !== null) {
+            url += '&after_id=' + afterId;
+        }
+        var response = await fetch(url, {
+            method: 'GET',
+            headers: {
+                'Content-Type': 'application/json'
+            }
+        })
+        if (!response.ok) {
+            return response;
+        }
+        summaries = summaries.concat(await response.json());
+        afterId = response.headers.get('X-Next-Cursor');
+        if (afterId === null) {
+            return summaries;
+        }
+    }
+}
+
+async function showDataPoint(key) {
+    var response = await fetch('/api/get_data_point/' + dataPoints[key]['id'], {
         method: 'GET',
         headers: {
             'Content-Type': 'application/json'
         }
     })
-    if (response.ok) {
+    if (!response.ok) {
+        alert("Error loading data point: " + response.status + " " + response.text());
+        return;
+    }
+    var dataPoint = await response.json();
+    replaceEditorValueKeepingStack(diffEditor._originalEditor, dataPoint['before_edit']);
+    replaceEditorValueKeepingStack(diffEditor._modifiedEditor, dataPoint['after_edit']);
+    replaceEditorValueKeepingStack(changeInstructionEditor, dataPoint['human_change_instruction']);
+    replaceEditorValueKeepingStack(noteEditor, dataPoint['note'] || '');
+}
+
+async function loadDataPoints() {
+    var result = await fetchDataPointSummaries();
+    if (Array.isArray(result)) {
         var isBrandNew = dataPoints.length === 0;
-        dataPoints = await response.json();
+        dataPoints = result;
         var select = $id('data-selector');
         var selectedDataPoint = select.value;
         select.innerHTML = '<option value="-1">Select a data point</option>';
@@ -192,10 +260,7 @@ async function loadDataPoints() {
             select.addEventListener('change', function () {
                 var key = select.value;
                 if (key != -1) {
-                    replaceEditorValueKeepingStack(diffEditor._originalEditor, dataPoints[key]['before_edit']);
-                    replaceEditorValueKeepingStack(diffEditor._modifiedEditor, dataPoints[key]['after_edit']);
-                    replaceEditorValueKeepingStack(changeInstructionEditor, dataPoints[key]['human_change_instruction']);
-                    replaceEditorValueKeepingStack(noteEditor, dataPoints[key]['note'] || '');
+                    showDataPoint(key);
                 }
             });
         }
@@ -208,7 +273,7 @@ async function loadDataPoints() {
         select.dispatchEvent(new Event('change'));
 
     } else {
-        alert("Error loading data points: " + response.status + " " + response.text());
+        alert("Error loading data points: " + result.status + " " + result.text());
     }
 }
 
@@ -218,6 +283,13 @@ loadDataPoints();
  * Validate config
  *************************************************************************/
 
+function formatValidationErrors(errors, error) {
+    if (!errors || errors.length === 0) {
+        return error || "Valid";
+    }
+    return errors.map(e => (e.doc_index === null ? "" : "Document " + (e.doc_index + 1) + ": ") + e.error).join("\n");
+}
+
 async function validate_configs(submitFlow=false) {
     var response = await fetch('/api/validate_configs', {
         method: 'POST',
@@ -226,15 +298,16 @@ async function validate_configs(submitFlow=false) {
         },
         body: JSON.stringify({
             before: originalModel.getValue(),
-            after: modifiedModel.getValue()
+            after: modifiedModel.getValue(),
+            all_errors: true
         })
     })
     if (response.ok) {
         var data = await response.json();
         if (data.before_error || data.after_error) {
             //alert("Config(s) are invalid. Error: " + JSON.stringify(data));
-            before_error = data.before_error || "Valid";
-            after_error = data.after_error || "Valid";
+            before_error = formatValidationErrors(data.before_errors, data.before_error);
+            after_error = formatValidationErrors(data.after_errors, data.after_error);
 
             if (!submitFlow) {
                 $id("errorModalBody").innerHTML = "Config(s) are invalid. Error:<br><br><code style='white-space: pre-wrap'><b>Original Config:</b>\n" + before_error + "\n\n<b>Modified Config:</b>\n" + after_error + "</code>";
@@ -266,6 +339,8 @@ async function validate_configs(submitFlow=false) {
         } else {
             return true;
         }
+    } else if (response.status === 429 || response.status === 503) {
+        alert("The server is busy validating other configs. Please try again in a few seconds.");
     } else {
         alert("Error while validating configs: " + response.status + " " + response.text());
     }
@@ -1,28 +1,75 @@
-import difflib
-import os
 import subprocess
-import pandas as pd
-import openai
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 import yaml
-from manifest import Manifest
 from fastcore.basics import *
-from fastcore.meta import delegates
 from starlette.config import Config
 
+import kurator.jsonschema_validator as jsonschema_validator
+from kurator.crd_schemas import (
+    ensure_json_schema, get_crd_info_index, get_crd_info_row,
+    get_json_schema_file_name_for_crd, get_json_schema_file_name_for_row,
+    unzip_community_operators_if_needed,
+)
+from kurator.llm import backoff_delay
+from kurator.validation_cache import validation_cache
+from kurator.yaml_diff import diff_configs
+
 from pathlib import Path
 from typing import *
 
 SRC_PATH = Path(__file__).parent
 ROOT_PATH = SRC_PATH.parent
 
-df_crd_info = pd.read_csv(ROOT_PATH / "crd_info.csv")
+# "jsonschema" validates CRDs in-process, "kubeconform" shells out for every document.
+# Inbuilt kinds (Deployment, Service, ...) are always validated by kubeconform.
+VALIDATION_BACKENDS = ["jsonschema", "kubeconform"]
+VALIDATION_BACKEND = Config()('VALIDATION_BACKEND', default="jsonschema")
+assert VALIDATION_BACKEND in VALIDATION_BACKENDS, f"VALIDATION_BACKEND must be one of {VALIDATION_BACKENDS}"
+
+# Documents are validated on a pool shared by all requests. A single request
+# never has more than VALIDATION_MAX_DOCS_IN_FLIGHT documents on the pool, so a
+# huge multi-document paste can't hog all the workers.
+VALIDATION_WORKERS = Config()('VALIDATION_WORKERS', cast=int, default=8)
+VALIDATION_MAX_DOCS_IN_FLIGHT = Config()('VALIDATION_MAX_DOCS_IN_FLIGHT', cast=int, default=4)
+validation_pool = ThreadPoolExecutor(max_workers=VALIDATION_WORKERS, thread_name_prefix="validation")
+
+# Caps the number of kubeconform processes and schema generations running at
+# once across all requests. Callers that can't get a slot within
+# VALIDATION_SLOT_TIMEOUT seconds fail with `ValidationOverloaded`.
+MAX_VALIDATION_SUBPROCESSES = Config()('MAX_VALIDATION_SUBPROCESSES', cast=int, default=4)
+VALIDATION_SLOT_TIMEOUT = Config()('VALIDATION_SLOT_TIMEOUT', cast=float, default=10)
+validation_subprocess_slots = threading.BoundedSemaphore(MAX_VALIDATION_SUBPROCESSES)
+
+
+class ValidationOverloaded(Exception):
+    pass
+
+
+@contextmanager
+def validation_subprocess_slot():
+    if not validation_subprocess_slots.acquire(timeout=VALIDATION_SLOT_TIMEOUT):
+        raise ValidationOverloaded("Too many validations in progress, please try again shortly")
+    try:
+        yield
+    finally:
+        validation_subprocess_slots.release()
 
 
 ###### Model ######
 
+# openai and manifest take most of a second to import, and only scripts use
+# `Model` (the routes use kurator.llm), so both are imported on first use.
+
 def load_gpt3_creds():
+    import openai
+
     config = Config()
     openai.api_key = config.environ['OPENAI_API_KEY']
+    return openai.api_key
 
 class Model():
     def __init__(
@@ -36,6 +83,8 @@ class Model():
         stop = ["```"],
         use_cache = True,
     ):
+        from manifest import Manifest
+
         store_attr()
 
         supported_providers = ["openai"]
@@ -49,8 +98,7 @@ class Model():
             args["cache_connection"] = ROOT_PATH/"manifest_cache.db"
 
         if model_provider == "openai":
-            load_gpt3_creds()
-            args["client_connection"] = openai.api_key
+            args["client_connection"] = load_gpt3_creds()
             args["engine"] = model_name
             args["n"] = n
             args["top_k_return"] = n
@@ -62,8 +110,8 @@ class Model():
         self.M = Manifest(**args)
         self.rate_limit = 150000
     
-    @delegates(Manifest.run)
     def query(self, prompt: str, debug: bool=False, **kwargs) -> List[str]:
+        # kwargs are passed on to Manifest.run
         if "n" in kwargs and "top_k_return" not in kwargs and self.model_provider == "openai":
             kwargs["top_k_return"] = kwargs["n"]
 
@@ -91,45 +139,26 @@ class Model():
                 print(e)
                 tries_left -= 1
                 n = max(n // 2, 1)
+                if tries_left > 0:
+                    time.sleep(backoff_delay(4 - tries_left))
                 continue
         
         return results
 
-CodexModel = Model("openai", "code-davinci-002")
+@lru_cache(maxsize=None)
+def get_codex_model() -> Model:
+    return Model("openai", "code-davinci-002")
 
-###### Validation ######
-
-def get_crd_info_row(crd_api_version: str, crd_name: str):
-    crd_info_rows = df_crd_info[
-        (df_crd_info.crd_name == crd_name) &
-        (df_crd_info.api_version == crd_api_version)
-    ].to_dict(orient='records')
-    # pick the one with latest version
-    crd_info_row = sorted(crd_info_rows, key=lambda x: tuple(map(int, x['version'].split('.'))), reverse=True)[0]
-    return crd_info_row
-
-def get_json_schema_file_name_for_crd(crd_api_version: str, crd_name: str) -> Path:
-    crd_info_row = get_crd_info_row(crd_api_version, crd_name)
-    crd_operator = crd_info_row['operator']
-    crd_kind = crd_info_row['crd_name']
-    operator_version = crd_info_row['version']
-    crd_api_version = crd_info_row['api_version'].split("/")[1]
-    
-    crd_schemas_path = ROOT_PATH / "crd_schemas"
-    return crd_schemas_path / f"{crd_operator}/{operator_version}/{crd_kind.lower()}_{crd_api_version}.json"
-
-
-def unzip_community_operators_if_needed():
-    community_operators_path = ROOT_PATH / "community-operators"
-    if community_operators_path.exists():
-        return
-
-    community_operators_zip_path = ROOT_PATH / "community-operators.zip"
-    assert community_operators_zip_path.exists(), "community-operators.zip does not exist. Check if installation was proper."
+def __getattr__(name):
+    # `CodexModel` is built on first access instead of at import
+    if name == "CodexModel":
+        return get_codex_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    subprocess.run(["unzip", "-o", community_operators_zip_path, "-d", ROOT_PATH], check=True)
+###### Validation ######
 
-def validate_single_doc(config_doc: Dict, ignore_schema_not_found: bool = False) -> Optional[str]:
+def validate_single_doc(config_doc: Dict, ignore_schema_not_found: bool = False, backend: Optional[str] = None) -> Optional[str]:
+    backend = backend or VALIDATION_BACKEND
     if len(config_doc) == 0:
         # empty config is valid
         return ""
@@ -141,57 +170,75 @@ def validate_single_doc(config_doc: Dict, ignore_schema_not_found: bool = False)
     if "apiVersion" not in config_doc:
         return "No `apiVersion` specified"
     crd_api_version = config_doc['apiVersion']
+
+    if not isinstance(crd_kind, str) or not isinstance(crd_api_version, str):
+        return "`kind` and `apiVersion` must be strings"
     
     assume_inbuilt = False
     crd_json_path = None
-    try:
-        crd_json_path = get_json_schema_file_name_for_crd(crd_api_version, crd_kind)
-    except Exception as e:
+    crd_info_row = get_crd_info_index().get((crd_api_version, crd_kind))
+    if crd_info_row is None:
         assume_inbuilt = True
-    
-    if crd_json_path and not crd_json_path.exists():
-        crd_json_path.parent.mkdir(parents=True, exist_ok=True)
-        # run openapi2jsonschema to generate the schema
-        crd_info_row = get_crd_info_row(crd_api_version, crd_kind)
-        crd_yaml_path = crd_info_row['crd_path']
-        crd_yaml_path = ROOT_PATH / crd_yaml_path
-        if not crd_yaml_path.exists():
-            # check if community-operators is already extracted
-            unzip_community_operators_if_needed()
-            assert crd_yaml_path.exists(), f"CRD yaml path {crd_yaml_path} does not exist"
-            
-        env = os.environ.copy()
-        env["FILENAME_FORMAT"] = "{kind}_{version}"
-        result = subprocess.run(
-            ["python3", str(SRC_PATH/"openapi2jsonschema.py"), str(crd_yaml_path)], cwd=str(crd_json_path.parent), env=env,
-            capture_output=True, text=True
-        )
-        if result.returncode != 0:
-            print(result.stderr)
+    else:
+        try:
+            crd_json_path = get_json_schema_file_name_for_row(crd_info_row)
+            if not crd_json_path.exists():
+                with validation_subprocess_slot():
+                    crd_json_path = ensure_json_schema(crd_info_row)
+        except RuntimeError as e:
             return "Failed to generate schema for CRD"
-        assert crd_json_path.exists(), f"Schema file not generated: {crd_json_path}"
     
+    cache_key = None
+    if validation_cache.enabled:
+        cache_key = validation_cache.make_key(config_doc, crd_json_path, backend, ignore_schema_not_found)
+        found, error = validation_cache.get(cache_key)
+        if found:
+            return error
+
+    if assume_inbuilt or backend == "kubeconform":
+        error, is_verdict = run_kubeconform(config_doc, crd_json_path, ignore_schema_not_found)
+    else:
+        error, is_verdict = jsonschema_validator.validate_doc(config_doc, crd_json_path), True
+
+    # a schema that couldn't be fetched may be there next time
+    if cache_key is not None and is_verdict:
+        validation_cache.put(cache_key, error)
+    return error
+
+
+def validate_single_doc_kubeconform(config_doc: Dict, crd_json_path: Optional[Path] = None, ignore_schema_not_found: bool = False) -> Optional[str]:
+    return run_kubeconform(config_doc, crd_json_path, ignore_schema_not_found)[0]
+
+
+def run_kubeconform(config_doc: Dict, crd_json_path: Optional[Path] = None, ignore_schema_not_found: bool = False) -> Tuple[Optional[str], bool]:
+    """
+    Returns the error (None if valid) and whether it is kubeconform's verdict
+    on the document, rather than a schema it couldn't find or download, or a
+    failure to run at all. Only verdicts are worth caching.
+    """
     # run kubeconfirm to validate the config
-    if assume_inbuilt:
+    if crd_json_path is None:
         cache_path = ROOT_PATH/"crd_schemas/inbuilt_crd_cache"
         cache_path.mkdir(parents=True, exist_ok=True)
         cmd = ["kubeconform", "-strict", "-cache", str(cache_path)]
     else:
         cmd = ["kubeconform", "-strict", "-schema-location", str(crd_json_path)]
     print(" ".join(cmd))
-    validation_result = subprocess.run(
-        cmd,
-        input=yaml.dump(config_doc).encode('utf-8'),
-        capture_output=True,
-    )
+    with validation_subprocess_slot():
+        validation_result = subprocess.run(
+            cmd,
+            input=yaml.dump(config_doc).encode('utf-8'),
+            capture_output=True,
+        )
     if validation_result.returncode != 0:
         error = validation_result.stdout.decode('utf-8')
         if error.startswith("stdin - "):
             error = error[len("stdin - "):]
         if "Could not find schema for" in error and ignore_schema_not_found:
-            return None
-        return error
-    return None
+            return None, False
+        # otherwise "... failed validation: <why it couldn't validate>", or nothing on stdout
+        return error, " is invalid: " in error
+    return None, True
 
 
 def validate_config(config_s: str) -> Optional[str]:
@@ -209,8 +256,62 @@ def validate_config(config_s: str) -> Optional[str]:
             return error    
     return None
 
+
+class DocumentError(NamedTuple):
+    # None if the error isn't specific to one document (e.g. invalid YAML)
+    doc_index: Optional[int]
+    error: str
+
+
+def validate_configs_all_docs(configs_s: List[str], max_in_flight: Optional[int] = None) -> List[Union[List[DocumentError], BaseException]]:
+    """
+    Validates all documents of all the given configs concurrently on
+    `validation_pool`, and returns every error instead of only the first one.
+    For each config, returns either its errors ordered by document index or the
+    exception raised while validating it.
+    """
+    max_in_flight = max_in_flight or VALIDATION_MAX_DOCS_IN_FLIGHT
+    results: List[Union[List[DocumentError], BaseException]] = []
+    tasks = []
+    for i, config_s in enumerate(configs_s):
+        try:
+            docs = list(yaml.load_all(config_s, Loader=yaml.SafeLoader))
+        except Exception as e:
+            results.append([DocumentError(None, "Invalid YAML?")])
+            continue
+        results.append([])
+        tasks.extend((i, doc_index, doc) for doc_index, doc in enumerate(docs) if doc is not None)
+
+    # Submit at most `max_in_flight` documents at a time
+    pending = {}
+    tasks_iter = iter(tasks)
+    while True:
+        for i, doc_index, doc in tasks_iter:
+            pending[validation_pool.submit(validate_single_doc, doc)] = (i, doc_index)
+            if len(pending) >= max_in_flight:
+                break
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            i, doc_index = pending.pop(future)
+            if isinstance(results[i], BaseException):
+                continue
+            try:
+                error = future.result()
+            except Exception as e:
+                results[i] = e
+                continue
+            # "" means the document is empty, which is valid
+            if error:
+                results[i].append(DocumentError(doc_index, error))
+
+    for errors in results:
+        if isinstance(errors, list):
+            errors.sort(key=lambda e: -1 if e.doc_index is None else e.doc_index)
+    return results
+
 ###### Misc ######
 
 def get_diff(a: str, b: str) -> str:
-    diff = difflib.ndiff(a.splitlines(), b.splitlines())
-    return "\n".join(diff)
+    return diff_configs(a, b)
@@ -0,0 +1,148 @@
+"""
+Cache of validation results, keyed on the content of the (parsed) document and
+of the schema it is validated against. An edited schema therefore never serves
+stale results, and the whole cache is dropped when `crd_schemas/` is rebuilt
+(i.e. the build id in `crd_schemas/manifest.json` changes).
+
+The in-memory tier is an LRU. Optionally, results are also kept in an SQLite
+file (`VALIDATION_CACHE_DISK`), which survives restarts and is shared by all
+workers.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import *
+
+from starlette.config import Config
+
+from kurator.crd_schemas import MANIFEST_PATH, sha256_file
+
+config = Config()
+
+# Inbuilt kinds are validated against kubeconform's (versioned) schema registry
+INBUILT_SCHEMA_HASH = "inbuilt"
+
+
+class ValidationCache:
+    def __init__(self, max_entries: int = 10000, disk_path: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self._entries: OrderedDict[str, Optional[str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._schema_hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._manifest_mtime_ns: Optional[int] = None
+        self._build_id: Optional[str] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._db = None
+        if disk_path is not None:
+            disk_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(disk_path), check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def schema_hash(self, schema_path: Optional[Path]) -> str:
+        if schema_path is None:
+            return INBUILT_SCHEMA_HASH
+        st = schema_path.stat()
+        cached = self._schema_hashes.get(str(schema_path))
+        if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+            cached = (st.st_mtime_ns, st.st_size, sha256_file(schema_path))
+            self._schema_hashes[str(schema_path)] = cached
+        return cached[2]
+
+    def make_key(self, config_doc: Dict, schema_path: Optional[Path], *extra: Any) -> str:
+        # Normalized, so that formatting/key order changes in the YAML don't matter
+        doc = json.dumps(config_doc, sort_keys=True, separators=(",", ":"), default=str)
+        h = hashlib.sha256(doc.encode("utf-8"))
+        h.update(b"\0" + self.schema_hash(schema_path).encode())
+        h.update(b"\0" + json.dumps(extra).encode())
+        return h.hexdigest()
+
+    def check_build(self):
+        """Drops everything if crd_schemas/ has been rebuilt since we last looked."""
+        try:
+            mtime_ns = MANIFEST_PATH.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if mtime_ns == self._manifest_mtime_ns:
+            return
+        self._manifest_mtime_ns = mtime_ns
+        build_id = json.loads(MANIFEST_PATH.read_text()).get("build_id") if mtime_ns else None
+        if self._db is not None and self._build_id is None:
+            # first check after startup: the disk tier may predate the current build
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'build_id'").fetchone()
+            self._build_id = row[0] if row else None
+        if build_id != self._build_id:
+            self.clear()
+            self._build_id = build_id
+            if self._db is not None:
+                self._db.execute("REPLACE INTO meta (name, value) VALUES ('build_id', ?)", (build_id,))
+
+    def get(self, key: str) -> Tuple[bool, Optional[str]]:
+        with self._lock:
+            self.check_build()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    result = json.loads(row[0])
+                    self._put_memory(key, result)
+                    return True, result
+            self.misses += 1
+            return False, None
+
+    def _put_memory(self, key: str, result: Optional[str]):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, result: Optional[str]):
+        with self._lock:
+            self._put_memory(key, result)
+            if self._db is not None:
+                self._db.execute("REPLACE INTO results (key, result) VALUES (?, ?)", (key, json.dumps(result)))
+
+    def clear(self):
+        self._entries.clear()
+        self._schema_hashes.clear()
+        self.invalidations += 1
+        if self._db is not None:
+            self._db.execute("DELETE FROM results")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "disk_path": str(self.disk_path) if self.disk_path else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "build_id": self._build_id,
+        }
+
+
+_disk_path = config('VALIDATION_CACHE_DISK', default="")
+validation_cache = ValidationCache(
+    max_entries=config('VALIDATION_CACHE_SIZE', cast=int, default=10000),
+    disk_path=Path(_disk_path) if _disk_path else None,
+)
@@ -0,0 +1,264 @@
+"""
+Structure-aware diff of two YAML configs, used for the GPT-3 prompts and
+`utils.get_diff`.
+
+Both sides are parsed and compared as data, so reordered keys, re-indented
+blocks and comments don't show up. The result is one line per change, with
+the path to the changed value, under a line naming the document:
+
+    # RabbitmqCluster/test-cluster
+    ~ spec.replicas: 2 -> 3
+    + spec.persistence: {"storage": "50Gi"}
+    - spec.affinity: {"podAntiAffinity": ...}
+
+Documents of a multi-document config are matched on kind, namespace and name
+(falling back to their position). Lists of objects with a `name` (containers,
+env, ports, ...) are matched on it (`containers[name=web].image`); other lists
+are aligned like lines of text (`args[2]`). Configs that don't parse, or that
+differ only in formatting, get a unified diff instead.
+
+Results are memoized on the hash of the two configs, since the same pair is
+diffed for every completion that is asked for.
+"""
+import difflib
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import *
+
+import yaml
+from starlette.config import Config
+
+config = Config()
+
+DIFF_CACHE_SIZE = config('DIFF_CACHE_SIZE', cast=int, default=256)
+
+ADDED = "+"
+REMOVED = "-"
+CHANGED = "~"
+
+# Keys that can be written after a dot without quoting
+PLAIN_KEY = re.compile(r"^[A-Za-z_$][\w$-]*$")
+
+_MISSING = object()
+
+
+class Change(NamedTuple):
+    op: str
+    path: str
+    old: Any = None
+    new: Any = None
+
+
+###### Formatting ######
+
+def format_key(path: str, key: Any) -> str:
+    if isinstance(key, str) and PLAIN_KEY.match(key):
+        return f"{path}.{key}" if path else key
+    return f"{path}[{json.dumps(key, default=str)}]"
+
+
+def format_value(value: Any) -> str:
+    # JSON is valid flow-style YAML and stays on one line. Strings are always
+    # quoted, so that "2" -> 2 doesn't read as no change.
+    return json.dumps(value, default=str)
+
+
+def format_change(change: Change) -> str:
+    # The path is empty for a whole document
+    prefix = f"{change.op} {change.path}: " if change.path else f"{change.op} "
+    if change.op == CHANGED:
+        return f"{prefix}{format_value(change.old)} -> {format_value(change.new)}"
+    return prefix + format_value(change.new if change.op == ADDED else change.old)
+
+
+###### Comparison ######
+
+def canonical(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def named_items(items: List[Any]) -> Optional[Dict[str, Any]]:
+    """{name: item} if every item is an object with a distinct `name`, else None."""
+    if not items or not all(isinstance(i, dict) and isinstance(i.get("name"), str) for i in items):
+        return None
+    named = {i["name"]: i for i in items}
+    return named if len(named) == len(items) else None
+
+
+def diff_values(path: str, old: Any, new: Any, changes: List[Change]):
+    if isinstance(old, dict) and isinstance(new, dict):
+        diff_dicts(path, old, new, changes)
+    elif isinstance(old, list) and isinstance(new, list):
+        diff_lists(path, old, new, changes)
+    elif old != new or type(old) != type(new):
+        changes.append(Change(CHANGED, path, old, new))
+
+
+def diff_dicts(path: str, old: Dict, new: Dict, changes: List[Change]):
+    for key, value in old.items():
+        if key not in new:
+            changes.append(Change(REMOVED, format_key(path, key), old=value))
+        else:
+            diff_values(format_key(path, key), value, new[key], changes)
+    for key, value in new.items():
+        if key not in old:
+            changes.append(Change(ADDED, format_key(path, key), new=value))
+
+
+def diff_lists(path: str, old: List, new: List, changes: List[Change]):
+    old_named, new_named = named_items(old), named_items(new)
+    if old_named is not None and new_named is not None:
+        diff_dicts_by_name(path, old_named, new_named, changes)
+        return
+
+    # Align the items like lines of text, so that an insertion doesn't shift everything after it
+    matcher = difflib.SequenceMatcher(None, [canonical(i) for i in old], [canonical(i) for i in new], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        paired = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+        for k in range(paired):
+            diff_values(f"{path}[{i1 + k}]", old[i1 + k], new[j1 + k], changes)
+        for k in range(i1 + paired, i2):
+            changes.append(Change(REMOVED, f"{path}[{k}]", old=old[k]))
+        for k in range(j1 + paired, j2):
+            changes.append(Change(ADDED, f"{path}[{k}]", new=new[k]))
+
+
+def diff_dicts_by_name(path: str, old: Dict[str, Any], new: Dict[str, Any], changes: List[Change]):
+    for name, item in old.items():
+        item_path = f"{path}[name={name}]"
+        if name not in new:
+            changes.append(Change(REMOVED, item_path, old=item))
+        else:
+            diff_values(item_path, item, new[name], changes)
+    for name, item in new.items():
+        if name not in old:
+            changes.append(Change(ADDED, f"{path}[name={name}]", new=item))
+
+
+###### Documents ######
+
+def document_id(doc: Any) -> Optional[Tuple[str, str, str]]:
+    if not isinstance(doc, dict) or not isinstance(doc.get("metadata"), dict):
+        return None
+    metadata = doc["metadata"]
+    if "kind" not in doc or "name" not in metadata:
+        return None
+    return (str(doc["kind"]), str(metadata.get("namespace", "")), str(metadata["name"]))
+
+
+def document_label(doc: Any, index: int) -> str:
+    doc_id = document_id(doc)
+    if doc_id is None:
+        return f"document {index + 1}"
+    kind, namespace, name = doc_id
+    return f"{kind}/{namespace}/{name}" if namespace else f"{kind}/{name}"
+
+
+def match_documents(old: List[Any], new: List[Any]) -> List[Tuple[Any, Any, str]]:
+    """Pairs up the documents as (old, new, label); a missing side is `_MISSING`."""
+    old_ids, new_ids = [document_id(d) for d in old], [document_id(d) for d in new]
+    by_id = (None not in old_ids + new_ids
+             and len(set(old_ids)) == len(old_ids) and len(set(new_ids)) == len(new_ids))
+    if not by_id:
+        length = max(len(old), len(new))
+        pairs = []
+        for i in range(length):
+            old_doc = old[i] if i < len(old) else _MISSING
+            new_doc = new[i] if i < len(new) else _MISSING
+            pairs.append((old_doc, new_doc, document_label(new_doc if old_doc is _MISSING else old_doc, i)))
+        return pairs
+
+    new_by_id, old_id_set = dict(zip(new_ids, new)), set(old_ids)
+    pairs = [(doc, new_by_id.get(doc_id, _MISSING), document_label(doc, i))
+             for i, (doc_id, doc) in enumerate(zip(old_ids, old))]
+    pairs += [(_MISSING, doc, document_label(doc, i))
+              for i, (doc_id, doc) in enumerate(zip(new_ids, new)) if doc_id not in old_id_set]
+    return pairs
+
+
+# The libyaml parser is an order of magnitude faster, where PyYAML was built with it
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load_documents(config_yaml: str) -> List[Any]:
+    # Empty documents (e.g. after a trailing `---`) carry no content
+    return [doc for doc in yaml.load_all(config_yaml, Loader=Loader) if doc is not None]
+
+
+def semantic_diff(old_docs: List[Any], new_docs: List[Any]) -> List[Tuple[str, List[Change]]]:
+    """The changes per document, as [(label, changes)] for the documents that changed."""
+    result = []
+    for old_doc, new_doc, label in match_documents(old_docs, new_docs):
+        changes: List[Change] = []
+        if old_doc is _MISSING:
+            changes.append(Change(ADDED, "", new=new_doc))
+        elif new_doc is _MISSING:
+            changes.append(Change(REMOVED, "", old=old_doc))
+        else:
+            diff_values("", old_doc, new_doc, changes)
+        if changes:
+            result.append((label, changes))
+    return result
+
+
+def format_semantic_diff(documents: List[Tuple[str, List[Change]]]) -> str:
+    lines = []
+    for label, changes in documents:
+        lines.append(f"# {label}")
+        lines += [format_change(c) for c in changes]
+    return "\n".join(lines)
+
+
+UNIFIED_DIFF_HEADER = "--- before"
+
+
+def unified_diff(before: str, after: str, context: int = 3) -> str:
+    # Starts with UNIFIED_DIFF_HEADER, which tells it apart from a change set
+    return "\n".join(difflib.unified_diff(
+        before.splitlines(), after.splitlines(), "before", "after", n=context, lineterm=""))
+
+
+###### Memoized entry point ######
+
+_cache: OrderedDict[str, str] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def diff_key(before: str, after: str) -> str:
+    h = hashlib.sha256(before.encode("utf-8"))
+    h.update(b"\0" + after.encode("utf-8"))
+    return h.hexdigest()
+
+
+def compute_diff(before: str, after: str) -> str:
+    if before == after:
+        return ""
+    try:
+        old_docs, new_docs = load_documents(before), load_documents(after)
+    except yaml.YAMLError:
+        return unified_diff(before, after)
+    documents = semantic_diff(old_docs, new_docs)
+    if not documents:
+        # Only formatting or comments changed
+        return unified_diff(before, after)
+    return format_semantic_diff(documents)
+
+
+def diff_configs(before: str, after: str) -> str:
+    """The change set from `before` to `after`, or a unified diff if they can't be compared as YAML."""
+    key = diff_key(before, after)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = compute_diff(before, after)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > DIFF_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
@@ -12,4 +12,13 @@ setup(
     packages=find_packages(),
     package_dir={'kurator': 'kurator'},
     install_requires=requirements,
+    entry_points={
+        'console_scripts': [
+            'kurator-build-schemas=kurator.crd_schemas:main',
+            'kurator-migrate=kurator.migrate:main',
+            'kurator-revalidate=kurator.revalidate:main',
+            'kurator-export=kurator.export:main',
+            'kurator-index-search=kurator.search:main',
+        ],
+    },
 )